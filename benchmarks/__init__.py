@@ -0,0 +1,7 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
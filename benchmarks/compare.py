@@ -0,0 +1,66 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+""" Compare two result files written by ``python -m benchmarks.run``
+
+    Usage::
+
+        python -m benchmarks.compare baseline.json results.json
+
+"""
+
+import argparse
+import json
+import sys
+
+
+def compare(baseline, results):
+    """ Return rows of (name, old time, new time, time ratio, memory ratio)
+    """
+    rows = []
+    for name in sorted(set(baseline['results']) | set(results['results'])):
+        old = baseline['results'].get(name)
+        new = results['results'].get(name)
+        if old is None or new is None:
+            rows.append((name, old and old['seconds'], new and new['seconds'],
+                         None, None))
+            continue
+        rows.append((name, old['seconds'], new['seconds'],
+                     new['seconds'] / old['seconds'],
+                     new['peak_memory_bytes'] /
+                     max(old['peak_memory_bytes'], 1)))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare two benchmark result files.")
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    args = parser.parse_args(argv)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    if baseline['parameters'] != results['parameters']:
+        sys.stderr.write("Warning: the benchmarks were run with different "
+                         "parameters.\n")
+    sys.stdout.write('%-32s %10s %10s %8s %8s\n'
+                     % ('benchmark', 'old (s)', 'new (s)', 'time', 'memory'))
+    for name, old, new, time_ratio, memory_ratio in compare(baseline,
+                                                            results):
+        sys.stdout.write('%-32s %10s %10s %8s %8s\n' % (
+            name,
+            '-' if old is None else '%.4f' % old,
+            '-' if new is None else '%.4f' % new,
+            '-' if time_ratio is None else '%.2fx' % time_ratio,
+            '-' if memory_ratio is None else '%.2fx' % memory_ratio))
+
+
+if __name__ == '__main__':
+    main()
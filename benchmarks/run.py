@@ -0,0 +1,173 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+""" Time and memory-profile the .uc consensus pipeline on synthetic data
+
+    Usage::
+
+        python -m benchmarks.run --queries 100000 --output results.json
+        python -m benchmarks.compare baseline.json results.json
+
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import taxster
+from taxster._uc import (_compute_consensus_annotation,
+                         _compute_consensus_annotations, _uc_to_taxonomy)
+
+from benchmarks.synthetic import (generate_taxonomy_map, generate_uc,
+                                  write_taxonomy_map)
+
+
+def _benchmarks(uc_path, taxonomy_map, taxonomy_table, annotations):
+    """ Return the benchmarked callables, keyed by name """
+    largest = max(annotations.values(), key=len)
+
+    def uc_to_taxonomy():
+        with open(uc_path) as uc:
+            _uc_to_taxonomy(uc, taxonomy_map)
+
+    def compute_consensus_annotation():
+        _compute_consensus_annotation(largest, 0.51, "Unassigned")
+
+    def compute_consensus_annotations():
+        _compute_consensus_annotations(annotations, 0.51, "Unassigned")
+
+    def uc_consensus_assignments():
+        with open(uc_path) as uc:
+            taxster.uc_consensus_assignments(uc, taxonomy_map)
+
+    def uc_consensus_assignments_table():
+        taxster.uc_consensus_assignments(uc_path, taxonomy_table)
+
+    return [('uc_to_taxonomy', uc_to_taxonomy),
+            ('compute_consensus_annotation', compute_consensus_annotation),
+            ('compute_consensus_annotations', compute_consensus_annotations),
+            ('uc_consensus_assignments', uc_consensus_assignments),
+            ('uc_consensus_assignments_table',
+             uc_consensus_assignments_table)]
+
+
+def _time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(queries, hits, depth, references, branching, repeat, seed=0,
+        select=None):
+    """ Run the benchmarks and return their results as a dict """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        taxonomy_map = generate_taxonomy_map(references, depth, branching,
+                                             seed)
+        tax_path = os.path.join(temp_dir, 'tax-map.tsv')
+        with open(tax_path, 'w') as f:
+            write_taxonomy_map(taxonomy_map, f)
+        uc_path = os.path.join(temp_dir, 'hits.uc')
+        with open(uc_path, 'w') as f:
+            n_records = generate_uc(f, queries, sorted(taxonomy_map), hits,
+                                    seed=seed)
+        uc_bytes = os.path.getsize(uc_path)
+        taxonomy_table = taxster.load_taxonomy_map(tax_path, cache=False)
+        with open(uc_path) as uc:
+            annotations = _uc_to_taxonomy(uc, taxonomy_map)
+
+        results = {}
+        for name, func in _benchmarks(uc_path, taxonomy_map, taxonomy_table,
+                                      annotations):
+            if select and name not in select:
+                continue
+            times = _time(func, repeat)
+            results[name] = {'seconds': min(times), 'times': times,
+                             'peak_memory_bytes': _peak_memory(func)}
+            if name != 'compute_consensus_annotation':
+                results[name]['records_per_second'] = n_records / min(times)
+            sys.stderr.write('%-32s %10.4fs %12d bytes\n'
+                             % (name, min(times),
+                                results[name]['peak_memory_bytes']))
+    finally:
+        shutil.rmtree(temp_dir)
+    return {'commit': _commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {'queries': queries, 'hits': list(hits),
+                           'depth': depth, 'references': references,
+                           'branching': branching, 'repeat': repeat,
+                           'seed': seed, 'records': n_records,
+                           'uc_bytes': uc_bytes},
+            'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the .uc consensus pipeline on synthetic "
+                    "data, writing the results as JSON.")
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--hits', type=int, nargs=2, default=[1, 10],
+                        metavar=('MIN', 'MAX'),
+                        help="range of the number of hits per query")
+    parser.add_argument('--depth', type=int, default=7)
+    parser.add_argument('--references', type=int, default=10000)
+    parser.add_argument('--branching', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--benchmark', action='append', dest='select',
+                        help="only run this benchmark (may be repeated)")
+    parser.add_argument('--output', '-o',
+                        help="file to write the JSON results to (default: "
+                             "stdout)")
+    args = parser.parse_args(argv)
+    results = run(args.queries, tuple(args.hits), args.depth,
+                  args.references, args.branching, args.repeat, args.seed,
+                  args.select)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import random
+
+
+def generate_taxonomy_map(n_references, depth=7, branching=5, seed=0):
+    """ Generate random taxonomic annotations for reference sequences
+
+        Parameters
+        ----------
+        n_references : int
+            The number of reference sequences.
+        depth : int, optional
+            The number of ranks in each annotation.
+        branching : int, optional
+            The number of distinct child taxa of each taxon.
+        seed : int, optional
+            Seed for the random number generator.
+
+        Returns
+        -------
+        dict
+            Mapping of reference identifiers (``r0``, ``r1``, ...) to
+            taxonomic annotations, as accepted by
+            ``taxster.uc_consensus_assignments``.
+
+    """
+    rng = random.Random(seed)
+    result = {}
+    for i in range(n_references):
+        lineage = []
+        for level in range(depth):
+            lineage.append('%d__%s' % (level, '.'.join(
+                lineage[-1:] + [str(rng.randrange(branching))])))
+        result['r%d' % i] = lineage
+    return result
+
+
+def write_taxonomy_map(taxonomy_map, f):
+    """ Write a taxonomy map in the tab-separated format of tax-map.tsv """
+    for reference_id, lineage in taxonomy_map.items():
+        f.write('%s\t%s\n' % (reference_id, '; '.join(lineage)))
+
+
+def generate_uc(f, n_queries, reference_ids, hits_per_query=(1, 10),
+                no_hit_fraction=0.05, seed=0):
+    """ Write a random query-grouped .uc file
+
+        Parameters
+        ----------
+        f : file-like object
+            Text file to write the records to.
+        n_queries : int
+            The number of query sequences.
+        reference_ids : list of str
+            Identifiers of the reference sequences that queries can hit.
+        hits_per_query : int or tuple of int, optional
+            The number of hits of each query, or the inclusive range to draw
+            it from uniformly.
+        no_hit_fraction : float, optional
+            The fraction of queries with an N record instead of hits.
+        seed : int, optional
+            Seed for the random number generator.
+
+        Returns
+        -------
+        int
+            The number of H and N records written.
+
+    """
+    rng = random.Random(seed)
+    if isinstance(hits_per_query, int):
+        hits_per_query = (hits_per_query, hits_per_query)
+    f.write('# Tab-separated fields:\n'
+            '# 1=Type, 2=ClusterNr, 3=SeqLength or ClusterSize, 4=PctId, '
+            '...\n')
+    n_records = 0
+    for q in range(n_queries):
+        query_id = 'q%d' % q
+        if rng.random() < no_hit_fraction:
+            f.write('N\t*\t195\t*\t*\t*\t*\t*\t%s\t*\n' % query_id)
+            n_records += 1
+            continue
+        for _ in range(rng.randint(*hits_per_query)):
+            reference_id = rng.choice(reference_ids)
+            f.write('H\t%s\t193\t%.1f\t+\t0\t0\t534I193M787I\t%s\t%s\n'
+                    % (reference_id, rng.uniform(90, 100), query_id,
+                       reference_id))
+            n_records += 1
+    return n_records
@@ -13,8 +13,11 @@ from taxster import __version__
 setup(
     name="taxster",
     version=__version__,
-    packages=find_packages(),
-    install_requires=['pandas'],
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
+    python_requires='>=3.7',
+    install_requires=['numpy', 'pandas'],
+    extras_require={'arrow': ['pyarrow'], 'zstd': ['zstandard']},
+    entry_points={'console_scripts': ['taxster=taxster._cli:main']},
     author="Greg Caporaso",
     author_email="gregcaporaso@gmail.com",
     description="Functionality for working with taxonomy data.",
@@ -6,8 +6,27 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from taxster._uc import uc_consensus_assignments
+from taxster._assignments import ConsensusAssignments, ConsensusLineages
+from taxster._async import aiter_uc_consensus_assignments
+from taxster._cache import ConsensusCache
+from taxster._errors import MissingReferenceError, UcErrors, UcRecordError
+from taxster._export import (uc_consensus_dataframe, uc_consensus_arrow,
+                             write_uc_consensus_assignments)
+from taxster._incremental import IncrementalConsensus
+from taxster._samples import uc_consensus_samples
+from taxster._stats import ConsensusStats
+from taxster._taxonomy import TaxonomyTable, load_taxonomy_map
+from taxster._uc import (uc_consensus_assignments,
+                         iter_uc_consensus_assignments,
+                         uc_consensus_lineages, uc_consensus_thresholds)
 
 __version__ = "0.0.0-dev"
 
-__all__ = ['uc_consensus_assignments']
+__all__ = ['uc_consensus_assignments', 'iter_uc_consensus_assignments',
+           'uc_consensus_lineages', 'uc_consensus_thresholds',
+           'aiter_uc_consensus_assignments', 'uc_consensus_samples',
+           'uc_consensus_dataframe', 'uc_consensus_arrow',
+           'write_uc_consensus_assignments', 'TaxonomyTable',
+           'load_taxonomy_map', 'ConsensusAssignments', 'ConsensusLineages',
+           'ConsensusCache', 'ConsensusStats', 'IncrementalConsensus',
+           'UcErrors', 'UcRecordError', 'MissingReferenceError']
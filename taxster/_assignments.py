@@ -0,0 +1,387 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from array import array
+from collections.abc import ItemsView, Mapping, ValuesView
+
+import numpy as np
+
+from taxster._taxonomy import TaxonomyTable
+from taxster._vectorized import _ancestor_matrix, _rank_consensus
+
+
+class _QueryMapping(Mapping):
+    """ Read-only mapping of query identifiers to rows of arrays
+
+        Subclasses store their values in arrays parallel to ``_query_ids``,
+        and implement ``_value(i)`` and ``_iter_values()``.
+
+    """
+
+    __slots__ = ('_query_ids', '_index')
+
+    def __getitem__(self, query_id):
+        return self._value(self._position(query_id))
+
+    def __iter__(self):
+        return iter(self._query_ids)
+
+    def __len__(self):
+        return len(self._query_ids)
+
+    def __contains__(self, query_id):
+        if self._index is None:
+            self._build_index()
+        return query_id in self._index
+
+    def __repr__(self):
+        return '%s(queries=%d)' % (self.__class__.__name__, len(self))
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    @property
+    def query_ids(self):
+        """ Query sequence identifiers, in the order of the arrays """
+        return self._query_ids
+
+    def _build_index(self):
+        self._index = {query_id: i
+                       for i, query_id in enumerate(self._query_ids)}
+
+    def _position(self, query_id):
+        if self._index is None:
+            self._build_index()
+        return self._index[query_id]
+
+
+class ConsensusAssignments(_QueryMapping):
+    """ Compact mapping of query identifiers to consensus annotations
+
+        The consensus of each query is stored as a node identifier of a
+        ``TaxonomyTable``, with its consensus fraction and number of hits in
+        parallel arrays, rather than as a tuple holding a list of str per
+        query. Indexing it with a query identifier returns the same tuple of
+        consensus taxonomic annotation (list), consensus fraction (float) and
+        number of hits (int) as the dict that was returned before, and it
+        compares equal to such a dict.
+
+        Parameters
+        ----------
+        query_ids : list of str
+            Query sequence identifiers.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+        nodes : array-like of int
+            Consensus lineage node identifier of each query. The root node
+            means that no acceptable annotation was identified.
+        fractions : array-like of float
+            Consensus fraction of each query.
+        n_hits : array-like of int
+            Number of hits of each query.
+        unassignable_label : str, optional
+            The annotation of queries whose consensus is the root node.
+
+        Notes
+        -----
+        The index from query identifiers to positions is only built when a
+        query is first looked up, so iterating over the items of a large
+        result doesn't pay for it. The annotation of each distinct consensus
+        node is expanded once, and each lookup returns a new list, which the
+        caller may modify.
+
+    """
+
+    __slots__ = ('_taxonomy_table', '_nodes', '_fractions', '_n_hits',
+                 '_unassignable_label', '_annotations')
+
+    def __init__(self, query_ids, taxonomy_table, nodes, fractions, n_hits,
+                 unassignable_label="Unassigned"):
+        self._query_ids = list(query_ids)
+        self._taxonomy_table = taxonomy_table
+        self._nodes = np.asarray(nodes, dtype=np.intc)
+        self._fractions = np.asarray(fractions, dtype=np.float64)
+        self._n_hits = np.asarray(n_hits, dtype=np.uint32)
+        self._unassignable_label = unassignable_label
+        self._index = None
+        self._annotations = {}
+        if not (len(self._query_ids) == len(self._nodes) ==
+                len(self._fractions) == len(self._n_hits)):
+            raise ValueError("query_ids, nodes, fractions and n_hits must "
+                             "have the same length.")
+
+    def __reduce__(self):
+        # the index and annotations are rebuilt on demand
+        return (self.__class__,
+                (self._query_ids, self._taxonomy_table, self._nodes,
+                 self._fractions, self._n_hits, self._unassignable_label))
+
+    @property
+    def taxonomy_table(self):
+        """ The table that ``nodes`` refer to """
+        return self._taxonomy_table
+
+    @property
+    def nodes(self):
+        """ Consensus lineage node identifier of each query """
+        return self._nodes
+
+    @property
+    def fractions(self):
+        """ Consensus fraction of each query """
+        return self._fractions
+
+    @property
+    def n_hits(self):
+        """ Number of hits of each query """
+        return self._n_hits
+
+    @property
+    def unassignable_label(self):
+        """ The annotation of queries whose consensus is the root node """
+        return self._unassignable_label
+
+    @classmethod
+    def _from_tuples(cls, assignments, unassignable_label):
+        """ Collect ``(query id, annotation, fraction, n_hits)`` tuples
+
+            The annotations are interned in a new ``TaxonomyTable``, so each
+            distinct annotation is stored once. Unassigned queries, whose
+            annotation is ``[unassignable_label]``, are stored as the root,
+            as when the assignments are computed from a ``TaxonomyTable``.
+
+        """
+        table = TaxonomyTable()
+        unassigned = [unassignable_label]
+        query_ids = []
+        nodes = array('i')
+        fractions = array('d')
+        n_hits = array('I')
+        for query_id, annotation, fraction, count in assignments:
+            query_ids.append(query_id)
+            nodes.append(TaxonomyTable.root if annotation == unassigned
+                         else table.intern(annotation))
+            fractions.append(fraction)
+            n_hits.append(count)
+        return cls(query_ids, table, np.frombuffer(nodes, dtype=np.intc),
+                   np.frombuffer(fractions, dtype=np.float64),
+                   np.frombuffer(n_hits, dtype=np.uint32),
+                   unassignable_label)
+
+    @classmethod
+    def _concatenate(cls, parts, unassignable_label):
+        """ Concatenate results, which may refer to different tables """
+        parts = list(parts)
+        tables = {id(part._taxonomy_table) for part in parts}
+        if len(tables) == 1:
+            table = parts[0]._taxonomy_table
+            nodes = [part._nodes for part in parts]
+        else:
+            table = TaxonomyTable()
+            nodes = [_remap_nodes(part._nodes, part._taxonomy_table, table)
+                     for part in parts]
+        query_ids = []
+        for part in parts:
+            query_ids.extend(part._query_ids)
+        return cls(query_ids, table,
+                   np.concatenate(nodes or [np.zeros(0, np.intc)]),
+                   np.concatenate([part._fractions for part in parts] or
+                                  [np.zeros(0)]),
+                   np.concatenate([part._n_hits for part in parts] or
+                                  [np.zeros(0, np.uint32)]),
+                   unassignable_label)
+
+    def _detach(self):
+        """ Return a copy that refers to a new table holding only the
+            consensus lineages, which is much smaller to pickle than a
+            reference database
+        """
+        table = TaxonomyTable()
+        return self.__class__(
+            self._query_ids, table,
+            _remap_nodes(self._nodes, self._taxonomy_table, table),
+            self._fractions, self._n_hits, self._unassignable_label)
+
+    def _value(self, i):
+        return (list(self._annotation(int(self._nodes[i]))),
+                float(self._fractions[i]), int(self._n_hits[i]))
+
+    def _annotation(self, node):
+        """ Return the shared annotation of a node, which must be copied """
+        annotation = self._annotations.get(node)
+        if annotation is None:
+            if node == TaxonomyTable.root:
+                annotation = [self._unassignable_label]
+            else:
+                annotation = self._taxonomy_table.lineage(node)
+            self._annotations[node] = annotation
+        return annotation
+
+    def _iter_values(self):
+        """ Iterate over the values in order """
+        annotation = self._annotation
+        for node, fraction, count in zip(self._nodes.tolist(),
+                                         self._fractions.tolist(),
+                                         self._n_hits.tolist()):
+            yield list(annotation(node)), fraction, count
+
+
+class ConsensusLineages(_QueryMapping):
+    """ Majority lineages of queries, with the fraction of hits at each rank
+
+        The majority lineage of a query is the most common lineage prefix of
+        its hits at each rank, for as long as it is held by more than half of
+        them. The consensus annotation at any ``min_consensus_fraction``
+        (which must be greater than 0.5) is a prefix of it: its ranks whose
+        fraction is at least ``min_consensus_fraction``. The assignments at
+        any number of thresholds can thus be derived from one computation
+        with ``assignments``.
+
+        Indexing it with a query identifier returns a tuple of the majority
+        lineage (list of str), the fraction of the query's hits that agree
+        with it at each rank (list of float, which never increase), and the
+        number of hits (int). Both lists are empty if no taxon is held by
+        more than half of the hits at the first rank.
+
+        Parameters
+        ----------
+        query_ids : list of str
+            Query sequence identifiers.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+        nodes : array-like of int
+            Node identifier of the deepest rank of each query's majority
+            lineage, or the root node if it is empty.
+        rank_fractions : array-like of float
+            Array of shape ``(len(query_ids), max_depth)`` holding the
+            fraction of each query's hits that agree with its majority
+            lineage at each rank, padded with NaN.
+        n_hits : array-like of int
+            Number of hits of each query.
+
+    """
+
+    __slots__ = ('_taxonomy_table', '_nodes', '_rank_fractions', '_n_hits')
+
+    def __init__(self, query_ids, taxonomy_table, nodes, rank_fractions,
+                 n_hits):
+        self._query_ids = list(query_ids)
+        self._taxonomy_table = taxonomy_table
+        self._nodes = np.asarray(nodes, dtype=np.intc)
+        self._rank_fractions = np.asarray(rank_fractions, dtype=np.float64)
+        self._n_hits = np.asarray(n_hits, dtype=np.uint32)
+        self._index = None
+        if not (len(self._query_ids) == len(self._nodes) ==
+                len(self._rank_fractions) == len(self._n_hits)):
+            raise ValueError("query_ids, nodes, rank_fractions and n_hits "
+                             "must have the same length.")
+
+    def __reduce__(self):
+        return (self.__class__,
+                (self._query_ids, self._taxonomy_table, self._nodes,
+                 self._rank_fractions, self._n_hits))
+
+    @property
+    def taxonomy_table(self):
+        """ The table that ``nodes`` refer to """
+        return self._taxonomy_table
+
+    @property
+    def nodes(self):
+        """ Node identifier of the deepest rank of each majority lineage """
+        return self._nodes
+
+    @property
+    def rank_fractions(self):
+        """ Fraction of hits that agree at each rank, padded with NaN """
+        return self._rank_fractions
+
+    @property
+    def n_hits(self):
+        """ Number of hits of each query """
+        return self._n_hits
+
+    def assignments(self, min_consensus_fraction=0.51,
+                    unassignable_label="Unassigned"):
+        """ Return the consensus annotations at a threshold
+
+            Parameters
+            ----------
+            min_consensus_fraction : float, optional
+                The minimum fraction of the annotations that a specfic
+                annotation must be present in for that annotation to be
+                accepted. This must be greater than 0.50.
+            unassignable_label : str, optional
+                The label to apply if no acceptable annotations are
+                identified.
+
+            Returns
+            -------
+            ConsensusAssignments
+                The consensus annotations, as returned by
+                ``uc_consensus_assignments`` with the same parameters.
+
+            Raises
+            ------
+            ValueError
+                If min_consensus_fraction <= 0.50.
+
+        """
+        if min_consensus_fraction <= 0.5:
+            raise ValueError("min_consensus_fraction must be greater than "
+                             "0.5.")
+        rank_nodes = _ancestor_matrix(self._nodes, self._taxonomy_table)
+        nodes, fractions = _rank_consensus(
+            rank_nodes, self._rank_fractions[:, :rank_nodes.shape[1]],
+            min_consensus_fraction)
+        return ConsensusAssignments(self._query_ids, self._taxonomy_table,
+                                    nodes, fractions, self._n_hits,
+                                    unassignable_label)
+
+    def _value(self, i):
+        node = int(self._nodes[i])
+        return (self._taxonomy_table.lineage(node),
+                self._rank_fractions[
+                    i, :self._taxonomy_table.depth(node)].tolist(),
+                int(self._n_hits[i]))
+
+    def _iter_values(self):
+        """ Iterate over the values in order """
+        for i in range(len(self._query_ids)):
+            yield self._value(i)
+
+
+class _ItemsView(ItemsView):
+
+    def __iter__(self):
+        return zip(self._mapping._query_ids, self._mapping._iter_values())
+
+
+class _ValuesView(ValuesView):
+
+    def __iter__(self):
+        return self._mapping._iter_values()
+
+
+def _remap_nodes(nodes, source_table, target_table):
+    """ Intern the lineages of nodes of one table in another table
+
+        Returns
+        -------
+        np.ndarray of int
+            The node identifier in ``target_table`` of each node.
+
+    """
+    distinct, inverse = np.unique(nodes, return_inverse=True)
+    targets = np.array([target_table.intern(source_table.lineage(node))
+                        for node in distinct.tolist()], dtype=np.intc)
+    return targets[inverse.ravel()] if len(distinct) else \
+        np.zeros(0, dtype=np.intc)
@@ -0,0 +1,219 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import io
+from collections import deque
+
+from taxster._errors import _RecordChecker, _resolve_errors
+from taxster._parallel import _record_query
+from taxster._uc import _CompletedQueries, _iter_consensus_assignments
+
+
+async def aiter_uc_consensus_assignments(stream, taxonomy_map,
+                                         min_consensus_fraction=0.51,
+                                         unassignable_label="Unassigned",
+                                         executor=None, batch_size=1 << 20,
+                                         max_pending_batches=2, errors=None):
+    """ Asynchronously compute consensus taxonomic annotations for a uc stream
+
+        Parameters
+        ----------
+        stream : asyncio.StreamReader or async iterable of bytes
+            The contents of a .uc file, such as those generated by uclust,
+            usearch, or vsearch. Objects with a ``read`` coroutine method are
+            read in blocks of ``batch_size`` bytes. All records for a given
+            query must be adjacent.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+            It is only read, so one map can be shared by any number of
+            concurrent calls.
+        min_consensus_fraction : float, optional
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than 0.50.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        executor : concurrent.futures.Executor, optional
+            The executor to parse batches of records and compute their
+            consensus in. Defaults to the event loop's default executor.
+        batch_size : int, optional
+            Approximate number of bytes of .uc records per batch. Blocks of
+            ``stream`` are collected until they hold at least this many
+            bytes, and then cut after their last complete query, so each
+            batch but the last holds at least ``batch_size`` bytes less the
+            records of one query.
+        max_pending_batches : int, optional
+            The maximum number of batches submitted to the executor and not
+            yet fully yielded. ``stream`` isn't read while this many are
+            pending, so a slow consumer slows down reading.
+        errors : UcErrors or str, optional
+            What to do with unusable records, as for
+            ``uc_consensus_assignments``. The records of each batch are
+            counted in ``errors`` as its assignments are yielded.
+
+        Yields
+        ------
+        tuple
+            Query identifier (str), consensus taxonomic annotation (list),
+            consensus fraction (float), and number of input annotations that
+            were provided for the query (int), in the order of ``stream``, as
+            yielded by ``iter_uc_consensus_assignments``.
+
+        Raises
+        ------
+        ValueError
+            If min_consensus_fraction <= 0.50.
+        ValueError
+            If the records for a query are found not to be adjacent in
+            ``stream``, as for ``iter_uc_consensus_assignments``.
+        UcRecordError
+            If a record is unusable, and the error policy is strict.
+
+        See Also
+        --------
+        iter_uc_consensus_assignments
+
+        Notes
+        -----
+        The event loop only splits the stream into batches of whole queries,
+        which needs just the last few lines of each block to be parsed. The
+        batches are processed in ``executor``, so the event loop is not
+        blocked by them. In a thread pool, this holds the GIL, but the other
+        tasks of the event loop still get to run between bytecodes.
+
+        If the iteration is stopped early or its task is cancelled, batches
+        that haven't started are cancelled, and the results of running ones
+        are discarded.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    if max_pending_batches < 1:
+        raise ValueError("max_pending_batches must be at least 1.")
+    errors = _resolve_errors(errors)
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    completed = _CompletedQueries()
+    # lines before the next batch, so that batches report line numbers of
+    # the whole stream
+    lines = [0]
+
+    def submit(data):
+        pending.append(loop.run_in_executor(
+            executor, _consensus_batch, data, taxonomy_map,
+            min_consensus_fraction, unassignable_label, errors._empty(),
+            lines[0]))
+        lines[0] += data.count(b'\n')
+
+    try:
+        # blocks are collected until they hold at least batch_size bytes,
+        # and joined once to be cut after their last complete query
+        blocks = []
+        size = 0
+        limit = batch_size
+        async for block in _aiter_blocks(stream, batch_size):
+            blocks.append(block)
+            size += len(block)
+            if size < limit:
+                continue
+            buffer = b''.join(blocks)
+            end = _complete_queries_end(buffer)
+            blocks = [buffer[end:]]
+            size = len(blocks[0])
+            if end == 0:
+                # the records of one query fill the buffer, so more are
+                # collected before it is joined again
+                limit = 2 * size
+                continue
+            limit = batch_size
+            submit(buffer[:end])
+            while len(pending) >= max_pending_batches:
+                for assignment in _check_batch(await pending.popleft(),
+                                               completed, errors):
+                    yield assignment
+        buffer = b''.join(blocks)
+        if buffer:
+            submit(buffer)
+        while pending:
+            for assignment in _check_batch(await pending.popleft(),
+                                           completed, errors):
+                yield assignment
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def _aiter_blocks(stream, block_size):
+    """ Iterate over the blocks of bytes of an async stream """
+    if hasattr(stream, 'read'):
+        while True:
+            block = await stream.read(block_size)
+            if not block:
+                return
+            yield block
+    else:
+        async for block in stream:
+            yield block
+
+
+def _complete_queries_end(data):
+    """ Return the offset in ``data`` after which its last query's records
+        may continue
+
+        Only complete lines that belong to a different query than the last
+        complete line can be processed, since the next block may have more
+        records of that query.
+
+    """
+    end = data.rfind(b'\n') + 1
+    last_query = None
+    while end > 0:
+        start = data.rfind(b'\n', 0, end - 1) + 1
+        query = _record_query(data[start:end])
+        if query is not None:
+            if last_query is None:
+                last_query = query
+            elif query != last_query:
+                return end
+        end = start
+    return 0
+
+
+def _consensus_batch(data, taxonomy_map, min_consensus_fraction,
+                     unassignable_label, errors, line_base):
+    """ Compute the consensus annotations of a batch of whole queries
+
+        Returns the assignments, and ``errors``, in which the unusable
+        records of the batch are counted. Its lines are numbered from
+        ``line_base`` + 1.
+
+    """
+    checker = _RecordChecker(errors, taxonomy_map, line_base)
+    # lines end at newlines only, as they do when a file is read, rather
+    # than at every line boundary of str.splitlines
+    return list(_iter_consensus_assignments(
+        io.StringIO(data.decode('utf-8')), taxonomy_map,
+        min_consensus_fraction, unassignable_label, None, None, None, False,
+        checker)), errors
+
+
+def _check_batch(batch, completed, errors):
+    """ Count the unusable records of a batch, and check that none of its
+        queries was completed by an earlier batch
+    """
+    assignments, batch_errors = batch
+    errors._merge(batch_errors)
+    for assignment in assignments:
+        query_id = assignment[0]
+        if query_id in completed:
+            raise ValueError(
+                "Records for query %r are not adjacent in the .uc stream."
+                % query_id)
+        completed.add(query_id)
+    return assignments
@@ -0,0 +1,185 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from __future__ import division
+
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+from taxster._taxonomy import TaxonomyTable
+
+_CACHE_VERSION = 1
+
+
+class ConsensusCache(object):
+    """ Least-recently-used cache of consensus annotations
+
+        Queries that hit exactly the same multiset of reference sequences
+        have the same consensus annotation, so it only needs to be computed
+        once. This is common in amplicon data, where the same sequence
+        variant is observed in many samples.
+
+        Parameters
+        ----------
+        maxsize : int, optional
+            The maximum number of consensus annotations to keep. The least
+            recently used annotation is evicted when this is exceeded.
+        path : str, optional
+            File to persist the cache to. If it exists, it is loaded the first
+            time the cache is used with a taxonomy map that is identical to
+            the one it was saved with, and it is written by ``save``.
+
+        Attributes
+        ----------
+        hits : int
+            Number of lookups that found a cached annotation.
+        misses : int
+            Number of lookups that did not.
+        evictions : int
+            Number of annotations evicted because the cache was full.
+
+        Notes
+        -----
+        Entries are keyed on the sorted target sequence identifiers of a
+        query's hits and the consensus parameters. They are only valid for
+        the taxonomy map they were computed with, so the cache is cleared
+        when it is used with a different one. Identifying the taxonomy map
+        requires hashing it, unless it was loaded with ``load_taxonomy_map``.
+
+    """
+
+    def __init__(self, maxsize=1000000, path=None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1.")
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._taxonomy_map = None
+        self._fingerprint = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return ('%s(size=%d, maxsize=%d, hits=%d, misses=%d, evictions=%d)'
+                % (self.__class__.__name__, len(self), self.maxsize,
+                   self.hits, self.misses, self.evictions))
+
+    @property
+    def hit_rate(self):
+        """ Fraction of lookups that found a cached annotation """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        """ Remove all entries and reset the statistics """
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def bind(self, taxonomy_map):
+        """ Prepare the cache for use with a taxonomy map
+
+            Loads the persisted entries on first use, and clears the cache if
+            ``taxonomy_map`` differs from the one its entries were computed
+            with.
+
+        """
+        if taxonomy_map is self._taxonomy_map:
+            return
+        fingerprint = _taxonomy_fingerprint(taxonomy_map)
+        if self._fingerprint is None and self.path is not None:
+            self._load(fingerprint)
+        elif fingerprint != self._fingerprint:
+            self._entries.clear()
+        self._taxonomy_map = taxonomy_map
+        self._fingerprint = fingerprint
+
+    def consensus(self, subject_ids, min_consensus_fraction,
+                  unassignable_label, compute):
+        """ Return the consensus of a query's hits, computing it if needed
+
+            Parameters
+            ----------
+            subject_ids : list
+                Target sequence identifiers of the query's hits, with ``None``
+                for N records.
+            min_consensus_fraction : float
+                The minimum consensus fraction.
+            unassignable_label : str
+                The label to apply if no acceptable annotations are
+                identified.
+            compute : callable
+                Called without arguments to compute the consensus annotation
+                (list) and consensus fraction (float) on a miss.
+
+            Returns
+            -------
+            tuple
+                Consensus annotation (list) and consensus fraction (float).
+
+        """
+        key = (tuple(sorted(s or '' for s in subject_ids)),
+               min_consensus_fraction, unassignable_label)
+        entries = self._entries
+        value = entries.get(key)
+        if value is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return list(value[0]), value[1]
+        self.misses += 1
+        annotation, fraction = compute()
+        entries[key] = (tuple(annotation), fraction)
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return annotation, fraction
+
+    def save(self, path=None):
+        """ Write the cache to ``path``, or to the path it was created with
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the cache to.")
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump({'version': _CACHE_VERSION,
+                         'fingerprint': self._fingerprint,
+                         'entries': list(self._entries.items())},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def _load(self, fingerprint):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = pickle.load(f)
+        if (data.get('version') == _CACHE_VERSION and
+                data.get('fingerprint') == fingerprint):
+            self._entries = OrderedDict(data['entries'][-self.maxsize:])
+
+
+def _taxonomy_fingerprint(taxonomy_map):
+    """ Return a hash identifying the contents of a taxonomy map """
+    source_sha1 = getattr(taxonomy_map, '_source_sha1', None)
+    if source_sha1 is not None:
+        return source_sha1
+    h = hashlib.sha1()
+    if isinstance(taxonomy_map, TaxonomyTable):
+        items = ((r, taxonomy_map.lineage(n))
+                 for r, n in taxonomy_map._references.items())
+    else:
+        items = taxonomy_map.items()
+    for reference_id, lineage in items:
+        h.update(('%s\t%s\n' % (reference_id, '; '.join(lineage)))
+                 .encode('utf-8'))
+    return h.hexdigest()
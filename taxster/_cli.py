@@ -0,0 +1,292 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+""" The ``taxster`` command line interface
+
+    Usage::
+
+        vsearch --usearch_global seqs.fna --db refs.fna --id 0.97 \\
+            --maxaccepts 3 --uc - | taxster uc-consensus -t tax-map.tsv -
+
+"""
+
+from __future__ import division
+
+import argparse
+import os
+import sys
+import time
+
+from taxster import __version__
+from taxster._errors import POLICIES, UcErrors, UcRecordError
+from taxster._export import _TSV_HEADER, _TSV_ROW
+from taxster._parallel import _resolve_n_jobs, _uc_path
+from taxster._stats import _peak_rss_bytes
+from taxster._taxonomy import load_taxonomy_map
+from taxster._uc import (_iter_parallel_consensus_shards,
+                         iter_uc_consensus_assignments)
+
+# queries between checks of the progress clock
+_PROGRESS_CHECK_INTERVAL = 1024
+
+
+def main(argv=None):
+    """ Run the ``taxster`` command line interface
+
+        Parameters
+        ----------
+        argv : list of str, optional
+            The command line arguments, excluding the program name. Defaults
+            to ``sys.argv[1:]``.
+
+        Returns
+        -------
+        int
+            The exit status.
+
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'command'):
+        parser.print_usage(sys.stderr)
+        return 2
+    try:
+        return args.command(args)
+    except BrokenPipeError:
+        # the reader of stdout exited, e.g. `taxster uc-consensus ... | head`,
+        # so stop quietly, without failing again when stdout is flushed at
+        # exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except (UcRecordError, ValueError, IOError, OSError) as e:
+        # missing target sequences are reported as UcRecordErrors, so other
+        # KeyErrors are bugs, and propagate with their traceback
+        parser.exit(1, "%s: error: %s\n" % (parser.prog, e))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='taxster',
+        description="Tools for working with taxonomic assignment data.")
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s ' + __version__)
+    subparsers = parser.add_subparsers(metavar='command')
+
+    uc_consensus = subparsers.add_parser(
+        'uc-consensus',
+        help="compute consensus taxonomy assignments from a .uc file",
+        description="Compute consensus taxonomy assignments from a .uc file, "
+                    "such as those written by uclust, usearch or vsearch, "
+                    "and write them as tab-separated query id, taxonomy, "
+                    "consensus fraction and number of hits. Assignments are "
+                    "written as soon as the last record of their query has "
+                    "been read, which requires that the records of each "
+                    "query are adjacent.")
+    uc_consensus.add_argument(
+        'uc', nargs='?', default='-',
+        help="the .uc file, which may be gzip, bzip2, xz or zstd "
+             "compressed, or - to read it from stdin (default: -)")
+    uc_consensus.add_argument(
+        '-t', '--taxonomy-map', required=True,
+        help="tab-separated file of target sequence ids and '; '-separated "
+             "taxonomies, or a cache directory written from one")
+    uc_consensus.add_argument(
+        '-o', '--output', default='-',
+        help="file to write the assignments to, or - for stdout "
+             "(default: -)")
+    uc_consensus.add_argument(
+        '-f', '--min-consensus-fraction', type=_consensus_fraction,
+        default=0.51,
+        help="minimum fraction of hits that must agree on a taxon for it "
+             "to be assigned; must be greater than 0.5 (default: 0.51)")
+    uc_consensus.add_argument(
+        '-u', '--unassignable-label', default='Unassigned',
+        help="label of queries without an acceptable assignment "
+             "(default: Unassigned)")
+    uc_consensus.add_argument(
+        '-n', '--max-hits', type=_positive_int, metavar='N',
+        help="compute each query's consensus from at most its N hits with "
+             "the highest percent identity (default: all hits)")
+    uc_consensus.add_argument(
+        '-w', '--weighted', action='store_true',
+        help="weight each hit's vote by its percent identity")
+    uc_consensus.add_argument(
+        '--on-error', choices=POLICIES, default='strict',
+        help="what to do with malformed records and hits of target "
+             "sequences that are not in the taxonomy map: stop with an "
+             "error (strict), drop them (skip), or count such hits as "
+             "unassigned, like N records, and drop malformed records "
+             "(unassigned). Records that were dropped or unassigned are "
+             "summarized on stderr (default: strict)")
+    uc_consensus.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help="number of processes; negative values count back from the "
+             "number of CPUs. More than one requires the .uc file to be "
+             "an uncompressed path (default: 1)")
+    cache = uc_consensus.add_mutually_exclusive_group()
+    cache.add_argument(
+        '--taxonomy-cache', metavar='DIR',
+        help="directory of the binary taxonomy map cache (default: the "
+             "taxonomy map path plus .taxster-cache)")
+    cache.add_argument(
+        '--no-taxonomy-cache', action='store_true',
+        help="don't read or write a binary taxonomy map cache")
+    uc_consensus.add_argument(
+        '--lazy-taxonomy', action='store_true',
+        help="index the taxonomy map, and only read the taxonomies of the "
+             "target sequences that are hit. The index is cached like the "
+             "binary taxonomy map, in the taxonomy map path plus "
+             ".taxster-index by default. Requires an uncompressed taxonomy "
+             "map")
+    uc_consensus.add_argument(
+        '--progress', action='store_true',
+        help="periodically report throughput and memory use on stderr")
+    uc_consensus.add_argument(
+        '--progress-interval', type=float, default=10.0, metavar='SECONDS',
+        help="seconds between progress reports (default: 10)")
+    uc_consensus.set_defaults(command=_uc_consensus)
+    return parser
+
+
+def _consensus_fraction(value):
+    fraction = float(value)
+    if fraction <= 0.5:
+        raise argparse.ArgumentTypeError("must be greater than 0.5")
+    return fraction
+
+
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def _uc_consensus(args):
+    start = time.time()
+    cache = not args.no_taxonomy_cache and (args.taxonomy_cache or True)
+    taxonomy_map = load_taxonomy_map(args.taxonomy_map, cache=cache,
+                                     lazy=args.lazy_taxonomy)
+    progress = None
+    if args.progress:
+        progress = _Progress(sys.stderr, args.progress_interval, start)
+        if args.lazy_taxonomy:
+            progress.message("indexed the taxonomy map")
+        else:
+            progress.message("loaded %d references" % len(taxonomy_map))
+
+    errors = UcErrors(args.on_error)
+    n_jobs = _resolve_n_jobs(args.jobs)
+    if n_jobs > 1:
+        if args.uc == '-':
+            raise ValueError("--jobs requires the .uc file to be given as a "
+                             "path.")
+        assignments = _iter_shard_assignments(
+            _uc_path(args.uc), taxonomy_map, args.min_consensus_fraction,
+            args.unassignable_label, n_jobs, args.max_hits, args.weighted,
+            errors)
+    else:
+        assignments = iter_uc_consensus_assignments(
+            sys.stdin if args.uc == '-' else args.uc, taxonomy_map,
+            args.min_consensus_fraction, args.unassignable_label,
+            max_hits=args.max_hits, weighted=args.weighted, errors=errors)
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        out.write(_TSV_HEADER)
+        for query_id, taxonomy, fraction, n_hits in assignments:
+            out.write(_TSV_ROW % (query_id, '; '.join(taxonomy), fraction,
+                                  n_hits))
+            if progress is not None:
+                progress.update(n_hits)
+        out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if progress is not None:
+        progress.report(final=True)
+    _report_errors(sys.stderr, errors)
+    return 0
+
+
+def _iter_shard_assignments(path, taxonomy_map, min_consensus_fraction,
+                            unassignable_label, n_jobs, max_hits=None,
+                            weighted=False, errors=None):
+    for shard_result in _iter_parallel_consensus_shards(
+            path, taxonomy_map, min_consensus_fraction, unassignable_label,
+            n_jobs, max_hits=max_hits, weighted=weighted, errors=errors):
+        for query_id, (taxonomy, fraction, n_hits) in shard_result.items():
+            yield query_id, taxonomy, fraction, n_hits
+
+
+def _report_errors(stream, errors):
+    """ Summarize the records that were dropped or unassigned """
+    if errors.malformed_records:
+        stream.write("taxster: skipped %d malformed records\n"
+                     % errors.malformed_records)
+    if errors.missing_reference_records:
+        references = sorted(errors.missing_references)
+        stream.write("taxster: %s %d hits of %d target sequences that are "
+                     "not in the taxonomy map: %s%s\n"
+                     % ('skipped' if errors.policy == 'skip' else
+                        'unassigned', errors.missing_reference_records,
+                        len(references), ', '.join(references[:10]),
+                        ', ...' if len(references) > 10 else ''))
+    for line_number, description in errors.examples:
+        stream.write("taxster: line %s: %s\n"
+                     % ('?' if line_number is None else line_number,
+                        description))
+
+
+class _Progress(object):
+    """ Periodic report of throughput and memory use
+
+        Parameters
+        ----------
+        stream : file-like object
+            Where to write the reports.
+        interval : float
+            Seconds between reports.
+        start : float
+            The ``time.time()`` the run started at.
+
+    """
+
+    def __init__(self, stream, interval, start):
+        self.stream = stream
+        self.interval = interval
+        self.start = start
+        self.n_queries = 0
+        self.n_hits = 0
+        self._next_report = time.time() + interval
+
+    def update(self, n_hits):
+        """ Count a completed query, and report if the interval has passed
+        """
+        self.n_queries += 1
+        self.n_hits += n_hits
+        if (self.n_queries % _PROGRESS_CHECK_INTERVAL == 0 and
+                time.time() >= self._next_report):
+            self.report()
+
+    def report(self, final=False):
+        now = time.time()
+        self._next_report = now + self.interval
+        elapsed = max(now - self.start, 1e-9)
+        rss = _peak_rss_bytes()
+        self.message("%s%d queries, %d hits in %.1fs (%.0f queries/s, "
+                     "%.0f hits/s), peak RSS %s"
+                     % ('done: ' if final else '', self.n_queries,
+                        self.n_hits, elapsed, self.n_queries / elapsed,
+                        self.n_hits / elapsed,
+                        'unknown' if rss is None else
+                        '%.1f MiB' % (rss / (1 << 20))))
+
+    def message(self, text):
+        self.stream.write('taxster: %s\n' % text)
+        self.stream.flush()
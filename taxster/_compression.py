@@ -0,0 +1,309 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import bz2
+import lzma
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# leading bytes of each supported compression format
+_MAGIC = [(b'\x1f\x8b', 'gzip'),
+          (b'BZh', 'bz2'),
+          (b'\xfd7zXZ\x00', 'xz'),
+          (b'\x28\xb5\x2f\xfd', 'zstd')]
+# gzip magic, deflate compression method, and only the FEXTRA flag set
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+_READ_SIZE = 1 << 20
+# decompressed blocks buffered ahead of the reader
+_MAX_PENDING_BLOCKS = 8
+# BGZF blocks inflated per batch and worker thread
+_BGZF_BLOCKS_PER_WORKER = 16
+
+
+def _compression(path):
+    """ Return the compression format of a file, or None if uncompressed
+
+        The format is identified from the file's leading bytes, so the file
+        name does not need a matching extension.
+
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _iter_decompressed(path):
+    """ Iterate over the decompressed contents of a file in blocks
+
+        Parameters
+        ----------
+        path : str
+            Path to a gzip, BGZF, bzip2, xz or zstd compressed file.
+            Concatenated (multi-member or multi-stream) files are read to the
+            end.
+
+        Yields
+        ------
+        bytes
+            Consecutive blocks of the decompressed data. Blocks are
+            decompressed in a background thread, and BGZF blocks in a pool
+            of threads, so that the caller can process one block while the
+            next ones are inflated.
+
+        Raises
+        ------
+        ImportError
+            If the file is zstd compressed and the zstandard package is not
+            installed.
+
+    """
+    compression = _compression(path)
+    if compression == 'zstd':
+        _import_zstandard()
+    elif compression == 'gzip' and _is_bgzf(path):
+        compression = 'bgzf'
+    return _background(_DECOMPRESSORS[compression](path))
+
+
+def _read_decompressed(path):
+    """ Return the decompressed contents of a file """
+    return b''.join(_iter_decompressed(path))
+
+
+def _iter_decompressed_lines(path, encoding='utf-8'):
+    """ Iterate over the lines of a compressed text file
+
+        The lines of each block are yielded as soon as it has been
+        decompressed, while the next blocks are decompressed in the
+        background, so the caller's processing overlaps decompression.
+
+    """
+    rest = b''
+    for block in _iter_decompressed(path):
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        if end:
+            # lines end at newlines only, as they do when a file is read
+            for line in block[:end - 1].decode(encoding).split('\n'):
+                yield line
+        rest = block[end:]
+    if rest:
+        yield rest.decode(encoding)
+
+
+def _iter_stream(path, decompressor_factory):
+    """ Decompress a file of one or more concatenated compressed streams """
+    with open(path, 'rb') as f:
+        decompressor = None
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                break
+            while data:
+                if decompressor is None:
+                    decompressor = decompressor_factory()
+                block = decompressor.decompress(data)
+                if block:
+                    yield block
+                if not decompressor.eof:
+                    break
+                # the next stream starts after the end of this one
+                data = decompressor.unused_data
+                decompressor = None
+    if decompressor is not None:
+        raise EOFError("Compressed file ended before the end-of-stream "
+                       "marker was reached: %r" % path)
+
+
+def _iter_gzip(path):
+    return _iter_stream(path, lambda: zlib.decompressobj(zlib.MAX_WBITS | 16))
+
+
+def _iter_bz2(path):
+    return _iter_stream(path, bz2.BZ2Decompressor)
+
+
+def _iter_xz(path):
+    return _iter_stream(path, lzma.LZMADecompressor)
+
+
+def _iter_zstd(path):
+    zstandard = _import_zstandard()
+    with open(path, 'rb') as f:
+        for block in zstandard.ZstdDecompressor().read_to_iter(
+                f, read_size=_READ_SIZE, read_across_frames=True):
+            yield block
+
+
+def _is_bgzf(path):
+    """ Return whether a gzip file is BGZF, i.e. a series of gzip members
+        that each record their compressed size
+    """
+    with open(path, 'rb') as f:
+        return _bgzf_block_size(f.read(_READ_SIZE), 0) is not None
+
+
+def _bgzf_block_size(data, offset):
+    """ Return the size of the BGZF block at ``offset``, or None if there is
+        no complete BGZF header there
+    """
+    if (len(data) < offset + 12 or
+            data[offset:offset + 4] != _BGZF_MAGIC):
+        return None
+    extra_length, = struct.unpack_from('<H', data, offset + 10)
+    position = offset + 12
+    end = position + extra_length
+    if len(data) < end:
+        return None
+    while position + 4 <= end:
+        subfield, length = struct.unpack_from('<2sH', data, position)
+        if subfield == b'BC' and length == 2:
+            return struct.unpack_from('<H', data, position + 4)[0] + 1
+        position += 4 + length
+    return None
+
+
+def _iter_bgzf(path):
+    """ Decompress a BGZF file, inflating batches of blocks in parallel
+
+        Each block is an independent gzip member that records its size in its
+        header, so blocks can be located without decompressing them. zlib
+        releases the GIL, so the blocks of a batch are inflated concurrently
+        by a pool of threads.
+
+    """
+    n_workers = os.cpu_count() or 1
+    batch_size = n_workers * _BGZF_BLOCKS_PER_WORKER
+    with open(path, 'rb') as f, ThreadPoolExecutor(n_workers) as executor:
+        data = b''
+        offset = 0
+        batch = []
+        while True:
+            size = _bgzf_block_size(data, offset)
+            if size is None or len(data) < offset + size:
+                more = f.read(_READ_SIZE)
+                if not more:
+                    break
+                data = data[offset:] + more
+                offset = 0
+                continue
+            batch.append(data[offset:offset + size])
+            offset += size
+            if len(batch) == batch_size:
+                yield b''.join(executor.map(_inflate_member, batch))
+                batch = []
+        if offset < len(data):
+            # the rest is not BGZF, so it's read as ordinary gzip members
+            batch.append(data[offset:] + f.read())
+        if batch:
+            yield b''.join(executor.map(_inflate_member, batch))
+
+
+def _inflate_member(member):
+    """ Decompress one or more complete gzip members """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    blocks = [decompressor.decompress(member)]
+    while decompressor.eof and decompressor.unused_data:
+        data = decompressor.unused_data
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        blocks.append(decompressor.decompress(data))
+    return b''.join(blocks)
+
+
+def _iter_uncompressed(path):
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_READ_SIZE)
+            if not block:
+                break
+            yield block
+
+
+_DECOMPRESSORS = {None: _iter_uncompressed,
+                  'gzip': _iter_gzip,
+                  'bgzf': _iter_bgzf,
+                  'bz2': _iter_bz2,
+                  'xz': _iter_xz,
+                  'zstd': _iter_zstd}
+
+_DONE = object()
+
+
+def _background(blocks, max_pending=_MAX_PENDING_BLOCKS):
+    """ Produce the items of an iterator in a background thread
+
+        Parameters
+        ----------
+        blocks : iterator
+            Items to produce. Iteration happens in a separate thread, at
+            most ``max_pending`` items ahead of the consumer.
+
+        Yields
+        ------
+        object
+            The items of ``blocks``, in order. Exceptions raised by
+            ``blocks`` are re-raised in the consumer's thread.
+
+    """
+    pending = queue.Queue(max_pending)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put(block):
+                    return
+        except BaseException as e:
+            put((_DONE, e))
+        else:
+            put((_DONE, None))
+        finally:
+            close = getattr(blocks, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = pending.get()
+            if type(item) is tuple and item[0] is _DONE:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading zstd compressed files requires the "
+                          "zstandard package, which can be installed with "
+                          "`pip install zstandard`.")
+    return zstandard
@@ -0,0 +1,323 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from collections import Counter
+
+POLICIES = ('strict', 'skip', 'unassigned')
+
+# returned by _RecordChecker.target for targets whose hits are skipped
+_SKIP = object()
+# the default of lookups in caches of checked targets
+_UNCHECKED = object()
+
+
+class UcRecordError(ValueError):
+    """ A .uc record that can't be used to compute consensus annotations
+
+        Attributes
+        ----------
+        line_number : int or None
+            The line of the .uc file that the record is on, counted from 1,
+            or None if it is unknown.
+
+    """
+
+    def __init__(self, message, line_number=None):
+        super(UcRecordError, self).__init__(message)
+        self.line_number = line_number
+
+    def __reduce__(self):
+        return self.__class__, (self.args[0], self.line_number)
+
+
+class MissingReferenceError(UcRecordError, KeyError):
+    """ A hit of a target sequence that is not in the taxonomy map
+
+        It is also a ``KeyError``, which was raised for missing target
+        sequences before.
+
+        Attributes
+        ----------
+        reference_id : str
+            The target sequence identifier.
+        query_id : str
+            The query sequence identifier of the hit.
+        line_number : int or None
+            As for ``UcRecordError``.
+
+    """
+
+    def __init__(self, reference_id, query_id, line_number=None):
+        super(MissingReferenceError, self).__init__(
+            "Target sequence %r of query %r%s is not in the taxonomy map."
+            % (reference_id, query_id, _on_line(line_number)), line_number)
+        self.reference_id = reference_id
+        self.query_id = query_id
+
+    # KeyError quotes its message
+    __str__ = UcRecordError.__str__
+
+    def __reduce__(self):
+        return (self.__class__,
+                (self.reference_id, self.query_id, self.line_number))
+
+
+class UcErrors(object):
+    """ How to handle unusable .uc records, and a summary of those found
+
+        Pass an object as ``errors`` to ``uc_consensus_assignments`` or
+        ``iter_uc_consensus_assignments`` to choose what happens to malformed
+        records and to hits of target sequences that are not in the taxonomy
+        map. The counts accumulate across runs.
+
+        Parameters
+        ----------
+        policy : {'strict', 'skip', 'unassigned'}, optional
+            With ``'strict'``, the first unusable record raises a
+            ``UcRecordError``, or a ``MissingReferenceError`` for a missing
+            target sequence, with its line number. With ``'skip'``, unusable
+            records are dropped, as if they weren't in the file, so queries
+            whose records are all dropped aren't assigned. With
+            ``'unassigned'``, hits of missing target sequences count as hits
+            without a taxonomy, like N records, and malformed records are
+            dropped.
+        max_examples : int, optional
+            The number of unusable records to keep the line number and a
+            description of, in ``examples``.
+
+        Attributes
+        ----------
+        malformed_records : int
+            H or N records that couldn't be parsed, such as H records with
+            fewer than 10 fields.
+        missing_reference_records : int
+            H records whose target sequence is not in the taxonomy map.
+        missing_references : set of str
+            The target sequences that are not in the taxonomy map.
+        other_records : collections.Counter
+            Number of records of each type other than H and N, such as S
+            (new seed) and C (cluster) records, which don't describe hits
+            and are ignored under every policy.
+        examples : list of tuples
+            Line number (or None if it is unknown) and description of the
+            first ``max_examples`` unusable records.
+
+        Raises
+        ------
+        ValueError
+            If ``policy`` is not one of the above.
+
+        Notes
+        -----
+        Records are checked as they are parsed, and each distinct target
+        sequence is only looked up once, so valid input isn't slowed down.
+        Line numbers of files processed with ``n_jobs`` greater than 1 are
+        found by counting the lines before the worker's part of the file,
+        which is only done once it finds an unusable record.
+
+    """
+
+    def __init__(self, policy='strict', max_examples=10):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of %s, not %r."
+                             % (', '.join(POLICIES), policy))
+        self.policy = policy
+        self.max_examples = max_examples
+        self.malformed_records = 0
+        self.missing_reference_records = 0
+        self.missing_references = set()
+        self.other_records = Counter()
+        self.examples = []
+
+    def __repr__(self):
+        return ('%s(policy=%r, malformed_records=%d, '
+                'missing_reference_records=%d)'
+                % (self.__class__.__name__, self.policy,
+                   self.malformed_records, self.missing_reference_records))
+
+    @property
+    def skipped_records(self):
+        """ Records that were dropped under the policy """
+        skipped = self.malformed_records
+        if self.policy == 'skip':
+            skipped += self.missing_reference_records
+        return skipped
+
+    def summary(self):
+        """ Return the counts and examples as a dict of built-in types """
+        return {'policy': self.policy,
+                'skipped_records': self.skipped_records,
+                'malformed_records': self.malformed_records,
+                'missing_reference_records': self.missing_reference_records,
+                'missing_references': sorted(self.missing_references),
+                'other_records': dict(self.other_records),
+                'examples': list(self.examples)}
+
+    def _empty(self):
+        """ Return a report with the same policy and no counts, for a
+            worker to fill in and ``_merge`` back
+        """
+        return self.__class__(self.policy, self.max_examples)
+
+    def _example(self, line_number, description):
+        if len(self.examples) < self.max_examples:
+            self.examples.append((line_number, description))
+
+    def _merge(self, other):
+        """ Add the counts and examples of a worker's report """
+        self.malformed_records += other.malformed_records
+        self.missing_reference_records += other.missing_reference_records
+        self.missing_references.update(other.missing_references)
+        self.other_records.update(other.other_records)
+        for example in other.examples:
+            self._example(*example)
+
+
+def _resolve_errors(errors):
+    """ Return a ``UcErrors`` for an ``errors`` parameter, which may also be
+        None (strict) or the name of a policy
+    """
+    if errors is None:
+        return UcErrors()
+    if isinstance(errors, UcErrors):
+        return errors
+    return UcErrors(errors)
+
+
+class _RecordChecker(object):
+    """ Applies the policy of a ``UcErrors`` to the records of one input
+
+        Parameters
+        ----------
+        errors : UcErrors, str or None
+            The policy and the report to count unusable records in.
+        taxonomy_map : dict or TaxonomyTable, optional
+            Mapping to check that target sequences are in. If it is None,
+            target sequences aren't checked.
+        line_base : int or callable, optional
+            The number of lines of the file before the input, or a function
+            that counts them, which is only called if a line number is
+            reported.
+
+        Notes
+        -----
+        Parsers count the lines they have read in ``lines``, and report the
+        line of a record as an offset from the start of the input.
+
+    """
+
+    __slots__ = ('errors', 'taxonomy_map', 'lines', 'targets', '_missing',
+                 '_line_base')
+
+    def __init__(self, errors=None, taxonomy_map=None, line_base=0):
+        self.errors = _resolve_errors(errors)
+        self.taxonomy_map = taxonomy_map
+        self.lines = 0
+        # the targets that have been found in the taxonomy map, so parsers
+        # only need a membership test for the hits of valid targets
+        self.targets = set()
+        # missing target id -> None (unassigned) or _SKIP
+        self._missing = {}
+        self._line_base = line_base
+
+    @property
+    def strict(self):
+        return self.errors.policy == 'strict'
+
+    def line_number(self, line):
+        """ Return the line number in the file of a line of the input,
+            counted from 1
+        """
+        if line is None:
+            return None
+        if callable(self._line_base):
+            self._line_base = self._line_base()
+        return self._line_base + line
+
+    def malformed(self, line, text):
+        """ Handle a malformed record on a line of the input, counted from 1
+
+            Raises
+            ------
+            UcRecordError
+                If the policy is strict.
+
+        """
+        line_number = self.line_number(line)
+        description = "Malformed .uc record%s: %r" % (_on_line(line_number),
+                                                      text)
+        if self.strict:
+            raise UcRecordError(description, line_number)
+        self.errors.malformed_records += 1
+        self.errors._example(line_number, description)
+
+    def other(self, record_type, count=1):
+        """ Count records that don't describe hits, which are ignored """
+        self.errors.other_records[record_type] += count
+
+    def hit(self, target_id, query_id, line):
+        """ Check a hit of a target sequence that is not in ``targets``
+
+            Returns and raises as ``target``, and counts the hit if the
+            target is missing.
+
+        """
+        result = self._missing.get(target_id, _UNCHECKED)
+        if result is _UNCHECKED:
+            return self.target(target_id, query_id, line)
+        self.missing_hits()
+        return result
+
+    def target(self, target_id, query_id, line):
+        """ Check a target sequence the first time it is hit
+
+            Returns
+            -------
+            str, None or _SKIP
+                ``target_id`` if it is in the taxonomy map, and is then added
+                to ``targets``, and otherwise None if its hits count as
+                unassigned or ``_SKIP`` if they are dropped.
+
+            Raises
+            ------
+            MissingReferenceError
+                If ``target_id`` is missing and the policy is strict.
+
+        """
+        if self.taxonomy_map is None or target_id in self.taxonomy_map:
+            self.targets.add(target_id)
+            return target_id
+        return self.missing(target_id, query_id, line)
+
+    def missing(self, target_id, query_id, line, count=1):
+        """ Handle ``count`` hits of a target sequence that is not in the
+            taxonomy map, the first of which is on a line of the input
+
+            Returns and raises as ``target``. Later hits of the target must
+            be counted with ``missing_hits``.
+
+        """
+        line_number = self.line_number(line)
+        if self.strict:
+            raise MissingReferenceError(target_id, query_id, line_number)
+        errors = self.errors
+        errors.missing_references.add(target_id)
+        errors._example(line_number, "Target sequence %r of query %r is not "
+                                     "in the taxonomy map."
+                                     % (target_id, query_id))
+        result = None if errors.policy == 'unassigned' else _SKIP
+        self._missing[target_id] = result
+        self.missing_hits(count)
+        return result
+
+    def missing_hits(self, count=1):
+        self.errors.missing_reference_records += count
+
+
+def _on_line(line_number):
+    return '' if line_number is None else ' on line %d' % line_number
@@ -0,0 +1,275 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+from taxster._taxonomy import TaxonomyTable
+from taxster._uc import _node_annotation, _uc_to_hit_arrays
+from taxster._vectorized import _ancestor_matrix, _batch_consensus
+
+_FORMATS = ('tsv', 'parquet')
+_TSV_HEADER = '#query_id\ttaxonomy\tconfidence\tn_hits\n'
+_TSV_ROW = '%s\t%s\t%s\t%d\n'
+_TSV_ROWS_PER_WRITE = 65536
+
+
+def uc_consensus_dataframe(uc, taxonomy_map, min_consensus_fraction=0.51,
+                           unassignable_label="Unassigned", ranks=None):
+    """ Compute consensus taxonomic annotations for a uc file as a DataFrame
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, such as those generated by uclust, usearch, or vsearch,
+            or the path to one, which may be compressed as for
+            ``uc_consensus_assignments``.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+            A dict is converted to a ``TaxonomyTable`` first.
+        min_consensus_fraction : float, optional
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than 0.50.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        ranks : list of str, optional
+            Names of the taxon columns, from the highest rank. Defaults to
+            ``rank_1``, ``rank_2``, and so on, for as many ranks as the
+            deepest consensus annotation.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per query, in the order queries are first observed, with
+            columns ``query_id``, one categorical column per rank holding the
+            consensus taxon at that rank (missing below the depth of the
+            consensus annotation), ``confidence`` (the consensus fraction)
+            and ``n_hits`` (the number of input annotations). Queries without
+            an acceptable annotation have ``unassignable_label`` as their
+            highest rank and a confidence of 1.0, as in
+            ``uc_consensus_assignments``.
+
+        Raises
+        ------
+        ValueError
+            If min_consensus_fraction <= 0.50.
+        ValueError
+            If fewer rank names are given than the depth of the deepest
+            consensus annotation.
+
+        See Also
+        --------
+        uc_consensus_assignments
+        uc_consensus_arrow
+
+        Notes
+        -----
+        The columns are built directly from the arrays of the vectorized
+        consensus computation: taxa are stored as codes into the distinct
+        labels of the results, so no per-query lists are created.
+
+    """
+    query_ids, table, nodes, fractions, n_hits = _consensus_arrays(
+        uc, taxonomy_map, min_consensus_fraction)
+    codes, categories, names = _rank_codes(nodes, table, unassignable_label,
+                                           ranks)
+    dtype = pd.CategoricalDtype(categories)
+    data = {'query_id': query_ids}
+    for name, column in zip(names, codes.T):
+        data[name] = pd.Categorical.from_codes(column, dtype=dtype)
+    data['confidence'] = fractions
+    data['n_hits'] = n_hits
+    return pd.DataFrame(data)
+
+
+def uc_consensus_arrow(uc, taxonomy_map, min_consensus_fraction=0.51,
+                       unassignable_label="Unassigned", ranks=None):
+    """ Compute consensus taxonomic annotations for a uc file as an Arrow table
+
+        Parameters and columns are as for ``uc_consensus_dataframe``. Taxon
+        columns are dictionary-encoded.
+
+        Returns
+        -------
+        pyarrow.Table
+
+        Raises
+        ------
+        ImportError
+            If pyarrow is not installed.
+
+    """
+    pa = _import_pyarrow()
+    query_ids, table, nodes, fractions, n_hits = _consensus_arrays(
+        uc, taxonomy_map, min_consensus_fraction)
+    codes, categories, rank_names = _rank_codes(nodes, table,
+                                                unassignable_label, ranks)
+    dictionary = pa.array(categories, type=pa.string())
+    names = ['query_id'] + rank_names
+    columns = [pa.array(query_ids, type=pa.string())]
+    for column in codes.T:
+        columns.append(pa.DictionaryArray.from_arrays(
+            pa.array(column, mask=column < 0), dictionary))
+    names.extend(['confidence', 'n_hits'])
+    columns.extend([pa.array(fractions), pa.array(n_hits)])
+    return pa.Table.from_arrays(columns, names=names)
+
+
+def write_uc_consensus_assignments(uc, taxonomy_map, out,
+                                   min_consensus_fraction=0.51,
+                                   unassignable_label="Unassigned",
+                                   format='tsv', ranks=None):
+    """ Compute consensus taxonomic annotations for a uc file and write them
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, or the path to one.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+        out : str or file-like object
+            Path to write to. A text file object can also be given for
+            ``'tsv'``.
+        min_consensus_fraction : float, optional
+            The minimum consensus fraction, as for
+            ``uc_consensus_assignments``.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        format : {'tsv', 'parquet'}, optional
+            ``'tsv'`` writes a header line followed by one line per query
+            with its identifier, ``'; '``-separated consensus annotation,
+            consensus fraction and number of hits, which can be used with
+            ``biom add-metadata``. ``'parquet'`` writes the table returned
+            by ``uc_consensus_arrow`` and requires pyarrow.
+        ranks : list of str, optional
+            Names of the taxon columns for ``'parquet'``, as for
+            ``uc_consensus_dataframe``.
+
+        Raises
+        ------
+        ValueError
+            If ``format`` is not ``'tsv'`` or ``'parquet'``.
+        ImportError
+            If ``format`` is ``'parquet'`` and pyarrow is not installed.
+
+    """
+    if format not in _FORMATS:
+        raise ValueError("format must be one of %s, not %r."
+                         % (', '.join(map(repr, _FORMATS)), format))
+    if format == 'parquet':
+        _import_pyarrow()
+        import pyarrow.parquet as pq
+        pq.write_table(uc_consensus_arrow(uc, taxonomy_map,
+                                          min_consensus_fraction,
+                                          unassignable_label, ranks), out)
+        return
+    query_ids, table, nodes, fractions, n_hits = _consensus_arrays(
+        uc, taxonomy_map, min_consensus_fraction)
+    # each distinct consensus annotation is joined only once
+    distinct, inverse = np.unique(nodes, return_inverse=True)
+    taxonomies = np.array(
+        ['; '.join(_node_annotation(node, table, unassignable_label))
+         for node in distinct.tolist()] or [''], dtype=object)[inverse]
+    if isinstance(out, str):
+        with open(out, 'w') as f:
+            _write_tsv(f, query_ids, taxonomies, fractions, n_hits)
+    else:
+        _write_tsv(out, query_ids, taxonomies, fractions, n_hits)
+
+
+def _write_tsv(f, query_ids, taxonomies, fractions, n_hits):
+    f.write(_TSV_HEADER)
+    for start in range(0, len(query_ids), _TSV_ROWS_PER_WRITE):
+        stop = start + _TSV_ROWS_PER_WRITE
+        f.write(''.join([_TSV_ROW % row for row in zip(
+            query_ids[start:stop], taxonomies[start:stop].tolist(),
+            fractions[start:stop].tolist(), n_hits[start:stop].tolist())]))
+
+
+def _consensus_arrays(uc, taxonomy_map, min_consensus_fraction):
+    """ Compute consensus annotations for a uc file as flat arrays
+
+        Returns
+        -------
+        list of str
+            Query sequence identifiers.
+        TaxonomyTable
+            ``taxonomy_map``, converted to a table if needed.
+        np.ndarray of int
+            Consensus node identifier of each query.
+        np.ndarray of float
+            Consensus fraction of each query.
+        np.ndarray of int
+            Number of hits of each query.
+
+    """
+    if not isinstance(taxonomy_map, TaxonomyTable):
+        taxonomy_map = TaxonomyTable(taxonomy_map)
+    query_ids, query_index, nodes = _uc_to_hit_arrays(uc, taxonomy_map)
+    consensus_nodes, fractions, n_hits = _batch_consensus(
+        query_index, _ancestor_matrix(nodes, taxonomy_map), len(query_ids),
+        min_consensus_fraction)
+    return query_ids, taxonomy_map, consensus_nodes, fractions, n_hits
+
+
+def _rank_codes(nodes, taxonomy_table, unassignable_label, ranks):
+    """ Encode the taxa of consensus nodes at each rank
+
+        Returns
+        -------
+        np.ndarray of int
+            Array of shape ``(len(nodes), n_ranks)`` of codes into the
+            categories, with ``-1`` below the depth of each node. The root
+            node is encoded as ``unassignable_label`` at the highest rank.
+        list of str
+            The distinct taxon labels of the nodes.
+        list of str
+            The name of each rank.
+
+    """
+    ancestors = _ancestor_matrix(nodes, taxonomy_table)
+    unassigned = nodes == TaxonomyTable.root
+    n_ranks = max(ancestors.shape[1], int(unassigned.any()))
+    if ranks is None:
+        ranks = ['rank_%d' % (i + 1) for i in range(n_ranks)]
+    elif len(ranks) < n_ranks:
+        raise ValueError("%d rank names were given, but the deepest "
+                         "consensus annotation has %d ranks."
+                         % (len(ranks), n_ranks))
+    if len(ranks) > ancestors.shape[1]:
+        padding = np.full((len(nodes), len(ranks) - ancestors.shape[1]), -1,
+                          dtype=ancestors.dtype)
+        ancestors = np.hstack([ancestors, padding])
+    labels = np.frombuffer(taxonomy_table.labels, dtype=np.intc)
+    # only the labels that occur in the results become categories
+    codes = np.where(ancestors >= 0, labels[ancestors], -1)
+    used, codes = np.unique(codes, return_inverse=True)
+    codes = codes.reshape(ancestors.shape).astype(np.intc)
+    if len(used) and used[0] == -1:
+        used = used[1:]
+        codes -= 1
+    label_pool = taxonomy_table.label_pool
+    categories = [label_pool[i] for i in used.tolist()]
+    if unassigned.any():
+        if unassignable_label in categories:
+            code = categories.index(unassignable_label)
+        else:
+            code = len(categories)
+            categories.append(unassignable_label)
+        codes[unassigned, 0] = code
+    return codes, categories, list(ranks)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Arrow and Parquet output require pyarrow, which "
+                          "can be installed with `pip install pyarrow`.")
+    return pyarrow
@@ -0,0 +1,268 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import pickle
+
+import numpy as np
+
+from taxster._assignments import ConsensusAssignments
+from taxster._cache import _taxonomy_fingerprint
+from taxster._taxonomy import TaxonomyTable
+from taxster._uc import _compute_consensus_node_counts, _uc_to_hit_arrays
+
+_STATE_VERSION = 2
+_MODES = ('append', 'replace')
+
+
+class IncrementalConsensus(object):
+    """ Consensus annotations that are updated as more hits are added
+
+        The hits of each query are kept as counts per lineage node, together
+        with the query's consensus, so when more .uc records are added, the
+        consensus only needs to be recomputed for the queries whose hits
+        changed. The results are the same as those of
+        ``uc_consensus_assignments`` for all of the records at once.
+
+        Parameters
+        ----------
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+            A dict is converted to a ``TaxonomyTable`` first.
+        min_consensus_fraction : float, optional
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than 0.50.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        path : str, optional
+            File to persist the state to. If it exists, it is loaded, and it
+            is written by ``save``.
+
+        Raises
+        ------
+        ValueError
+            If min_consensus_fraction <= 0.50.
+        ValueError
+            If the state at ``path`` was computed with a different taxonomy
+            map or different parameters.
+
+        Notes
+        -----
+        A persisted state can only be loaded with an identical taxonomy map.
+        Identifying the taxonomy map requires hashing it, unless it was
+        loaded with ``load_taxonomy_map``. The state records lineages rather
+        than node identifiers, since a table loaded with ``lazy=True``
+        numbers its nodes in the order its references are looked up.
+
+    """
+
+    def __init__(self, taxonomy_map, min_consensus_fraction=0.51,
+                 unassignable_label="Unassigned", path=None):
+        if min_consensus_fraction <= 0.5:
+            raise ValueError("min_consensus_fraction must be greater than "
+                             "0.5.")
+        if not isinstance(taxonomy_map, TaxonomyTable):
+            taxonomy_map = TaxonomyTable(taxonomy_map)
+        self.taxonomy_map = taxonomy_map
+        self.min_consensus_fraction = min_consensus_fraction
+        self.unassignable_label = unassignable_label
+        self.path = path
+        # query id -> tuple of (node, count) pairs, sorted by node
+        self._counts = {}
+        # query id -> (consensus node, consensus fraction, number of hits)
+        self._results = {}
+        self._fingerprint = None
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, query_id):
+        return query_id in self._results
+
+    def __repr__(self):
+        return '%s(queries=%d)' % (self.__class__.__name__, len(self))
+
+    def update(self, uc, mode='append'):
+        """ Add the records of a uc file, and recompute the changed queries
+
+            Parameters
+            ----------
+            uc : file-like object or str
+                A .uc file, or the path to one, as for
+                ``uc_consensus_assignments``.
+            mode : {'append', 'replace'}, optional
+                With ``'append'``, the hits in ``uc`` are added to the hits
+                that each query already has, as if ``uc`` had been appended
+                to the earlier files. With ``'replace'``, the queries in
+                ``uc`` keep only its hits, as when a search is rerun with
+                more accepted hits.
+
+            Returns
+            -------
+            ConsensusAssignments
+                The consensus annotations of the queries whose hits changed,
+                as returned by ``uc_consensus_assignments``.
+
+            Raises
+            ------
+            ValueError
+                If ``mode`` is not one of the above.
+
+        """
+        if mode not in _MODES:
+            raise ValueError("mode must be one of %s, not %r."
+                             % (', '.join(_MODES), mode))
+        table = self.taxonomy_map
+        changed = {}
+        for query_id, counts in _query_node_counts(uc, table):
+            previous = self._counts.get(query_id)
+            if mode == 'append' and previous is not None:
+                counts = _merge_counts(previous, counts)
+            if counts == previous:
+                continue
+            self._counts[query_id] = counts
+            node, fraction = _compute_consensus_node_counts(
+                dict(counts), table, self.min_consensus_fraction)
+            self._results[query_id] = changed[query_id] = (
+                node, fraction, sum(count for _, count in counts))
+        return self._assignments(changed)
+
+    def assignments(self):
+        """ Return the consensus annotations of all queries
+
+            Returns
+            -------
+            ConsensusAssignments
+                Keys are query identifiers, and values are tuples of
+                consensus taxonomic annotation (list), consensus fraction
+                (float), and number of input annotations that were provided
+                for the query (int), as returned by
+                ``uc_consensus_assignments``.
+
+        """
+        return self._assignments(self._results)
+
+    def save(self, path=None):
+        """ Write the state to ``path``, or to the path it was created with
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the state to.")
+        lineages = _NodeLineages(self.taxonomy_map)
+        counts = {query_id: tuple((lineages[node], count)
+                                  for node, count in counts)
+                  for query_id, counts in self._counts.items()}
+        results = {query_id: (lineages[node], fraction, n_hits)
+                   for query_id, (node, fraction, n_hits)
+                   in self._results.items()}
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump({'version': _STATE_VERSION,
+                         'fingerprint': self._taxonomy_fingerprint(),
+                         'min_consensus_fraction':
+                             self.min_consensus_fraction,
+                         'counts': counts,
+                         'results': results},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def _assignments(self, results):
+        """ Wrap a dict of query ids to (node, fraction, n_hits) tuples """
+        columns = list(zip(*results.values())) or [(), (), ()]
+        return ConsensusAssignments(list(results), self.taxonomy_map,
+                                    *columns,
+                                    unassignable_label=self.unassignable_label)
+
+    def _taxonomy_fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = _taxonomy_fingerprint(self.taxonomy_map)
+        return self._fingerprint
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != _STATE_VERSION:
+            raise ValueError("%r was written by an incompatible version of "
+                             "taxster." % self.path)
+        if data['fingerprint'] != self._taxonomy_fingerprint():
+            raise ValueError("%r was computed with a different taxonomy map."
+                             % self.path)
+        if data['min_consensus_fraction'] != self.min_consensus_fraction:
+            raise ValueError("%r was computed with a min_consensus_fraction "
+                             "of %r." % (self.path,
+                                         data['min_consensus_fraction']))
+        # the lineages are interned again, as this table may number them
+        # differently than the one the state was saved from
+        nodes = _LineageNodes(self.taxonomy_map)
+        self._counts = {query_id: tuple(sorted((nodes[lineage], count)
+                                               for lineage, count in counts))
+                        for query_id, counts in data['counts'].items()}
+        self._results = {query_id: (nodes[lineage], fraction, n_hits)
+                         for query_id, (lineage, fraction, n_hits)
+                         in data['results'].items()}
+
+
+class _NodeLineages(dict):
+    """ Lineages of the nodes of a taxonomy table, as tuples of labels """
+
+    def __init__(self, taxonomy_table):
+        self.taxonomy_table = taxonomy_table
+
+    def __missing__(self, node):
+        lineage = self[node] = tuple(self.taxonomy_table.lineage(node))
+        return lineage
+
+
+class _LineageNodes(dict):
+    """ Node identifiers of lineages, interned in a taxonomy table """
+
+    def __init__(self, taxonomy_table):
+        self.taxonomy_table = taxonomy_table
+
+    def __missing__(self, lineage):
+        node = self[lineage] = self.taxonomy_table.intern(lineage)
+        return node
+
+
+def _query_node_counts(uc, taxonomy_table):
+    """ Count the hits of each query of a uc file per lineage node
+
+        Yields
+        ------
+        tuple
+            Query sequence identifier, and tuple of ``(node, count)`` pairs
+            of its hits, sorted by node, in the order queries are first
+            observed. N records count as hits of the root node.
+
+    """
+    query_ids, query_index, nodes = _uc_to_hit_arrays(uc, taxonomy_table)
+    if not query_ids:
+        return
+    keys = (query_index.astype(np.int64) * taxonomy_table.n_nodes +
+            nodes.astype(np.int64))
+    keys, counts = np.unique(keys, return_counts=True)
+    queries, nodes = np.divmod(keys, taxonomy_table.n_nodes)
+    # the pairs are sorted by query index, then node
+    bounds = np.flatnonzero(np.diff(queries)) + 1
+    starts = [0] + bounds.tolist()
+    ends = bounds.tolist() + [len(keys)]
+    nodes, counts, queries = nodes.tolist(), counts.tolist(), queries.tolist()
+    for start, end in zip(starts, ends):
+        yield (query_ids[queries[start]],
+               tuple(zip(nodes[start:end], counts[start:end])))
+
+
+def _merge_counts(a, b):
+    """ Add two tuples of ``(node, count)`` pairs sorted by node """
+    counts = dict(a)
+    for node, count in b:
+        counts[node] = counts.get(node, 0) + count
+    return tuple(sorted(counts.items()))
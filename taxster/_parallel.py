@@ -0,0 +1,188 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import multiprocessing
+import os
+
+from taxster._compression import _compression
+
+# the object shared with all worker processes of the current pool
+_shared = None
+
+
+def _resolve_n_jobs(n_jobs):
+    """ Return the number of worker processes to use
+
+        Parameters
+        ----------
+        n_jobs : int
+            The requested number of processes. Negative values count back
+            from the number of CPUs, so ``-1`` uses all of them.
+
+        Raises
+        ------
+        ValueError
+            If n_jobs is 0.
+
+    """
+    if n_jobs == 0:
+        raise ValueError("n_jobs must not be 0.")
+    if n_jobs < 0:
+        n_jobs = max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def _uc_path(uc):
+    """ Return the path of a uc file given as a path or file object
+
+        Raises
+        ------
+        ValueError
+            If ``uc`` is a file object that does not refer to a file on disk,
+            or the file is compressed.
+
+    """
+    path = uc if isinstance(uc, str) else getattr(uc, 'name', None)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        raise ValueError("Parallel processing requires the .uc file to be "
+                         "given as a path or as a file object opened from a "
+                         "path.")
+    if _compression(path) is not None:
+        raise ValueError("Parallel processing requires an uncompressed .uc "
+                         "file, because compressed files can't be split at "
+                         "query boundaries without decompressing them.")
+    return path
+
+
+def _record_query(line):
+    """ Return the query label of a raw .uc line, or None for other lines
+
+        The line is split as the parsers split it, so the label is the
+        encoded query sequence identifier.
+
+    """
+    line = line.decode('utf-8', 'surrogateescape').strip()
+    if line.startswith('#'):
+        return None
+    fields = line.split('\t', 9)
+    if len(fields) < 9 or not fields[8].strip():
+        return None
+    return fields[8].split(None, 1)[0].encode('utf-8', 'surrogateescape')
+
+
+def _uc_shard_offsets(path, n_shards):
+    """ Split a uc file into byte ranges that do not split any query
+
+        Parameters
+        ----------
+        path : str
+            Path to a .uc file whose records are grouped by query.
+        n_shards : int
+            The target number of byte ranges. Fewer are returned for small
+            files.
+
+        Returns
+        -------
+        list of tuples
+            ``(start, end)`` byte offsets, covering the file in order. Each
+            range starts at the beginning of a line and no query has records
+            in more than one range.
+
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            target = max(size * i // n_shards, boundaries[-1])
+            f.seek(target)
+            if target > 0:
+                # move to the start of the next complete line
+                f.readline()
+            # and then past the remaining records of that line's query
+            boundary_query = None
+            while True:
+                position = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                query = _record_query(line)
+                if query is None:
+                    continue
+                if boundary_query is None:
+                    boundary_query = query
+                elif query != boundary_query:
+                    break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    if boundaries[-1] < size or len(boundaries) == 1:
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _call_worker(args):
+    func, task = args
+    return func(_shared, task)
+
+
+def _map_shared(func, tasks, shared, n_jobs):
+    """ Apply a function to tasks in worker processes sharing one object
+
+        Parameters are as for ``_imap_shared``.
+
+        Returns
+        -------
+        list
+            The result of ``func`` for each task, in the order of ``tasks``.
+
+    """
+    return list(_imap_shared(func, tasks, shared, n_jobs))
+
+
+def _imap_shared(func, tasks, shared, n_jobs):
+    """ Lazily apply a function to tasks in worker processes sharing one
+        object
+
+        Parameters
+        ----------
+        func : callable
+            A module-level function taking ``shared`` and one task.
+        tasks : list
+            The tasks to apply ``func`` to.
+        shared : object
+            Object passed to every call of ``func``. Where the ``fork`` start
+            method is available, workers inherit it from this process instead
+            of receiving a pickled copy; otherwise it is pickled once per
+            worker rather than once per task.
+        n_jobs : int
+            The number of worker processes.
+
+        Yields
+        ------
+        object
+            The result of ``func`` for each task, in the order of ``tasks``,
+            as soon as it and the results of all earlier tasks are available.
+
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    pool = context.Pool(n_jobs, initializer=_init_worker, initargs=(shared,))
+    try:
+        for result in pool.imap(_call_worker,
+                                [(func, task) for task in tasks]):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,162 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+from collections import Counter
+
+import pandas as pd
+
+from taxster._parallel import _imap_shared, _resolve_n_jobs
+from taxster._taxonomy import TaxonomyTable
+from taxster._uc import uc_consensus_assignments
+
+
+def uc_consensus_samples(ucs, taxonomy_map, min_consensus_fraction=0.51,
+                         unassignable_label="Unassigned", n_jobs=1,
+                         cache=None):
+    """ Compute consensus taxonomic annotations for many uc files
+
+        Parameters
+        ----------
+        ucs : dict or list
+            The .uc files of the samples, as for ``uc_consensus_assignments``,
+            keyed by sample identifier. A list of paths is keyed by the paths.
+            If ``n_jobs`` is not 1, these must be paths.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations,
+            shared by all samples. A dict is converted to a
+            ``TaxonomyTable`` once. Worker processes inherit it where the
+            ``fork`` start method is available, and otherwise receive one
+            copy each, rather than one per file.
+        min_consensus_fraction : float, optional
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than 0.50.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        n_jobs : int, optional
+            The number of processes to use. Each file is processed in one
+            process, starting with the largest files so that the processes
+            finish at about the same time. Negative values count back from
+            the number of CPUs, so ``-1`` uses all of them.
+        cache : ConsensusCache, optional
+            Cache of consensus annotations to reuse for queries that hit the
+            same target sequences, in the same or later files. If ``n_jobs``
+            is 1 it is updated, and saved after each file if it has a path.
+            Otherwise each worker process uses a copy of it for all of the
+            files it processes, and it is left unchanged.
+
+        Returns
+        -------
+        dict of ConsensusAssignments
+            The consensus annotations of each sample, keyed by sample
+            identifier in the order of ``ucs``, as returned by
+            ``uc_consensus_assignments``.
+        pd.DataFrame
+            The number of queries of each sample (columns) that were assigned
+            each consensus taxonomy (rows, ``'; '``-separated and sorted).
+
+        Raises
+        ------
+        ValueError
+            If min_consensus_fraction <= 0.50.
+        ValueError
+            If ``ucs`` is a list with duplicate paths, or ``n_jobs`` is not 1
+            and a .uc file is not given as a path.
+
+        See Also
+        --------
+        uc_consensus_assignments
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    if not isinstance(ucs, dict):
+        ucs = list(ucs)
+        if len(set(ucs)) != len(ucs):
+            raise ValueError("Samples given as a list of paths must not "
+                             "contain duplicate paths.")
+        ucs = dict(zip(ucs, ucs))
+    n_jobs = min(_resolve_n_jobs(n_jobs), max(len(ucs), 1))
+    if not isinstance(taxonomy_map, TaxonomyTable):
+        # intern the lineages once for all samples
+        taxonomy_map = TaxonomyTable(taxonomy_map)
+    if n_jobs == 1:
+        results = {
+            sample_id: uc_consensus_assignments(
+                uc, taxonomy_map, min_consensus_fraction, unassignable_label,
+                cache=cache)
+            for sample_id, uc in ucs.items()}
+    else:
+        results = _parallel_sample_assignments(
+            ucs, taxonomy_map, min_consensus_fraction, unassignable_label,
+            n_jobs, cache)
+    return results, _taxonomy_counts(results)
+
+
+def _parallel_sample_assignments(ucs, taxonomy_map, min_consensus_fraction,
+                                 unassignable_label, n_jobs, cache):
+    """ Compute the consensus annotations of each sample in worker processes
+
+        Parameters are as for ``uc_consensus_samples``, except that ``ucs``
+        must be a dict of paths.
+
+    """
+    for uc in ucs.values():
+        if not isinstance(uc, str):
+            raise ValueError("Parallel processing requires the .uc files to "
+                             "be given as paths.")
+    # the largest files are started first, so that the smaller ones fill in
+    # around them
+    sample_ids = sorted(ucs, key=lambda s: os.path.getsize(ucs[s]),
+                        reverse=True)
+    tasks = [(ucs[s], min_consensus_fraction, unassignable_label)
+             for s in sample_ids]
+    results = dict(zip(sample_ids, _imap_shared(
+        _sample_assignments, tasks, (taxonomy_map, cache), n_jobs)))
+    return {sample_id: results[sample_id] for sample_id in ucs}
+
+
+def _sample_assignments(shared, task):
+    """ Compute the consensus annotations of one sample in a worker """
+    taxonomy_map, cache = shared
+    path, min_consensus_fraction, unassignable_label = task
+    if cache is not None:
+        # this process's copy of the cache lives for all of its tasks, and
+        # only the caller's copy is saved
+        cache.path = None
+    # the results are sent back without the shared taxonomy map
+    return uc_consensus_assignments(path, taxonomy_map,
+                                    min_consensus_fraction,
+                                    unassignable_label, cache=cache)._detach()
+
+
+def _taxonomy_counts(results):
+    """ Count the queries of each sample assigned to each taxonomy
+
+        Parameters
+        ----------
+        results : dict of ConsensusAssignments
+            The consensus annotations of each sample, as returned by
+            ``uc_consensus_samples``.
+
+        Returns
+        -------
+        pd.DataFrame
+            Taxonomy by sample counts, as returned by
+            ``uc_consensus_samples``.
+
+    """
+    counts = {sample_id: Counter('; '.join(taxonomy) for taxonomy, _, _
+                                 in assignments.values())
+              for sample_id, assignments in results.items()}
+    taxonomies = sorted(set().union(*counts.values()))
+    return pd.DataFrame(
+        [[counts[s][t] for s in results] for t in taxonomies],
+        index=pd.Index(taxonomies, name='taxonomy'),
+        columns=list(results), dtype=int)
@@ -0,0 +1,202 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from __future__ import division
+
+import sys
+import time
+from collections import Counter
+
+# the stages that time is charged to, in pipeline order
+STAGES = ('parse', 'lookup', 'consensus')
+
+
+class ConsensusStats(object):
+    """ Timings and counts of the stages of consensus computations
+
+        Pass the same object as ``stats`` to ``uc_consensus_assignments`` or
+        ``iter_uc_consensus_assignments`` to collect statistics of one or
+        more runs. The counts and times accumulate across runs.
+
+        Parameters
+        ----------
+        on_stage : callable, optional
+            Called as ``on_stage(stage, wall_seconds, cpu_seconds)`` for each
+            stage at the end of each run, with the time spent in that stage
+            during the run.
+        on_query : callable, optional
+            Called as ``on_query(query_id, n_hits)`` as each query's consensus
+            is computed.
+
+        Attributes
+        ----------
+        wall_time : dict
+            Wall-clock seconds spent in each of the ``'parse'`` (reading and
+            splitting .uc records), ``'lookup'`` (resolving target sequence
+            identifiers in the taxonomy map) and ``'consensus'`` stages.
+        cpu_time : dict
+            CPU seconds spent in each stage.
+        elapsed : float
+            Wall-clock seconds from the start to the end of each run.
+        bytes_parsed : int
+            Bytes of .uc data read, after decompression.
+        records_parsed : int
+            H and N records read.
+        queries : int
+            Queries whose consensus was computed.
+        hit_histogram : collections.Counter
+            Number of queries with each number of hits.
+        peak_memory : int or None
+            Peak resident set size of this process and its finished worker
+            processes in bytes, or None if it can't be determined.
+
+        Notes
+        -----
+        Time is charged to one stage at a time, so the stage times don't
+        overlap, and time spent by the caller between the assignments yielded
+        by ``iter_uc_consensus_assignments`` isn't charged to any stage. With
+        ``n_jobs`` greater than 1, the stage times and parsing counts are
+        summed over the worker processes, so the stage times can exceed
+        ``elapsed``.
+
+        Statistics are only collected when an object is passed, so runs
+        without one are not slowed down.
+
+    """
+
+    def __init__(self, on_stage=None, on_query=None):
+        self.on_stage = on_stage
+        self.on_query = on_query
+        self.wall_time = dict.fromkeys(STAGES, 0.0)
+        self.cpu_time = dict.fromkeys(STAGES, 0.0)
+        self.elapsed = 0.0
+        self.bytes_parsed = 0
+        self.records_parsed = 0
+        self.queries = 0
+        self.hit_histogram = Counter()
+        self.peak_memory = None
+        self._stage = None
+        self._wall = self._cpu = self._start_wall = 0.0
+        self._run_wall = self._run_cpu = None
+
+    def __repr__(self):
+        return ('%s(queries=%d, records_parsed=%d, bytes_parsed=%d, '
+                'elapsed=%.3f)'
+                % (self.__class__.__name__, self.queries,
+                   self.records_parsed, self.bytes_parsed, self.elapsed))
+
+    def __getstate__(self):
+        # callbacks often can't be pickled, and worker processes report to
+        # the caller's object rather than calling them
+        state = self.__dict__.copy()
+        state['on_stage'] = state['on_query'] = None
+        return state
+
+    @property
+    def queries_per_second(self):
+        """ Queries processed per second of elapsed time """
+        return self.queries / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        """ Return the statistics as a dict of built-in types """
+        return {'wall_time': dict(self.wall_time),
+                'cpu_time': dict(self.cpu_time),
+                'elapsed': self.elapsed,
+                'bytes_parsed': self.bytes_parsed,
+                'records_parsed': self.records_parsed,
+                'queries': self.queries,
+                'queries_per_second': self.queries_per_second,
+                'hit_histogram': dict(self.hit_histogram),
+                'peak_memory': self.peak_memory}
+
+    def _start(self, stage=None):
+        """ Start a run, charging time to ``stage`` """
+        self._run_wall = dict.fromkeys(STAGES, 0.0)
+        self._run_cpu = dict.fromkeys(STAGES, 0.0)
+        self._wall = self._start_wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._stage = stage
+
+    def _switch(self, stage):
+        """ Charge the time since the last switch to the current stage, and
+            charge later time to ``stage``, or to no stage if it is None
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if self._stage is not None:
+            self._run_wall[self._stage] += wall - self._wall
+            self._run_cpu[self._stage] += cpu - self._cpu
+        self._stage = stage
+        self._wall = wall
+        self._cpu = cpu
+
+    def _timed(self, stage, iterable):
+        """ Charge the time spent producing each item of an iterable to
+            ``stage``, and later time to no stage
+        """
+        iterator = iter(iterable)
+        while True:
+            self._switch(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._switch(None)
+                return
+            self._switch(None)
+            yield item
+
+    def _chunk(self, n_bytes, n_records):
+        self.bytes_parsed += n_bytes
+        self.records_parsed += n_records
+
+    def _query(self, query_id, n_hits):
+        self.queries += 1
+        self.hit_histogram[n_hits] += 1
+        if self.on_query is not None:
+            self.on_query(query_id, n_hits)
+
+    def _merge(self, other):
+        """ Add the stage times and parsing counts of a worker process's
+            statistics. Its queries are counted by the caller, so that
+            ``on_query`` is called in this process.
+        """
+        for stage in STAGES:
+            self._run_wall[stage] += other.wall_time[stage]
+            self._run_cpu[stage] += other.cpu_time[stage]
+        self.bytes_parsed += other.bytes_parsed
+        self.records_parsed += other.records_parsed
+
+    def _finish(self):
+        """ End a run, and report its stage times to ``on_stage`` """
+        if self._run_wall is None:
+            return
+        self._switch(None)
+        self.elapsed += self._wall - self._start_wall
+        self.peak_memory = _peak_rss_bytes()
+        run_wall, run_cpu = self._run_wall, self._run_cpu
+        self._run_wall = self._run_cpu = None
+        for stage in STAGES:
+            self.wall_time[stage] += run_wall[stage]
+            self.cpu_time[stage] += run_cpu[stage]
+        if self.on_stage is not None:
+            for stage in STAGES:
+                self.on_stage(stage, run_wall[stage], run_cpu[stage])
+
+
+def _peak_rss_bytes():
+    """ Return the peak resident set size of this process and its finished
+        children, or None if it is unknown
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # in bytes on macOS and in KiB elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,831 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+import warnings
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+import numpy as np
+
+from taxster._compression import _compression, _iter_decompressed_lines
+
+
+class TaxonomyTable(Mapping):
+    """ Compact mapping of reference identifiers to taxonomic annotations
+
+        Each distinct lineage is stored once, as a path in a prefix tree of
+        integer node identifiers, and each rank label is stored once in a
+        string pool. Reference identifiers map to the node at the end of
+        their lineage. Node ``0`` is the root of the tree and represents the
+        empty lineage.
+
+        A ``TaxonomyTable`` can be used anywhere a ``taxonomy_map`` dict is
+        accepted: indexing it with a reference identifier returns that
+        reference's taxonomic annotation as a list of str.
+
+        Parameters
+        ----------
+        taxonomy_map : dict, optional
+            Mapping of target sequence identifiers to taxonomic annotations
+            to add to the table.
+
+    """
+
+    root = 0
+    # SHA-1 hash of the file the table was loaded from, while unmodified
+    _source_sha1 = None
+
+    def __init__(self, taxonomy_map=None):
+        self._parents = array('i', [-1])
+        self._labels = array('i', [-1])
+        self._depths = array('H', [0])
+        self._label_pool = []
+        self._label_ids = {}
+        self._children = {}
+        self._references = {}
+        if taxonomy_map is not None:
+            for reference_id, lineage in taxonomy_map.items():
+                self.add(reference_id, lineage)
+
+    @classmethod
+    def _from_arrays(cls, parents, labels, depths, label_pool, references):
+        """ Create a table from its column arrays and string pools
+
+            The arrays are wrapped in read-only memory views rather than
+            copied, so a table loaded from a memory-mapped cache stays
+            mapped. They are copied into ``array``s, and the lookup indices
+            used by ``intern`` are rebuilt, when the table is first modified,
+            so read-only tables never pay for them. ``references`` may also
+            be a ``_CachedReferences``, which is copied into a dict then.
+
+        """
+        table = cls.__new__(cls)
+        table._parents = _array_view(parents, np.intc, 'i')
+        table._labels = _array_view(labels, np.intc, 'i')
+        table._depths = _array_view(depths, np.uint16, 'H')
+        table._label_pool = label_pool
+        table._label_ids = None
+        table._children = None
+        table._references = references
+        return table
+
+    def __getstate__(self):
+        # memory views can't be pickled, so mapped arrays are copied
+        state = self.__dict__.copy()
+        state.update(self._arrays())
+        return state
+
+    def __getitem__(self, reference_id):
+        return self.lineage(self._references[reference_id])
+
+    def __iter__(self):
+        return iter(self._references)
+
+    def __len__(self):
+        return len(self._references)
+
+    def __contains__(self, reference_id):
+        return reference_id in self._references
+
+    @property
+    def n_nodes(self):
+        """ Number of nodes in the prefix tree, including the root """
+        return len(self._parents)
+
+    @property
+    def parents(self):
+        """ Parent node identifier of each node (``-1`` for the root) """
+        return self._parents
+
+    @property
+    def labels(self):
+        """ Index into ``label_pool`` of each node's label (``-1`` for the
+            root)
+        """
+        return self._labels
+
+    @property
+    def label_pool(self):
+        """ The distinct taxon labels, in the order they were added """
+        return self._label_pool
+
+    @property
+    def depths(self):
+        """ Number of ranks in the lineage of each node """
+        return self._depths
+
+    def add(self, reference_id, lineage):
+        """ Add a reference and its taxonomic annotation to the table
+
+            Parameters
+            ----------
+            reference_id : str
+                Target sequence identifier.
+            lineage : list of str
+                Taxonomic annotation of ``reference_id``, from the highest to
+                the lowest rank.
+
+            Returns
+            -------
+            int
+                The node identifier of ``lineage``.
+
+        """
+        node = self.intern(lineage)
+        if not isinstance(self._references, dict):
+            self._references = self._references._to_dict()
+        self._references[reference_id] = node
+        self._source_sha1 = None
+        return node
+
+    def intern(self, lineage):
+        """ Return the node identifier of a lineage, adding it if needed
+
+            Parameters
+            ----------
+            lineage : list of str
+                Taxonomic annotation, from the highest to the lowest rank.
+
+            Returns
+            -------
+            int
+                The node identifier of ``lineage``.
+
+        """
+        if self._children is None:
+            self._build_indices()
+        node = self.root
+        children = self._children
+        for label in lineage:
+            label_id = self._label_ids.get(label)
+            if label_id is None:
+                label_id = self._label_ids[label] = len(self._label_pool)
+                self._label_pool.append(label)
+            key = (node, label_id)
+            child = children.get(key)
+            if child is None:
+                child = children[key] = len(self._parents)
+                self._parents.append(node)
+                self._labels.append(label_id)
+                self._depths.append(self._depths[node] + 1)
+            node = child
+        return node
+
+    def _arrays(self):
+        """ Return the node arrays by attribute name, as ``array``s """
+        return {name: (values if isinstance(values, array) else
+                       array(code, values.tobytes()))
+                for name, code, values in [('_parents', 'i', self._parents),
+                                           ('_labels', 'i', self._labels),
+                                           ('_depths', 'H', self._depths)]}
+
+    def _build_indices(self):
+        # arrays that are still mapped from a cache are copied to be extended
+        self.__dict__.update(self._arrays())
+        self._label_ids = {label: i for i, label in
+                           enumerate(self._label_pool)}
+        self._children = {(parent, label): node for node, (parent, label)
+                          in enumerate(zip(self._parents, self._labels))
+                          if node != self.root}
+
+    def node(self, reference_id):
+        """ Return the node identifier of a reference's lineage
+
+            Raises
+            ------
+            KeyError
+                If ``reference_id`` is not in the table.
+
+        """
+        return self._references[reference_id]
+
+    def nodes(self, reference_ids):
+        """ Return the node identifiers of several references' lineages
+
+            Raises
+            ------
+            KeyError
+                If any of ``reference_ids`` is not in the table.
+
+        """
+        references = self._references
+        return [references[r] for r in reference_ids]
+
+    def depth(self, node):
+        """ Return the number of ranks in the lineage of ``node`` """
+        return self._depths[node]
+
+    def path(self, node):
+        """ Return the node identifiers from the highest rank to ``node``
+
+            Parameters
+            ----------
+            node : int
+                A node identifier.
+
+            Returns
+            -------
+            list of int
+                Element ``i`` is the ancestor of ``node`` at rank ``i``. The
+                root is not included, so the path of the root is empty.
+
+        """
+        parents = self._parents
+        result = []
+        while node != self.root:
+            result.append(node)
+            node = parents[node]
+        result.reverse()
+        return result
+
+    def lineage(self, node):
+        """ Return the taxonomic annotation of ``node`` as a list of str """
+        label_pool = self._label_pool
+        labels = self._labels
+        return [label_pool[labels[n]] for n in self.path(node)]
+
+
+class _IndexedTaxonomyTable(TaxonomyTable):
+    """ TaxonomyTable that reads references from a taxonomy map on demand
+
+        References are located in the file through an index of the hashes of
+        their identifiers, and are parsed and added to the table the first
+        time they are looked up, so the table only holds the lineages of the
+        references that have been used. Iterating over the table and its
+        length only cover those references. References are resolved under a
+        lock, so the table can be shared by threads. The file is mapped into
+        memory when a reference is first resolved, and stays mapped while
+        the table exists, so single lookups, as made by iterators, caches
+        and error checks, don't reopen it.
+
+        Parameters
+        ----------
+        path : str
+            Path to the uncompressed taxonomy map.
+        hashes : np.ndarray of uint64
+            Sorted hashes of the reference identifiers in ``path``, as
+            computed by ``_hash_fields``.
+        offsets : np.ndarray of int
+            Byte offset in ``path`` of the line of each hash.
+        source_sha1 : str
+            SHA-1 hash of ``path``.
+
+    """
+
+    def __init__(self, path, hashes, offsets, source_sha1):
+        TaxonomyTable.__init__(self)
+        self._path = path
+        self._hashes = hashes
+        self._offsets = offsets
+        self._lineage_nodes = {}
+        self._source_sha1 = source_sha1
+        self._lock = threading.Lock()
+        self._buffer = None
+
+    def __getstate__(self):
+        state = TaxonomyTable.__getstate__(self)
+        del state['_lock']
+        state['_buffer'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, reference_id):
+        return self.lineage(self.node(reference_id))
+
+    def __contains__(self, reference_id):
+        try:
+            self.node(reference_id)
+        except KeyError:
+            return False
+        return True
+
+    def node(self, reference_id):
+        node = self._references.get(reference_id)
+        if node is None:
+            self._resolve([reference_id])
+            node = self._references[reference_id]
+        return node
+
+    def nodes(self, reference_ids):
+        references = self._references
+        missing = [r for r in reference_ids if r not in references]
+        if missing:
+            self._resolve(missing)
+        return [references[r] for r in reference_ids]
+
+    def _resolve(self, reference_ids):
+        """ Read the lineages of references from the taxonomy map
+
+            Identifiers that are not in the file are skipped. Where an
+            identifier occurs on several lines, the last one is used, as for
+            ``load_taxonomy_map``.
+
+        """
+        if not len(self._hashes):
+            return
+        with self._lock:
+            self._resolve_unlocked(reference_ids)
+
+    def _resolve_unlocked(self, reference_ids):
+        references = self._references
+        # another thread may have resolved some of them in the meantime
+        reference_ids = list(set(reference_ids).difference(references))
+        if not reference_ids:
+            return
+        encoded = [r.encode('utf-8') for r in reference_ids]
+        if len(encoded) < _VECTORIZED_HASH_MIN:
+            # single lookups, as from iterators and caches, aren't worth
+            # the overhead of vectorizing
+            hashes = np.array([_hash_bytes(e) for e in encoded],
+                              dtype=np.uint64)
+        else:
+            lengths = np.array([len(e) for e in encoded], dtype=np.intp)
+            starts = np.cumsum(lengths) - lengths
+            hashes = _hash_fields(np.frombuffer(b''.join(encoded),
+                                                dtype=np.uint8),
+                                  starts, lengths)
+        first = np.searchsorted(self._hashes, hashes, 'left').tolist()
+        last = np.searchsorted(self._hashes, hashes, 'right').tolist()
+        lineage_nodes = self._lineage_nodes
+        buffer = self._buffer
+        if buffer is None:
+            with open(self._path, 'rb') as f:
+                buffer = self._buffer = mmap.mmap(f.fileno(), 0,
+                                                  access=mmap.ACCESS_READ)
+        for reference_id, i, j in zip(reference_ids, first, last):
+            for offset in self._offsets[i:j].tolist():
+                end = buffer.find(b'\n', offset)
+                line = buffer[offset:end if end >= 0 else len(buffer)]
+                fields = line.decode('utf-8').strip().split('\t', 2)
+                if fields[0] != reference_id:
+                    continue
+                if len(fields) < 2:
+                    raise ValueError(
+                        "Line at byte %d of the taxonomy map does not "
+                        "contain a taxonomic annotation: %r"
+                        % (offset, fields[0]))
+                taxonomy = fields[1]
+                node = lineage_nodes.get(taxonomy)
+                if node is None:
+                    node = lineage_nodes[taxonomy] = \
+                        self.intern(taxonomy.split('; '))
+                references[reference_id] = node
+
+
+class _CachedReferences(Mapping):
+    """ Read-only mapping of reference identifiers to node identifiers,
+        loaded from a taxonomy cache
+
+        The identifiers are kept sorted and are looked up by bisection, and
+        their nodes stay in a memory-mapped array, so loading a cache
+        doesn't build a dict of all its references. The nodes of the
+        references that have been found are kept in a dict, so that hits of
+        the same target are only looked up once. A table copies its
+        references into a dict when it is first modified.
+
+        Parameters
+        ----------
+        ids : list of str
+            The sorted reference identifiers.
+        nodes : np.ndarray of int
+            Node identifier of each reference of ``ids``.
+        order : np.ndarray of int
+            Index in ``ids`` of each reference, in the order of the table.
+
+    """
+
+    def __init__(self, ids, nodes, order):
+        self._ids = ids
+        # memory-mapped arrays are viewed as plain arrays, which are cheaper
+        # to index one element at a time
+        self._nodes = np.asarray(nodes)
+        self._order = np.asarray(order)
+        self._found = {}
+
+    def __getstate__(self):
+        # memory-mapped arrays are copied
+        return dict(self.__dict__, _nodes=np.array(self._nodes),
+                    _order=np.array(self._order))
+
+    def __getitem__(self, reference_id):
+        node = self._found.get(reference_id)
+        if node is None:
+            ids = self._ids
+            try:
+                i = bisect_left(ids, reference_id)
+            except TypeError:
+                raise KeyError(reference_id)
+            if i == len(ids) or ids[i] != reference_id:
+                raise KeyError(reference_id)
+            node = self._found[reference_id] = int(self._nodes[i])
+        return node
+
+    def __iter__(self):
+        return map(self._ids.__getitem__, self._order.tolist())
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, reference_id):
+        try:
+            self[reference_id]
+        except KeyError:
+            return False
+        return True
+
+    def _to_dict(self):
+        return dict(zip(self, self._nodes[self._order].tolist()))
+
+
+_CACHE_VERSION = 2
+_CACHE_SUFFIX = '.taxster-cache'
+_INDEX_VERSION = 1
+_INDEX_SUFFIX = '.taxster-index'
+_TAB, _NEWLINE, _CARRIAGE_RETURN, _SPACE, _HASH = 9, 10, 13, 32, ord('#')
+_FNV_OFFSET = np.uint64(14695981039346656037)
+_FNV_PRIME = np.uint64(1099511628211)
+_UINT64_MASK = (1 << 64) - 1
+# lookups of fewer references are hashed one by one
+_VECTORIZED_HASH_MIN = 16
+
+
+def load_taxonomy_map(path, cache=True, lazy=False):
+    """ Load a tab-separated taxonomy map into a TaxonomyTable
+
+        Parameters
+        ----------
+        path : str
+            Path to a tab-separated file where the first column is a target
+            sequence identifier and the second column is its taxonomic
+            annotation, with ranks separated by ``'; '``. Additional columns,
+            blank lines and lines starting with ``#`` are ignored. The file
+            may be gzip (including BGZF), bzip2, xz or zstd compressed; zstd
+            requires the zstandard package. The path of a cache directory
+            written by an earlier call can also be given, in which case the
+            cached table is loaded without checking it against the file it
+            was created from.
+        cache : bool or str, optional
+            Whether to store the parsed table in a binary cache next to
+            ``path``, and to load it from there on later calls if ``path``
+            is unchanged. A str gives the directory to use for the cache
+            instead of ``path`` plus ``'.taxster-cache'``. If ``lazy`` is
+            True, this applies to the index instead, whose default directory
+            is ``path`` plus ``'.taxster-index'``.
+        lazy : bool, optional
+            Index the identifiers in ``path`` instead of parsing it, and only
+            read the annotations of target sequences when they are first
+            looked up. Loading the index and the memory used by the table
+            then depend on the number of distinct targets that are hit rather
+            than on the size of ``path``, which must be uncompressed.
+            Iterating over the table and its length only cover the targets
+            looked up so far, and malformed lines are only reported when
+            they are read.
+
+        Returns
+        -------
+        TaxonomyTable
+            The taxonomic annotations of all target sequences in ``path``.
+
+        Raises
+        ------
+        ValueError
+            If a line of ``path`` does not have at least two columns, or
+            ``path`` is a directory that does not contain a complete cache,
+            or ``lazy`` is True and ``path`` is compressed.
+
+        Notes
+        -----
+        The cache is a directory of ``.npy`` arrays, which are loaded with
+        memory mapping and stay mapped unless the table is modified, and
+        newline-separated string pools, in which reference identifiers are
+        sorted and looked up by bisection, so loading it doesn't build a
+        dict of all references. It is reused when the size and modification
+        time of ``path`` match the ones it was created from, without reading
+        ``path``, or else when its size and SHA-1 hash do, and it is rebuilt
+        otherwise.
+
+        The index used when ``lazy`` is True holds the sorted 64-bit hashes
+        of the identifiers and the byte offsets of their lines, and is also
+        loaded with memory mapping. So that ``path`` doesn't need to be read
+        to load it, it is only checked against the size and modification
+        time of ``path``.
+
+    """
+    if lazy and not os.path.isdir(path):
+        return _load_indexed_taxonomy_map(path, cache)
+    if os.path.isdir(path):
+        table = _read_taxonomy_cache(path)
+        if table is None:
+            raise ValueError("%r is not a complete taxonomy cache." % path)
+        return table
+    if cache is True:
+        cache = path + _CACHE_SUFFIX
+    stat = os.stat(path)
+    source = {'version': _CACHE_VERSION, 'size': stat.st_size,
+              'mtime': stat.st_mtime}
+    if cache:
+        # path is only read and hashed if its size or modification time
+        # changed
+        table = _read_taxonomy_cache(cache, source)
+        if table is not None:
+            return table
+    with open(path, 'rb') as f:
+        data = f.read()
+    source['sha1'] = hashlib.sha1(data).hexdigest()
+    if cache:
+        # a file that was only touched still matches the cache by content
+        table = _read_taxonomy_cache(cache, {k: v for k, v in source.items()
+                                             if k != 'mtime'})
+        if table is not None:
+            try:
+                _write_cache_meta(cache, source)
+            except (IOError, OSError):
+                pass
+            return table
+    if _compression(path) is not None:
+        # lines are parsed while the next blocks are being decompressed
+        del data
+        lines = _iter_decompressed_lines(path)
+    else:
+        lines = io.StringIO(data.decode('utf-8'))
+    table = _parse_taxonomy_map(lines)
+    if cache:
+        try:
+            _write_taxonomy_cache(cache, source, table)
+        except (IOError, OSError) as e:
+            warnings.warn("Could not write taxonomy cache %r: %s"
+                          % (cache, e), RuntimeWarning)
+    table._source_sha1 = source['sha1']
+    return table
+
+
+def _load_indexed_taxonomy_map(path, cache):
+    """ Load a taxonomy map through its index, building it if needed """
+    if _compression(path) is not None:
+        raise ValueError("Lazy loading requires an uncompressed taxonomy map, "
+                         "because lines of compressed files can't be read "
+                         "from their offsets.")
+    if cache is True:
+        cache = path + _INDEX_SUFFIX
+    stat = os.stat(path)
+    source = {'version': _INDEX_VERSION, 'size': stat.st_size,
+              'mtime': stat.st_mtime}
+    if cache:
+        index = _read_taxonomy_index(cache, source)
+        if index is not None:
+            return _IndexedTaxonomyTable(path, *index)
+    with open(path, 'rb') as f:
+        data = f.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    hashes, offsets = _index_taxonomy_map(data)
+    del data
+    if cache:
+        try:
+            _write_taxonomy_index(cache, dict(source, sha1=sha1), hashes,
+                                  offsets)
+        except (IOError, OSError) as e:
+            warnings.warn("Could not write taxonomy index %r: %s"
+                          % (cache, e), RuntimeWarning)
+    return _IndexedTaxonomyTable(path, hashes, offsets, sha1)
+
+
+def _index_taxonomy_map(data):
+    """ Index the reference identifiers of a taxonomy map
+
+        Parameters
+        ----------
+        data : bytes
+            The contents of an uncompressed taxonomy map.
+
+        Returns
+        -------
+        np.ndarray of uint64
+            Sorted hashes of the reference identifiers.
+        np.ndarray of int64
+            Byte offset of the line of each hash, in increasing order where
+            hashes are equal.
+
+        Raises
+        ------
+        ValueError
+            If a line that isn't blank or a comment does not have at least
+            two columns.
+
+    """
+    if not data:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buffer == _NEWLINE)
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.append(newlines, len(buffer))
+    tabs = np.append(np.flatnonzero(buffer == _TAB), len(buffer))
+    id_ends = tabs[np.searchsorted(tabs, starts)]
+    first = buffer[np.minimum(starts, len(buffer) - 1)]
+    regular = ((id_ends < ends) & (id_ends > starts) & (first != _HASH) &
+               (first != _SPACE) & (first != _CARRIAGE_RETURN))
+    # lines without an identifier at the start are blank, comments or
+    # malformed, or need to be stripped, so they are checked one by one
+    extra_starts = []
+    extra_ids = []
+    irregular = np.flatnonzero(~regular & (starts < ends) & (first != _HASH))
+    for line_number in irregular.tolist():
+        line = data[starts[line_number]:ends[line_number]].strip()
+        if line.startswith(b'#') or not line:
+            continue
+        fields = line.split(b'\t', 2)
+        if len(fields) < 2:
+            raise ValueError("Line %d of the taxonomy map does not contain a "
+                             "taxonomic annotation: %r"
+                             % (line_number + 1, line.decode('utf-8')))
+        extra_starts.append(starts[line_number])
+        extra_ids.append(fields[0])
+    starts, id_ends = starts[regular], id_ends[regular]
+    hashes = _hash_fields(buffer, starts, id_ends - starts)
+    if extra_ids:
+        lengths = np.array([len(i) for i in extra_ids], dtype=np.intp)
+        hashes = np.append(hashes, _hash_fields(
+            np.frombuffer(b''.join(extra_ids), dtype=np.uint8),
+            np.cumsum(lengths) - lengths, lengths))
+        starts = np.append(starts, extra_starts)
+    order = np.lexsort((starts, hashes))
+    return hashes[order], starts[order].astype(np.int64)
+
+
+def _hash_fields(buffer, starts, lengths):
+    """ Return the 64-bit FNV-1a hashes of byte ranges of a buffer
+
+        The ranges are hashed one byte position at a time for all of them at
+        once, so no copy of their bytes is made.
+
+    """
+    hashes = np.full(len(starts), _FNV_OFFSET, dtype=np.uint64)
+    last = len(buffer) - 1
+    with np.errstate(over='ignore'):
+        for i in range(int(lengths.max()) if len(lengths) else 0):
+            active = lengths > i
+            column = buffer[np.minimum(starts + i, last)]
+            hashes = np.where(active, (hashes ^ column) * _FNV_PRIME, hashes)
+    return hashes
+
+
+def _hash_bytes(data):
+    """ Return the 64-bit FNV-1a hash of bytes, as ``_hash_fields`` """
+    h = int(_FNV_OFFSET)
+    prime = int(_FNV_PRIME)
+    for byte in bytearray(data):
+        h = ((h ^ byte) * prime) & _UINT64_MASK
+    return h
+
+
+def _write_taxonomy_index(index_dir, source, hashes, offsets):
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    meta_path = os.path.join(index_dir, 'meta.json')
+    # the metadata is written last, so its presence marks a complete index
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    np.save(os.path.join(index_dir, 'hashes.npy'), hashes)
+    np.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+    with open(meta_path, 'w') as f:
+        json.dump(source, f)
+
+
+def _read_taxonomy_index(index_dir, source):
+    """ Return the hashes, offsets and source SHA-1 hash of a cached index,
+        or None if it is missing or stale
+    """
+    try:
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if any(meta.get(k) != v for k, v in source.items()):
+            return None
+        hashes, offsets = [np.load(os.path.join(index_dir, name + '.npy'),
+                                   mmap_mode='r')
+                           for name in ('hashes', 'offsets')]
+    except (IOError, OSError, ValueError):
+        return None
+    if len(hashes) != len(offsets):
+        return None
+    return hashes, offsets, meta['sha1']
+
+
+def _array_view(values, dtype, code):
+    """ Return a read-only memory view of an array without copying it """
+    return memoryview(np.ascontiguousarray(values, dtype)).cast('B').cast(
+        code)
+
+
+def _parse_taxonomy_map(lines):
+    """ Parse the lines of a taxonomy map into a TaxonomyTable """
+    table = TaxonomyTable()
+    references = table._references
+    intern = table.intern
+    # many references share a lineage, so each distinct lineage string only
+    # needs to be split and walked into the tree once
+    lineage_nodes = {}
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line.startswith('#') or not line:
+            continue
+        fields = line.split('\t', 2)
+        if len(fields) < 2:
+            raise ValueError("Line %d of the taxonomy map does not contain a "
+                             "taxonomic annotation: %r" % (line_number, line))
+        taxonomy = fields[1]
+        node = lineage_nodes.get(taxonomy)
+        if node is None:
+            node = lineage_nodes[taxonomy] = intern(taxonomy.split('; '))
+        references[fields[0]] = node
+    return table
+
+
+def _write_taxonomy_cache(cache_dir, source, table):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    # the metadata is written last, so its presence marks a complete cache
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    # references are stored sorted by identifier, so that they can be
+    # looked up by bisection
+    ids = list(table._references)
+    ranked = sorted(range(len(ids)), key=ids.__getitem__)
+    sorted_ids = [ids[i] for i in ranked]
+    nodes = np.fromiter(table._references.values(), dtype=np.intc,
+                        count=len(ids))
+    order = np.empty(len(ids), dtype=np.int64)
+    order[ranked] = np.arange(len(ids))
+    # the arrays are replaced rather than overwritten, since tables loaded
+    # from an earlier version of the cache may still map them
+    for name, values in [
+            ('parents', np.frombuffer(table._parents, dtype=np.intc)),
+            ('labels', np.frombuffer(table._labels, dtype=np.intc)),
+            ('depths', np.frombuffer(table._depths, dtype=np.uint16)),
+            ('reference_nodes', nodes[ranked]),
+            ('reference_order', order)]:
+        path = os.path.join(cache_dir, name + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, values)
+        os.replace(path + '.tmp', path)
+    for name, strings in [('labels.txt', table._label_pool),
+                          ('references.txt', sorted_ids)]:
+        with open(os.path.join(cache_dir, name), 'wb') as f:
+            f.write(''.join(s + '\n' for s in strings).encode('utf-8'))
+    _write_cache_meta(cache_dir, source)
+
+
+def _write_cache_meta(cache_dir, source):
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(source, f)
+
+
+def _read_taxonomy_cache(cache_dir, source=None):
+    """ Return the cached TaxonomyTable, or None if it is missing or stale
+
+        The cache is stale if its metadata differs from ``source``, or if
+        ``source`` is None, if it was written by another cache version.
+
+    """
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if source is None:
+            source = {'version': _CACHE_VERSION}
+        if any(meta.get(k) != v for k, v in source.items()):
+            return None
+        arrays = [np.load(os.path.join(cache_dir, name + '.npy'),
+                          mmap_mode='r')
+                  for name in ('parents', 'labels', 'depths',
+                               'reference_nodes', 'reference_order')]
+        pools = []
+        for name in ('labels.txt', 'references.txt'):
+            with open(os.path.join(cache_dir, name), 'rb') as f:
+                data = f.read().decode('utf-8')
+            pools.append(data.split('\n')[:-1])
+    except (IOError, OSError, ValueError):
+        return None
+    parents, labels, depths, reference_nodes, reference_order = arrays
+    label_pool, reference_ids = pools
+    if not (len(reference_ids) == len(reference_nodes) ==
+            len(reference_order)):
+        return None
+    table = TaxonomyTable._from_arrays(
+        parents, labels, depths, label_pool,
+        _CachedReferences(reference_ids, reference_nodes, reference_order))
+    table._source_sha1 = meta['sha1']
+    return table
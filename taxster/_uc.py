@@ -8,37 +8,107 @@
 
 from __future__ import division
 
+import heapq
+from array import array
 from collections import Counter, defaultdict
+from operator import itemgetter
+
+import numpy as np
+
+from taxster._assignments import ConsensusAssignments, ConsensusLineages
+from taxster._errors import _SKIP, _RecordChecker, _resolve_errors
+from taxster._parallel import (_imap_shared, _resolve_n_jobs, _uc_path,
+                               _uc_shard_offsets)
+from taxster._stats import ConsensusStats
+from taxster._taxonomy import TaxonomyTable
+from taxster._ucio import (_UcRange, _is_uc_file, _iter_uc_hits_mmap,
+                           _record_checker, _uc_hit_arrays_mmap)
+from taxster._vectorized import (_ancestor_matrix, _batch_consensus,
+                                 _batch_majority, _top_hits)
 
 
 def uc_consensus_assignments(uc, taxonomy_map, min_consensus_fraction=0.51,
-                             unassignable_label="Unassigned"):
+                             unassignable_label="Unassigned", n_jobs=1,
+                             cache=None, stats=None, max_hits=None,
+                             weighted=False, errors=None):
     """ Compute consensus taxonomic annotations for a uc file
 
         Parameters
         ----------
-        uc : file-like object
-            A .uc file, such as those generated by uclust, usearch, or vsearch
-        taxonomy_map : dict
-            Mapping of target sequence identifiers to taxonomic annotations
+        uc : file-like object or str
+            A .uc file, such as those generated by uclust, usearch, or vsearch,
+            or the path to one. Paths are read with memory mapping, which is
+            faster than reading lines from a file object. Paths of gzip
+            (including BGZF), bzip2, xz or zstd compressed files are
+            decompressed while they are read; zstd requires the zstandard
+            package. If ``n_jobs`` is not 1, this must be the path of an
+            uncompressed file or a file object opened from one.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+            Consensus is computed on integer lineage nodes if this is a
+            ``TaxonomyTable``, which is faster and uses less memory.
         min_consensus_fraction : float, optional
             The minimum fraction of the annotations that a specfic annotation
             must be present in for that annotation to be accepted. This must
             be greater than 0.50.
         unassignable_label : str, optional
             The label to apply if no acceptable annotations are identified.
+        n_jobs : int, optional
+            The number of processes to use. If greater than 1, the file is
+            split into byte ranges at query boundaries, and each range is
+            parsed and its consensus computed in a separate process. This
+            requires that all records for a query are adjacent in the file.
+            Negative values count back from the number of CPUs, so ``-1``
+            uses all of them.
+        cache : ConsensusCache, optional
+            Cache of consensus annotations to reuse for queries that hit the
+            same target sequences. If the cache has a path, it is saved there
+            once the file has been processed. This requires ``n_jobs`` to be
+            1.
+        stats : ConsensusStats, optional
+            Statistics to add the stage timings and counts of this run to.
+        max_hits : int, optional
+            The maximum number of hits of each query to compute its consensus
+            from. The hits with the highest percent identity (field 4) are
+            kept, and of hits with equal identities, the first in the file.
+            They are selected while the file is parsed, so no more than this
+            many hits of a query are held in memory.
+        weighted : bool, optional
+            If True, each hit votes with its percent identity rather than
+            with one vote, and the consensus fraction is the fraction of the
+            total identity of the hits. N records carry no weight. This
+            can't be combined with a cache.
+        errors : UcErrors or str, optional
+            What to do with malformed records and hits of target sequences
+            that are not in ``taxonomy_map``, and where to count them. A
+            policy name (``'strict'``, ``'skip'`` or ``'unassigned'``) can be
+            given instead, and by default the first one raises an exception.
 
         Returns
         -------
-        dict of tuples
-            Keys are query identifiers, and values are tuples of consensus
-            taxonomic annotation (list), consensus fraction (float), and number
-            of input annotations that were provided for the query (int).
+        ConsensusAssignments
+            Mapping whose keys are query identifiers, and values are tuples
+            of consensus taxonomic annotation (list), consensus fraction
+            (float), and number of input annotations that were provided for
+            the query (int). With ``max_hits``, the latter is the number of
+            hits that were kept. It is backed by arrays, and compares equal
+            to a dict with the same items.
 
         Raises
         ------
         ValueError
             If min_consensus_fraction <= 0.50.
+        ValueError
+            If ``n_jobs`` is not 1 and ``uc`` is not a file on disk, or its
+            records are not grouped by query, or a cache is given.
+        ValueError
+            If ``max_hits`` is less than 1, or ``weighted`` is True and a
+            cache is given.
+        UcRecordError
+            If a record is malformed, and the error policy is strict.
+        MissingReferenceError
+            If a target sequence is not in ``taxonomy_map``, and the error
+            policy is strict. This is also a ``KeyError``.
 
         Notes
         -----
@@ -57,26 +127,689 @@ def uc_consensus_assignments(uc, taxonomy_map, min_consensus_fraction=0.51,
         [4] https://peerj.com/preprints/934/
 
     """
-    annotations = _uc_to_taxonomy(uc, taxonomy_map)
+    n_jobs = _resolve_n_jobs(n_jobs)
+    if stats is None:
+        return _consensus_assignments(uc, taxonomy_map, min_consensus_fraction,
+                                      unassignable_label, n_jobs, cache,
+                                      max_hits=max_hits, weighted=weighted,
+                                      errors=errors)
+    stats._start('parse')
+    try:
+        return _consensus_assignments(uc, taxonomy_map, min_consensus_fraction,
+                                      unassignable_label, n_jobs, cache, stats,
+                                      max_hits, weighted, errors)
+    finally:
+        stats._finish()
+
+
+def _consensus_assignments(uc, taxonomy_map, min_consensus_fraction,
+                           unassignable_label, n_jobs, cache, stats=None,
+                           max_hits=None, weighted=False, errors=None):
+    """ Compute consensus taxonomic annotations for a uc file
+
+        Parameters are as for ``uc_consensus_assignments``, except that
+        ``n_jobs`` must have been resolved to a positive number, and time is
+        charged to the stages of ``stats`` without starting or finishing a
+        run.
+
+    """
+    _check_hit_selection(max_hits, weighted, cache)
+    errors = _resolve_errors(errors)
+    if n_jobs > 1:
+        if cache is not None:
+            raise ValueError("A consensus cache can't be shared with worker "
+                             "processes. Use n_jobs=1 with a cache.")
+        return _parallel_consensus_assignments(
+            _uc_path(uc), taxonomy_map, min_consensus_fraction,
+            unassignable_label, n_jobs, stats, max_hits, weighted, errors)
+    checker = _record_checker(uc, errors, taxonomy_map)
+    if cache is not None:
+        if max_hits is None:
+            query_hits = _uc_to_query_hits(uc, stats, checker).items()
+        else:
+            query_hits = [(query_id, subject_ids) for query_id, subject_ids, _
+                          in _uc_to_query_scored_hits(uc, max_hits, stats,
+                                                      checker)]
+        return ConsensusAssignments._from_tuples(
+            _cached_consensus_assignments(
+                query_hits, taxonomy_map, min_consensus_fraction,
+                unassignable_label, cache, stats), unassignable_label)
+    if isinstance(taxonomy_map, TaxonomyTable):
+        weights = None
+        if max_hits is not None or weighted:
+            query_ids, query_index, nodes, weights = (
+                _uc_to_selected_hit_arrays(uc, taxonomy_map, max_hits,
+                                           weighted, stats, checker))
+        else:
+            query_ids, query_index, nodes = _uc_to_hit_arrays(
+                uc, taxonomy_map, stats, checker)
+        if stats is not None:
+            stats._switch('consensus')
+        return _batch_consensus_annotations(query_ids, query_index, nodes,
+                                            taxonomy_map,
+                                            min_consensus_fraction,
+                                            unassignable_label, stats,
+                                            weights)
+    if max_hits is not None or weighted:
+        return ConsensusAssignments._from_tuples(
+            _scored_consensus_assignments(
+                _uc_to_query_scored_hits(uc, max_hits, stats, checker),
+                taxonomy_map,
+                min_consensus_fraction, unassignable_label, weighted, stats),
+            unassignable_label)
+    if stats is None:
+        annotations = _uc_to_taxonomy(uc, taxonomy_map, checker)
+    else:
+        # hits are grouped before they are looked up, so that parsing and
+        # lookups are timed separately
+        query_hits = _uc_to_query_hits(uc, stats, checker)
+        stats._switch('lookup')
+        annotations = {
+            query_id: [taxonomy_map[s] if s is not None else []
+                       for s in subject_ids]
+            for query_id, subject_ids in query_hits.items()}
+        stats._switch('consensus')
     return _compute_consensus_annotations(annotations, min_consensus_fraction,
-                                          unassignable_label)
+                                          unassignable_label, stats)
 
 
-def _uc_to_taxonomy(uc, taxonomy_map):
-    """ Process a uc file and associated taxonomy annotations
+def _parallel_consensus_assignments(path, taxonomy_map,
+                                    min_consensus_fraction,
+                                    unassignable_label, n_jobs, stats=None,
+                                    max_hits=None, weighted=False,
+                                    errors=None):
+    """ Compute consensus annotations for a uc file in worker processes
+
+        Parameters are as for ``uc_consensus_assignments``, except that
+        ``path`` must be the path to the .uc file.
+
+    """
+    return ConsensusAssignments._concatenate(
+        _iter_parallel_consensus_shards(
+            path, taxonomy_map, min_consensus_fraction, unassignable_label,
+            n_jobs, stats, max_hits, weighted, errors), unassignable_label)
+
+
+def _iter_parallel_consensus_shards(path, taxonomy_map,
+                                    min_consensus_fraction,
+                                    unassignable_label, n_jobs, stats=None,
+                                    max_hits=None, weighted=False,
+                                    errors=None):
+    """ Compute consensus annotations for a uc file shard by shard
+
+        Parameters are as for ``_parallel_consensus_assignments``. The stage
+        times and counts of the workers are added to ``stats``, their
+        unusable records are counted in ``errors``, and the time this
+        process spends waiting for them is not charged to any stage.
+
+        Yields
+        ------
+        ConsensusAssignments
+            The consensus annotations of each byte range of the file, in
+            file order, as returned by ``uc_consensus_assignments``.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    _check_hit_selection(max_hits, weighted)
+    errors = _resolve_errors(errors)
+    # use more shards than processes so that uneven shards balance out
+    tasks = [(path, start, end, min_consensus_fraction, unassignable_label,
+              max_hits, weighted, stats is not None, errors._empty())
+             for start, end in _uc_shard_offsets(path, n_jobs * 4)]
+    if stats is not None:
+        stats._switch(None)
+    completed = set()
+    for shard_result, shard_stats, shard_errors in _imap_shared(
+            _consensus_shard, tasks, taxonomy_map, n_jobs):
+        errors._merge(shard_errors)
+        if stats is not None:
+            stats._merge(shard_stats)
+            for query_id, n_hits in zip(shard_result.query_ids,
+                                        shard_result.n_hits.tolist()):
+                stats._query(query_id, n_hits)
+        for query_id in shard_result:
+            if query_id in completed:
+                raise ValueError(
+                    "Records for query %r are not adjacent in the .uc file. "
+                    "Use n_jobs=1 for input that is not grouped by query."
+                    % query_id)
+        completed.update(shard_result)
+        yield shard_result
+
+
+def _consensus_shard(taxonomy_map, task):
+    """ Compute consensus annotations for one byte range of a uc file
+
+        Returns the consensus annotations, as returned by
+        ``uc_consensus_assignments`` but referring to a table of only their
+        lineages, the statistics of computing them if the task requests them
+        (or None), and the ``UcErrors`` of the range.
+
+    """
+    (path, start, end, min_consensus_fraction, unassignable_label, max_hits,
+     weighted, instrumented, errors) = task
+    stats = ConsensusStats() if instrumented else None
+    result = uc_consensus_assignments(_UcRange(path, start, end),
+                                      taxonomy_map, min_consensus_fraction,
+                                      unassignable_label, stats=stats,
+                                      max_hits=max_hits, weighted=weighted,
+                                      errors=errors)._detach()
+    return result, stats, errors
+
+
+def iter_uc_consensus_assignments(uc, taxonomy_map,
+                                  min_consensus_fraction=0.51,
+                                  unassignable_label="Unassigned",
+                                  cache=None, stats=None, max_hits=None,
+                                  weighted=False, errors=None):
+    """ Iteratively compute consensus taxonomic annotations for a uc file
 
         Parameters
         ----------
-        uc : file-like object
-            A .uc file, such as those generated by uclust, usearch, or vsearch
-        taxonomy_map : dict
+        uc : file-like object or str
+            A .uc file, such as those generated by uclust, usearch, or vsearch,
+            or the path to one, which may be compressed as for
+            ``uc_consensus_assignments``. All records for a given query must
+            be adjacent in the file (this is how vsearch and usearch write .uc
+            files).
+        taxonomy_map : dict or TaxonomyTable
             Mapping of target sequence identifiers to taxonomic annotations
+        min_consensus_fraction : float, optional
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than 0.50.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        cache : ConsensusCache, optional
+            Cache of consensus annotations to reuse for queries that hit the
+            same target sequences. If the cache has a path, it is saved there
+            once the last query has been yielded.
+        stats : ConsensusStats, optional
+            Statistics to add the stage timings and counts of this run to.
+            The run ends when the last query has been yielded or the
+            generator is closed.
+        max_hits : int, optional
+            The maximum number of hits of each query to compute its consensus
+            from, as for ``uc_consensus_assignments``.
+        weighted : bool, optional
+            Whether each hit votes with its percent identity, as for
+            ``uc_consensus_assignments``.
+        errors : UcErrors or str, optional
+            What to do with unusable records, as for
+            ``uc_consensus_assignments``.
+
+        Yields
+        ------
+        tuple
+            Query identifier (str), consensus taxonomic annotation (list),
+            consensus fraction (float), and number of input annotations that
+            were provided for the query (int). A tuple is yielded as soon as
+            the last record for its query has been read.
+
+        Raises
+        ------
+        ValueError
+            If min_consensus_fraction <= 0.50.
+        ValueError
+            If the records for a query are found not to be adjacent in
+            ``uc`` (see Notes). Use ``uc_consensus_assignments`` for such
+            files.
+        ValueError
+            If ``max_hits`` is less than 1, or ``weighted`` is True and a
+            cache is given.
+        UcRecordError
+            If a record is unusable, and the error policy is strict, as for
+            ``uc_consensus_assignments``. The assignments of the queries
+            before it have already been yielded.
+
+        See Also
+        --------
+        uc_consensus_assignments
+
+        Notes
+        -----
+        Unlike ``uc_consensus_assignments``, only the annotations of the
+        current query are held in memory, so memory use is bounded by the
+        query with the most hits rather than by the size of the file, or by
+        ``max_hits``. To detect ungrouped input without retaining the
+        identifiers of all completed queries, a fixed-size table of 8 MiB
+        holds hashes of them, in which later queries replace earlier ones.
+        Records of a query that recur after many other queries may therefore
+        go undetected, and are then yielded as a separate query; grouped
+        input is never rejected.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    _check_hit_selection(max_hits, weighted, cache)
+    for assignment in _iter_consensus_assignments(
+            uc, taxonomy_map, min_consensus_fraction, unassignable_label,
+            cache, stats, max_hits, weighted,
+            _record_checker(uc, errors, taxonomy_map)):
+        yield assignment
+
+
+def _iter_consensus_assignments(uc, taxonomy_map, min_consensus_fraction,
+                                unassignable_label, cache, stats, max_hits,
+                                weighted, checker):
+    """ Iteratively compute consensus taxonomic annotations for a uc file
+
+        Parameters and yielded tuples are as for
+        ``iter_uc_consensus_assignments``, once they have been checked,
+        except that ``checker`` is the ``_RecordChecker`` to apply to the
+        records.
+
+    """
+    if stats is not None:
+        for assignment in _instrumented_consensus_assignments(
+                uc, taxonomy_map, min_consensus_fraction, unassignable_label,
+                cache, stats, max_hits, weighted, checker):
+            yield assignment
+        return
+    if cache is not None:
+        if max_hits is None:
+            query_hits = _iter_uc_query_hits(uc, checker=checker)
+        else:
+            query_hits = ((query_id, subject_ids) for query_id, subject_ids, _
+                          in _iter_uc_query_hits(uc, checker=checker,
+                                                 scored=True,
+                                                 max_hits=max_hits))
+        for assignment in _cached_consensus_assignments(
+                query_hits, taxonomy_map, min_consensus_fraction,
+                unassignable_label, cache):
+            yield assignment
+        return
+    if max_hits is not None or weighted:
+        for assignment in _scored_consensus_assignments(
+                _iter_uc_query_hits(uc, checker=checker, scored=True,
+                                    max_hits=max_hits),
+                taxonomy_map, min_consensus_fraction, unassignable_label,
+                weighted):
+            yield assignment
+        return
+    if isinstance(taxonomy_map, TaxonomyTable):
+        for query_id, subject_ids in _iter_uc_query_hits(uc,
+                                                         checker=checker):
+            annotation, consensus_fraction = _compute_hit_consensus(
+                subject_ids, taxonomy_map, min_consensus_fraction,
+                unassignable_label)
+            yield query_id, annotation, consensus_fraction, len(subject_ids)
+        return
+    for query_id, annotations in _iter_uc_query_taxonomy(uc, taxonomy_map,
+                                                         checker):
+        consensus_annotation, consensus_fraction = \
+            _compute_consensus_annotation(annotations, min_consensus_fraction,
+                                          unassignable_label)
+        yield (query_id, consensus_annotation, consensus_fraction,
+               len(annotations))
+
+
+def uc_consensus_lineages(uc, taxonomy_map, max_hits=None, weighted=False,
+                          errors=None):
+    """ Compute the majority lineage and per-rank fractions for a uc file
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, or the path to one, as for
+            ``uc_consensus_assignments``.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+            A dict is converted to a ``TaxonomyTable`` first.
+        max_hits : int, optional
+            The maximum number of hits of each query to compute its majority
+            lineage from, as for ``uc_consensus_assignments``.
+        weighted : bool, optional
+            Whether each hit votes with its percent identity, as for
+            ``uc_consensus_assignments``.
+        errors : UcErrors or str, optional
+            What to do with unusable records, as for
+            ``uc_consensus_assignments``.
+
+        Returns
+        -------
+        ConsensusLineages
+            Mapping whose keys are query identifiers, and values are tuples
+            of the lineage that more than half of the query's hits agree with
+            (list), the fraction of the hits that agree with it at each rank
+            (list of float), and the number of hits (int).
+
+        Raises
+        ------
+        ValueError
+            If ``max_hits`` is less than 1.
+
+        See Also
+        --------
+        uc_consensus_assignments
+        uc_consensus_thresholds
+
+        Notes
+        -----
+        The consensus annotation of a query at a ``min_consensus_fraction``
+        is the prefix of its majority lineage whose fractions are at least
+        ``min_consensus_fraction``, and its consensus fraction is the last of
+        these. ``ConsensusLineages.assignments`` derives the result of
+        ``uc_consensus_assignments`` at any threshold from this, without
+        reading ``uc`` again.
+
+    """
+    _check_hit_selection(max_hits, weighted)
+    if not isinstance(taxonomy_map, TaxonomyTable):
+        taxonomy_map = TaxonomyTable(taxonomy_map)
+    checker = _record_checker(uc, errors, taxonomy_map)
+    weights = None
+    if max_hits is not None or weighted:
+        query_ids, query_index, nodes, weights = _uc_to_selected_hit_arrays(
+            uc, taxonomy_map, max_hits, weighted, checker=checker)
+    else:
+        query_ids, query_index, nodes = _uc_to_hit_arrays(uc, taxonomy_map,
+                                                          checker=checker)
+    rank_nodes, rank_fractions, n_hits = _batch_majority(
+        query_index, _ancestor_matrix(nodes, taxonomy_map), len(query_ids),
+        weights)
+    # the majority lineages are usually much shallower than the deepest hit
+    depths = (rank_nodes >= 0).sum(axis=1)
+    max_depth = int(depths.max()) if len(depths) else 0
+    majority_nodes = np.zeros(len(query_ids), dtype=np.intc)
+    rows = np.flatnonzero(depths)
+    majority_nodes[rows] = rank_nodes[rows, depths[rows] - 1]
+    return ConsensusLineages(query_ids, taxonomy_map, majority_nodes,
+                             rank_fractions[:, :max_depth], n_hits)
+
+
+def uc_consensus_thresholds(uc, taxonomy_map, min_consensus_fractions,
+                            unassignable_label="Unassigned", max_hits=None,
+                            weighted=False, errors=None):
+    """ Compute consensus taxonomic annotations at several thresholds at once
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, or the path to one, as for
+            ``uc_consensus_assignments``.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+        min_consensus_fractions : iterable of float
+            The values of ``min_consensus_fraction`` to compute the consensus
+            annotations at. Each must be greater than 0.50.
+        unassignable_label : str, optional
+            The label to apply if no acceptable annotations are identified.
+        max_hits : int, optional
+            The maximum number of hits of each query to compute its consensus
+            from, as for ``uc_consensus_assignments``.
+        weighted : bool, optional
+            Whether each hit votes with its percent identity, as for
+            ``uc_consensus_assignments``.
+        errors : UcErrors or str, optional
+            What to do with unusable records, as for
+            ``uc_consensus_assignments``.
 
         Returns
         -------
         dict
-            Mapping of query sequence identifiers to taxonomic annotations
-            of corresponding hits.
+            Keys are the values of ``min_consensus_fractions``, and values
+            are the ``ConsensusAssignments`` that ``uc_consensus_assignments``
+            returns with that ``min_consensus_fraction``.
+
+        Raises
+        ------
+        ValueError
+            If any of min_consensus_fractions <= 0.50.
+        ValueError
+            If ``max_hits`` is less than 1.
+
+        See Also
+        --------
+        uc_consensus_lineages
+
+        Notes
+        -----
+        ``uc`` is parsed and the hits of each query are counted once, with
+        ``uc_consensus_lineages``, and the assignments at each threshold are
+        cut from the resulting lineages.
+
+    """
+    min_consensus_fractions = list(min_consensus_fractions)
+    if any(fraction <= 0.5 for fraction in min_consensus_fractions):
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    lineages = uc_consensus_lineages(uc, taxonomy_map, max_hits, weighted,
+                                     errors)
+    return {fraction: lineages.assignments(fraction, unassignable_label)
+            for fraction in min_consensus_fractions}
+
+
+def _instrumented_consensus_assignments(uc, taxonomy_map,
+                                        min_consensus_fraction,
+                                        unassignable_label, cache, stats,
+                                        max_hits=None, weighted=False,
+                                        checker=None):
+    """ Iteratively compute consensus annotations, timing each stage
+
+        Parameters and yielded tuples are as for
+        ``iter_uc_consensus_assignments``, where ``stats`` is required, and
+        ``checker`` is the ``_RecordChecker`` to apply to the records.
+
+    """
+    stats._start()
+    try:
+        if max_hits is None and not weighted:
+            query_hits = stats._timed('parse', _iter_uc_query_hits(
+                uc, stats, checker))
+        else:
+            query_hits = stats._timed(
+                'parse', _iter_uc_query_hits(uc, stats, checker, True,
+                                             max_hits))
+            if cache is None:
+                for assignment in _scored_consensus_assignments(
+                        query_hits, taxonomy_map, min_consensus_fraction,
+                        unassignable_label, weighted, stats):
+                    stats._switch(None)
+                    yield assignment
+                return
+            query_hits = ((query_id, subject_ids)
+                          for query_id, subject_ids, _ in query_hits)
+        if cache is not None:
+            for assignment in _cached_consensus_assignments(
+                    query_hits, taxonomy_map, min_consensus_fraction,
+                    unassignable_label, cache, stats):
+                stats._switch(None)
+                yield assignment
+            return
+        for query_id, subject_ids in query_hits:
+            annotation, consensus_fraction = _compute_hit_consensus(
+                subject_ids, taxonomy_map, min_consensus_fraction,
+                unassignable_label, stats)
+            stats._query(query_id, len(subject_ids))
+            stats._switch(None)
+            yield query_id, annotation, consensus_fraction, len(subject_ids)
+    finally:
+        stats._finish()
+
+
+def _cached_consensus_assignments(query_hits, taxonomy_map,
+                                  min_consensus_fraction, unassignable_label,
+                                  cache, stats=None):
+    """ Compute consensus annotations of queries' hits through a cache
+
+        Parameters
+        ----------
+        query_hits : iterable of tuples
+            Query sequence identifier and list of the target sequence
+            identifiers of its hits, as yielded by ``_iter_uc_query_hits``.
+        taxonomy_map : dict or TaxonomyTable
+            Mapping of target sequence identifiers to taxonomic annotations.
+        min_consensus_fraction : float
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted.
+        unassignable_label : str
+            The label to apply if no acceptable annotations are identified.
+        cache : ConsensusCache
+            The cache to look up and store consensus annotations in. It is
+            saved once ``query_hits`` is exhausted if it has a path.
+        stats : ConsensusStats, optional
+            Statistics to count the queries in, and to charge cache lookups
+            to the consensus stage of.
+
+        Yields
+        ------
+        tuple
+            Query identifier, consensus taxonomic annotation, consensus
+            fraction, and number of input annotations, as yielded by
+            ``iter_uc_consensus_assignments``.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    cache.bind(taxonomy_map)
+    for query_id, subject_ids in query_hits:
+        if stats is not None:
+            stats._switch('consensus')
+        annotation, consensus_fraction = cache.consensus(
+            subject_ids, min_consensus_fraction, unassignable_label,
+            lambda: _compute_hit_consensus(subject_ids, taxonomy_map,
+                                           min_consensus_fraction,
+                                           unassignable_label, stats))
+        if stats is not None:
+            stats._query(query_id, len(subject_ids))
+        yield query_id, annotation, consensus_fraction, len(subject_ids)
+    if cache.path is not None:
+        cache.save()
+
+
+def _scored_consensus_assignments(query_hits, taxonomy_map,
+                                  min_consensus_fraction, unassignable_label,
+                                  weighted, stats=None):
+    """ Compute consensus annotations of queries' selected hits
+
+        Parameters
+        ----------
+        query_hits : iterable of tuples
+            Query sequence identifier, list of the target sequence
+            identifiers of its hits and list of their percent identities, as
+            yielded by ``_iter_uc_query_hits`` if ``scored``.
+        weighted : bool
+            Whether each hit votes with its percent identity.
+        stats : ConsensusStats, optional
+            Statistics to count the queries in, and to charge the lookups and
+            the consensus computation to the stages of.
+
+        Other parameters and the yielded tuples are as for
+        ``_cached_consensus_assignments``.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    for query_id, subject_ids, identities in query_hits:
+        annotation, consensus_fraction = _compute_hit_consensus(
+            subject_ids, taxonomy_map, min_consensus_fraction,
+            unassignable_label, stats, identities if weighted else None)
+        if stats is not None:
+            stats._query(query_id, len(subject_ids))
+        yield query_id, annotation, consensus_fraction, len(subject_ids)
+
+
+def _check_hit_selection(max_hits, weighted, cache=None):
+    """ Check the hit selection and weighting parameters """
+    if max_hits is not None and max_hits < 1:
+        raise ValueError("max_hits must be at least 1.")
+    if weighted and cache is not None:
+        raise ValueError("Identity-weighted consensus annotations can't be "
+                         "cached. Use weighted=False with a cache.")
+
+
+def _compute_hit_consensus(subject_ids, taxonomy_map, min_consensus_fraction,
+                           unassignable_label, stats=None, weights=None):
+    """ Compute the consensus annotation of a query's hits
+
+        Parameters
+        ----------
+        subject_ids : list
+            Target sequence identifiers of the query's hits, with ``None``
+            for N records.
+        stats : ConsensusStats, optional
+            Statistics to charge the lookups and the consensus computation
+            to the stages of.
+        weights : list of float, optional
+            The vote of each hit. By default each hit has one vote.
+
+        Other parameters and the result are as for
+        ``_compute_consensus_annotation``.
+
+    """
+    if stats is not None:
+        stats._switch('lookup')
+    if isinstance(taxonomy_map, TaxonomyTable):
+        nodes = [taxonomy_map.node(s) if s is not None else
+                 TaxonomyTable.root for s in subject_ids]
+        if stats is not None:
+            stats._switch('consensus')
+        if weights is None:
+            node, consensus_fraction = _compute_consensus_node(
+                nodes, taxonomy_map, min_consensus_fraction)
+        else:
+            node, consensus_fraction = _compute_consensus_node_counts(
+                _weight_sums(nodes, weights), taxonomy_map,
+                min_consensus_fraction)
+        return (_node_annotation(node, taxonomy_map, unassignable_label),
+                consensus_fraction)
+    annotations = [taxonomy_map[s] if s is not None else []
+                   for s in subject_ids]
+    if stats is not None:
+        stats._switch('consensus')
+    if weights is None:
+        return _compute_consensus_annotation(
+            annotations, min_consensus_fraction, unassignable_label)
+    return _compute_consensus_lineage_counts(
+        _weight_sums(map(tuple, annotations), weights),
+        min_consensus_fraction, unassignable_label)
+
+
+def _weight_sums(keys, weights):
+    """ Sum the weights of each distinct key """
+    sums = defaultdict(float)
+    for key, weight in zip(keys, weights):
+        sums[key] += weight
+    return sums
+
+
+def _iter_uc_hits(uc, stats=None, checker=None, scored=False):
+    """ Iterate over the hit and no-hit records of a uc file
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, such as those generated by uclust, usearch, or vsearch,
+            or the path to one, which is read with memory mapping or
+            decompressed if it is compressed.
+        stats : ConsensusStats, optional
+            Statistics to count the bytes and records parsed in. Bytes of
+            file objects opened in text mode are counted as characters.
+        checker : _RecordChecker, optional
+            The error policy to apply to malformed records and, if it has a
+            taxonomy map, to hits of targets that are not in it. By default,
+            the first malformed record raises a ``UcRecordError``.
+        scored : bool, optional
+            Whether to also parse the percent identity (field 4) of each
+            record.
+
+        Returns
+        -------
+        iterator of tuples
+            Query sequence identifier and target sequence identifier of each
+            H record, or query sequence identifier and ``None`` for each N
+            record. Records that the policy skips are left out, and hits it
+            unassigns have a target of ``None``. If ``scored``, each tuple
+            also holds the percent identity of the record, or 0 for N
+            records.
+
+        Raises
+        ------
+        UcRecordError
+            If a record is malformed, including an H record whose percent
+            identity is not a number when ``scored``, and the error policy
+            is strict.
 
         Notes
         -----
@@ -91,52 +824,501 @@ def _uc_to_taxonomy(uc, taxonomy_map):
         [3] http://drive5.com/usearch/manual/utax_algo.html
 
     """
+    if _is_uc_file(uc):
+        return _iter_uc_hits_mmap(uc, stats, checker, scored)
+    if stats is not None:
+        return _iter_uc_lines(_counted_lines(uc, stats), stats, checker,
+                              scored)
+    return _iter_uc_lines(uc, checker=checker, scored=scored)
+
+
+def _counted_lines(uc, stats):
+    """ Iterate over the lines of a file object, counting their length """
+    for line in uc:
+        stats.bytes_parsed += len(line)
+        yield line
+
+
+def _iter_uc_lines(uc, stats=None, checker=None, scored=False):
+    """ Iterate over the hit and no-hit records of a uc file object """
     # This code has been ported to taxster from QIIME 1.9.1 with
     # permission from @gregcaporaso.
-    results = defaultdict(list)
-    for line in uc:
+    if checker is None:
+        checker = _RecordChecker()
+    targets = checker.targets
+    for line_number, line in enumerate(uc, 1):
         line = line.strip()
         if line.startswith('#') or line == "":
             continue
         elif line.startswith('H'):
             fields = line.split('\t')
-            query_id = fields[8].split()[0]
-            subject_id = fields[9].split()[0]
-            tax = taxonomy_map[subject_id]
-            results[query_id].append(tax)
+            try:
+                query_id = fields[8].split()[0]
+                target_id = fields[9].split()[0]
+                if scored:
+                    identity = float(fields[3])
+            except (IndexError, ValueError):
+                checker.malformed(line_number, line)
+                continue
+            if stats is not None:
+                stats.records_parsed += 1
+            # each distinct target is only checked once
+            if target_id not in targets:
+                target_id = checker.hit(target_id, query_id, line_number)
+                if target_id is _SKIP:
+                    continue
+            if scored:
+                yield query_id, target_id, identity
+            else:
+                yield query_id, target_id
         elif line.startswith('N'):
             fields = line.split('\t')
-            query_id = fields[8].split()[0]
+            try:
+                query_id = fields[8].split()[0]
+            except IndexError:
+                checker.malformed(line_number, line)
+                continue
+            if stats is not None:
+                stats.records_parsed += 1
+            if scored:
+                yield query_id, None, 0.0
+            else:
+                yield query_id, None
+        else:
+            checker.other(line[0])
+
+
+# slots of the table of completed queries, which takes 8 bytes per slot
+_COMPLETED_QUERY_SLOTS = 2 ** 20
+
+
+class _CompletedQueries(object):
+    """ A fixed-size record of the queries that have been completed
+
+        The hash of each completed query identifier is stored in a table
+        slot picked by the hash, replacing any earlier query's, so memory
+        use doesn't grow with the number of queries. A query is only
+        reported as completed if its full hash is in its slot, so ungrouped
+        input may go undetected, but grouped input is never rejected. Once
+        the table is full size, a query whose records recur after ``k`` other
+        queries is detected with a probability of about ``exp(-k / size)``.
+
+        Parameters
+        ----------
+        size : int, optional
+            The maximum number of slots, which must be a power of 2. The
+            table starts small, and grows up to it as queries are added.
+
+    """
+
+    __slots__ = ('_slots', '_mask', '_size', '_count')
+
+    def __init__(self, size=_COMPLETED_QUERY_SLOTS):
+        self._size = size
+        self._slots = array('q', bytes(8 * min(size, 1024)))
+        self._mask = len(self._slots) - 1
+        self._count = 0
+
+    def add(self, query_id):
+        # the low bit is set so that no hash matches an empty slot
+        h = hash(query_id) | 1
+        self._slots[h & self._mask] = h
+        self._count += 1
+        if self._count > self._mask and self._mask + 1 < self._size:
+            self._grow()
+
+    def __contains__(self, query_id):
+        h = hash(query_id) | 1
+        return self._slots[h & self._mask] == h
+
+    def _grow(self):
+        hashes = [h for h in self._slots if h]
+        self._slots = array('q', bytes(8 * min(4 * len(self._slots),
+                                               self._size)))
+        self._mask = mask = len(self._slots) - 1
+        slots = self._slots
+        for h in hashes:
+            slots[h & mask] = h
+
+
+def _iter_uc_query_hits(uc, stats=None, checker=None, scored=False,
+                        max_hits=None):
+    """ Process a query-grouped uc file one query at a time
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, such as those generated by uclust, usearch, or vsearch
+        stats : ConsensusStats, optional
+            Statistics to count the bytes and records parsed in.
+        checker : _RecordChecker, optional
+            The error policy to apply to the records, as for
+            ``_iter_uc_hits``.
+        scored : bool, optional
+            Whether to keep the hits with the highest percent identities, and
+            to yield their identities.
+        max_hits : int, optional
+            The maximum number of hits to keep per query if ``scored``.
+
+        Yields
+        ------
+        tuple
+            Query sequence identifier and list of the target sequence
+            identifiers of its (kept) hits, in the order they occur in
+            ``uc``, and if ``scored``, list of their percent identities.
+            ``None`` is used as the target of N records.
+
+        Raises
+        ------
+        ValueError
+            If the records for a query are found not to be adjacent in
+            ``uc``, which is checked with a ``_CompletedQueries``.
+
+    """
+    completed = _CompletedQueries()
+    current_id = None
+    current = None
+    for record in _iter_uc_hits(uc, stats, checker, scored):
+        query_id = record[0]
+        if query_id != current_id:
+            if current_id is not None:
+                completed.add(current_id)
+                yield ((current_id,) + current.hits() if scored else
+                       (current_id, current))
+            if query_id in completed:
+                raise ValueError(
+                    "Records for query %r are not adjacent in the .uc file. "
+                    "Use uc_consensus_assignments for input that is not "
+                    "grouped by query." % query_id)
+            current_id = query_id
+            current = _TopHits(max_hits) if scored else []
+            add = current.add if scored else current.append
+        add(*record[1:])
+    if current_id is not None:
+        yield ((current_id,) + current.hits() if scored else
+               (current_id, current))
+
+
+class _TopHits(object):
+    """ The hits of a query with the highest percent identities
+
+        Parameters
+        ----------
+        max_hits : int or None
+            The maximum number of hits to keep, or None to keep all of them.
+
+        Notes
+        -----
+        The kept hits are a min-heap on identity, so each hit is added in
+        O(log max_hits) time, and the lowest identity hit is dropped when a
+        better one arrives. Of hits with equal identities, the earlier ones
+        are kept.
+
+    """
+    __slots__ = ('max_hits', '_hits', '_n')
+
+    def __init__(self, max_hits=None):
+        self.max_hits = max_hits
+        self._hits = []
+        self._n = 0
+
+    def add(self, subject_id, identity):
+        # the negated position breaks ties in favour of earlier hits, so
+        # target identifiers are never compared
+        hit = (identity, -self._n, subject_id)
+        self._n += 1
+        if self.max_hits is None:
+            self._hits.append(hit)
+        elif len(self._hits) < self.max_hits:
+            heapq.heappush(self._hits, hit)
+        else:
+            heapq.heappushpop(self._hits, hit)
+
+    def hits(self):
+        """ Return the target identifiers and identities of the kept hits,
+            in the order they were added
+        """
+        hits = self._hits
+        if self.max_hits is not None:
+            hits = sorted(hits, key=itemgetter(1), reverse=True)
+        return [hit[2] for hit in hits], [hit[0] for hit in hits]
+
+
+def _uc_to_query_scored_hits(uc, max_hits=None, stats=None, checker=None):
+    """ Group the hits of a uc file by query, keeping the hits with the
+        highest percent identities
+
+        Parameters are as for ``_iter_uc_query_hits``, except that the
+        records of a query need not be adjacent.
+
+        Returns
+        -------
+        list of tuples
+            Query sequence identifier, target sequence identifiers and
+            percent identities of the kept hits of each query, as yielded by
+            ``_iter_uc_query_hits`` if ``scored``, in the order queries are
+            first observed.
+
+    """
+    results = {}
+    for query_id, subject_id, identity in _iter_uc_hits(uc, stats, checker,
+                                                        scored=True):
+        top_hits = results.get(query_id)
+        if top_hits is None:
+            top_hits = results[query_id] = _TopHits(max_hits)
+        top_hits.add(subject_id, identity)
+    return [(query_id,) + top_hits.hits()
+            for query_id, top_hits in results.items()]
+
+
+def _iter_uc_query_taxonomy(uc, taxonomy_map, checker=None):
+    """ Process a query-grouped uc file one query at a time
+
+        Parameters
+        ----------
+        uc : file-like object
+            A .uc file, such as those generated by uclust, usearch, or vsearch
+        taxonomy_map : dict
+            Mapping of target sequence identifiers to taxonomic annotations
+        checker : _RecordChecker, optional
+            The error policy to apply to the records, which must check
+            targets against ``taxonomy_map``. By default, the first unusable
+            record raises a ``UcRecordError``.
+
+        Yields
+        ------
+        tuple
+            Query sequence identifier and list of taxonomic annotations of
+            the corresponding hits, in the order they occur in ``uc``.
+
+        Raises
+        ------
+        ValueError
+            If the records for a query are not adjacent in ``uc``.
+
+    """
+    if checker is None:
+        checker = _record_checker(uc, taxonomy_map=taxonomy_map)
+    for query_id, subject_ids in _iter_uc_query_hits(uc, checker=checker):
+        yield query_id, [taxonomy_map[s] if s is not None else []
+                         for s in subject_ids]
+
+
+def _uc_to_taxonomy(uc, taxonomy_map, checker=None):
+    """ Process a uc file and associated taxonomy annotations
+
+        Parameters
+        ----------
+        uc : file-like object
+            A .uc file, such as those generated by uclust, usearch, or vsearch
+        taxonomy_map : dict
+            Mapping of target sequence identifiers to taxonomic annotations
+        checker : _RecordChecker, optional
+            The error policy to apply to the records, as for
+            ``_iter_uc_query_taxonomy``.
+
+        Returns
+        -------
+        dict
+            Mapping of query sequence identifiers to taxonomic annotations
+            of corresponding hits.
+
+        Notes
+        -----
+        The .uc format is documented in [1]_. This format was initally defined
+        by Robert Edgar [2]_. This is not an implementation of utax [3]_, but
+        rather just an approach for using search hits to identify taxonomy.
+
+        References
+        ----------
+        [1] http://drive5.com/usearch/manual/opt_uc.html
+        [2] http://drive5.com/
+        [3] http://drive5.com/usearch/manual/utax_algo.html
+
+    """
+    if checker is None:
+        checker = _record_checker(uc, taxonomy_map=taxonomy_map)
+    results = defaultdict(list)
+    for query_id, subject_id in _iter_uc_hits(uc, checker=checker):
+        if subject_id is None:
             results[query_id].append([])
+        else:
+            results[query_id].append(taxonomy_map[subject_id])
     return results
 
 
+def _uc_to_query_hits(uc, stats=None, checker=None):
+    """ Group the hits of a uc file by query
+
+        Parameters are as for ``_iter_uc_hits``.
+
+        Returns
+        -------
+        dict
+            Mapping of query sequence identifiers to lists of the target
+            sequence identifiers of their hits, with ``None`` for N records.
+
+    """
+    results = defaultdict(list)
+    for query_id, subject_id in _iter_uc_hits(uc, stats, checker):
+        results[query_id].append(subject_id)
+    return results
+
+
+def _uc_to_hit_arrays(uc, taxonomy_table, stats=None, checker=None,
+                      scored=False):
+    """ Process a uc file into flat arrays of hits
+
+        Parameters
+        ----------
+        uc : file-like object or str
+            A .uc file, such as those generated by uclust, usearch, or vsearch,
+            or the path to one, which is read with memory mapping or
+            decompressed if it is compressed.
+        taxonomy_table : TaxonomyTable
+            Taxonomic annotations of the target sequences.
+        stats : ConsensusStats, optional
+            Statistics to count the bytes and records parsed in, and to
+            charge the time spent looking up targets to the lookup stage of.
+        checker : _RecordChecker, optional
+            The error policy to apply to unusable records and to hits of
+            targets that are not in ``taxonomy_table``. By default, the first
+            one raises a ``UcRecordError``.
+        scored : bool, optional
+            Whether to also parse the percent identity (field 4) of each
+            hit.
+
+        Returns
+        -------
+        list of str
+            Query sequence identifiers, in the order they are first observed.
+        np.ndarray of int
+            Index into the query identifiers of each hit.
+        np.ndarray of int
+            Lineage node identifier of each hit. N records map to the root
+            node.
+        np.ndarray of float
+            Percent identity of each hit, or 0 for N records. Only returned
+            if ``scored`` is True.
+
+    """
+    if checker is None:
+        checker = _record_checker(uc, taxonomy_map=taxonomy_table)
+    if _is_uc_file(uc):
+        return _uc_hit_arrays_mmap(uc, taxonomy_table, stats, checker,
+                                   scored)
+    query_ids = []
+    query_indices = {}
+    query_index = array('i')
+    subject_ids = []
+    identities = array('d')
+    for hit in _iter_uc_hits(uc, stats, checker, scored):
+        query_id, subject_id = hit[0], hit[1]
+        if scored:
+            identities.append(hit[2])
+        index = query_indices.get(query_id)
+        if index is None:
+            index = query_indices[query_id] = len(query_ids)
+            query_ids.append(query_id)
+        query_index.append(index)
+        subject_ids.append(subject_id)
+    if stats is not None:
+        stats._switch('lookup')
+    # the distinct targets are looked up together, once all are known; the
+    # parser has already collected them while checking them
+    targets = list(checker.targets)
+    target_nodes = dict(zip(targets, taxonomy_table.nodes(targets)))
+    target_nodes[None] = TaxonomyTable.root
+    nodes = array('i', [target_nodes[s] for s in subject_ids])
+    result = (query_ids, np.frombuffer(query_index, dtype=np.intc),
+              np.frombuffer(nodes, dtype=np.intc))
+    if scored:
+        result += (np.frombuffer(identities, dtype=np.float64),)
+    return result
+
+
+def _uc_to_selected_hit_arrays(uc, taxonomy_table, max_hits, weighted,
+                               stats=None, checker=None):
+    """ Process a uc file into flat arrays of queries' selected hits
+
+        Parameters
+        ----------
+        max_hits : int or None
+            The maximum number of hits to keep per query, as for
+            ``uc_consensus_assignments``.
+        weighted : bool
+            Whether each hit votes with its percent identity.
+
+        Other parameters are as for ``_uc_to_hit_arrays``.
+
+        Returns
+        -------
+        tuple
+            Query sequence identifiers, query index of each kept hit and
+            lineage node identifier of each kept hit, as returned by
+            ``_uc_to_hit_arrays``, and the percent identity of each kept hit
+            if ``weighted``, or None.
+
+    """
+    query_ids, query_index, nodes, identities = _uc_to_hit_arrays(
+        uc, taxonomy_table, stats, checker, scored=True)
+    if max_hits is not None:
+        keep = _top_hits(query_index, identities, max_hits)
+        query_index, nodes, identities = (query_index[keep], nodes[keep],
+                                          identities[keep])
+    return query_ids, query_index, nodes, identities if weighted else None
+
+
 def _compute_consensus_annotations(query_annotations, min_consensus_fraction,
-                                   unassignable_label):
+                                   unassignable_label, stats=None):
     """
         Parameters
         ----------
         query_annotations : dict of lists
             Keys are query identifiers, and values are lists of all
             taxonomic annotations associated with that identfier.
+        stats : ConsensusStats, optional
+            Statistics to count the queries in.
+        weights : np.ndarray of float, optional
+            The vote of each hit. By default each hit has one vote.
 
         Returns
         -------
-        dict
+        ConsensusAssignments
             Keys are query identifiers, and values are the consensus of the
             input taxonomic annotations.
 
+    """
+    return ConsensusAssignments._from_tuples(
+        _iter_consensus_annotations(query_annotations, min_consensus_fraction,
+                                    unassignable_label, stats),
+        unassignable_label)
+
+
+def _iter_consensus_annotations(query_annotations, min_consensus_fraction,
+                                unassignable_label, stats=None):
+    """ Iterate over the consensus annotations of queries' annotations
+
+        Parameters are as for ``_compute_consensus_annotations``.
+
+        Yields
+        ------
+        tuple
+            Query identifier, consensus taxonomic annotation, consensus
+            fraction, and number of input annotations, as yielded by
+            ``iter_uc_consensus_assignments``.
+
     """
     # This code has been ported to taxster from QIIME 1.9.1 with
     # permission from @gregcaporaso.
-    result = {}
     for query_id, annotations in query_annotations.items():
         consensus_annotation, consensus_fraction = \
             _compute_consensus_annotation(annotations, min_consensus_fraction,
                                           unassignable_label)
-        result[query_id] = (consensus_annotation, consensus_fraction,
-                            len(annotations))
-    return result
+        if stats is not None:
+            stats._query(query_id, len(annotations))
+        yield (query_id, consensus_annotation, consensus_fraction,
+               len(annotations))
 
 
 def _compute_consensus_annotation(annotations, min_consensus_fraction,
@@ -168,6 +1350,52 @@ def _compute_consensus_annotation(annotations, min_consensus_fraction,
         raise ValueError("min_consensus_fraction must be greater than 0.5.")
     num_input_annotations = len(annotations)
     consensus_annotation = []
+    # see _compute_consensus_lineage_counts for why the consensus only has
+    # the number of levels of the shortest annotation
+    num_levels = min(map(len, annotations))
+
+    # the candidates are the annotations that agree with the consensus so
+    # far. since min_consensus_fraction > 0.5, only a prefix that extends the
+    # consensus at the previous level can be accepted at the current level,
+    # so each level only counts the taxa of the candidates, and annotations
+    # that disagree are neither counted again nor converted to tuples. when
+    # the consensus fails at the first levels, as it does for diverse hits,
+    # most annotations are only inspected once.
+    candidates = annotations
+    for level in range(num_levels):
+        current_level_annotations = Counter(map(itemgetter(level),
+                                                candidates))
+        tax, max_count = current_level_annotations.most_common(1)[0]
+        max_consensus_fraction = max_count / num_input_annotations
+        if max_consensus_fraction >= min_consensus_fraction:
+            consensus_annotation.append((tax, max_consensus_fraction))
+            if max_count < len(candidates):
+                candidates = [a for a in candidates if a[level] == tax]
+        else:
+            break
+    return _consensus_result(consensus_annotation, unassignable_label)
+
+
+def _compute_consensus_lineage_counts(lineages, min_consensus_fraction,
+                                      unassignable_label):
+    """ Compute the consensus of counted annotations
+
+        Parameters
+        ----------
+        lineages : dict
+            Number of annotations (int), or their total weight (float), of
+            each distinct taxonomic annotation (tuple).
+
+        Other parameters and the result are as for
+        ``_compute_consensus_annotation``.
+
+    """
+    # This code has been ported to taxster from QIIME 1.9.1 with
+    # permission from @gregcaporaso.
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    num_input_annotations = sum(lineages.values())
+    consensus_annotation = []
 
     # if the annotations don't all have the same number
     # of levels, the resulting annotation will have a max number
@@ -177,18 +1405,35 @@ def _compute_consensus_annotation(annotations, min_consensus_fraction,
     # which has 7 levels, and the other n-1 assignments have 6 levels.
     # A 7th level in the result would be misleading because it
     # would appear to the user as though it was the consensus
-    # across all n assignments.
-    num_levels = min([len(a) for a in annotations])
+    # across all n assignments. annotations without any weight can't
+    # support an assignment at any level.
+    num_levels = min([len(a) for a in lineages])
+    if not num_input_annotations:
+        num_levels = 0
 
-    # iterate over the assignment levels
+    # the candidates are the distinct lineages that agree with the consensus
+    # so far. since min_consensus_fraction > 0.5, only a prefix that extends
+    # the consensus at the previous level can be accepted at the current
+    # level, so prefixes never need to be counted across all annotations.
+    # for example, 'p__A; c__B; o__C' and 'p__X; c__Y; o__C' represent
+    # different taxa at the o__ level, but 'p__X; c__Y; o__C' is dropped as
+    # soon as 'p__A' is accepted.
+    candidates = list(lineages.items())
     for level in range(num_levels):
-        # count the different taxonomic assignments at the current level.
-        # the counts are computed based on the current level and all higher
-        # levels to reflect that, for example, 'p__A; c__B; o__C' and
-        # 'p__X; c__Y; o__C' represent different taxa at the o__ level (since
-        # they are different at the p__ and c__ levels).
-        current_level_annotations = \
-            Counter([tuple(e[:level + 1]) for e in annotations])
+        if len(candidates) == 1:
+            # all remaining annotations share one lineage, so they agree at
+            # every remaining level with the same fraction
+            lineage, count = candidates[0]
+            max_consensus_fraction = count / num_input_annotations
+            if max_consensus_fraction >= min_consensus_fraction:
+                consensus_annotation.extend(
+                    (taxon, max_consensus_fraction)
+                    for taxon in lineage[level:num_levels])
+            break
+        # count the different taxonomic assignments at the current level
+        current_level_annotations = Counter()
+        for lineage, count in candidates:
+            current_level_annotations[lineage[level]] += count
         # identify the most common taxonomic assignment, and compute the
         # fraction of annotations that contained it. it's safe to compute the
         # fraction using num_assignments because the deepest level we'll
@@ -199,14 +1444,22 @@ def _compute_consensus_annotation(annotations, min_consensus_fraction,
         # check whether the most common taxonomic assignment is observed
         # in at least min_consensus_fraction of the sequences
         if max_consensus_fraction >= min_consensus_fraction:
-            # if so, append the current level only (e.g., 'o__C' if tax is
-            # 'p__A; c__B; o__C', and continue on to the next level
-            consensus_annotation.append((tax[-1], max_consensus_fraction))
+            # if so, append the current level only, and continue on to the
+            # next level with the annotations that contain it
+            consensus_annotation.append((tax, max_consensus_fraction))
+            candidates = [(lineage, count) for lineage, count in candidates
+                          if lineage[level] == tax]
         else:
-            # if not, there is no assignment at this level, and we're
-            # done iterating over levels
+            # if not, no annotation can reach min_consensus_fraction at
+            # this or any deeper level, and we're done iterating over levels
             break
+    return _consensus_result(consensus_annotation, unassignable_label)
 
+
+def _consensus_result(consensus_annotation, unassignable_label):
+    """ Return the annotation and fraction of ``(taxon, fraction)`` pairs
+        accepted at each level
+    """
     # construct the results
     # determine the number of levels in the consensus assignment
     consensus_annotation_depth = len(consensus_annotation)
@@ -228,3 +1481,212 @@ def _compute_consensus_annotation(annotations, min_consensus_fraction,
         consensus_fraction_result = 1.0
 
     return annotation, consensus_fraction_result
+
+
+def _compute_consensus_nodes(query_nodes, taxonomy_table,
+                             min_consensus_fraction, unassignable_label):
+    """ Compute consensus annotations of lineage node identifiers
+
+        Parameters
+        ----------
+        query_nodes : dict of lists
+            Keys are query identifiers, and values are lists of the lineage
+            node identifiers associated with that identifier.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+        min_consensus_fraction : float
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted.
+        unassignable_label : str
+            The label to apply if no acceptable annotations are identified.
+
+        Returns
+        -------
+        dict
+            Keys are query identifiers, and values are tuples of consensus
+            taxonomic annotation (list), consensus fraction (float), and
+            number of input annotations (int), as returned by
+            ``_compute_consensus_annotations``.
+
+    """
+    result = {}
+    for query_id, nodes in query_nodes.items():
+        node, consensus_fraction = _compute_consensus_node(
+            nodes, taxonomy_table, min_consensus_fraction)
+        result[query_id] = (
+            _node_annotation(node, taxonomy_table, unassignable_label),
+            consensus_fraction, len(nodes))
+    return result
+
+
+def _compute_consensus_node(nodes, taxonomy_table, min_consensus_fraction):
+    """ Compute the consensus of a collection of lineage node identifiers
+
+        This is equivalent to ``_compute_consensus_annotation``, but because
+        each node of a ``TaxonomyTable`` identifies a unique lineage prefix,
+        prefixes are counted as ints rather than as tuples of str.
+
+        Parameters
+        ----------
+        nodes : list of int
+            Lineage node identifiers to compute the consensus of.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+        min_consensus_fraction : float
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than or equal to 0.51.
+
+        Result
+        ------
+        consensus_node
+            Node identifier of the consensus assignment, or the root node if
+            there is no acceptable assignment.
+        consensus_fraction
+            Fraction of input annotations that agreed at the deepest
+            level of assignment
+    """
+    return _compute_consensus_node_counts(Counter(nodes), taxonomy_table,
+                                          min_consensus_fraction)
+
+
+def _compute_consensus_node_counts(node_counts, taxonomy_table,
+                                   min_consensus_fraction):
+    """ Compute the consensus of counted lineage node identifiers
+
+        Parameters
+        ----------
+        node_counts : dict
+            Number of annotations (int), or their total weight (float), of
+            each distinct lineage node identifier.
+
+        Other parameters and the result are as for
+        ``_compute_consensus_node``.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    path, fractions = _compute_majority_path(node_counts, taxonomy_table)
+    # the fractions never increase along the path, so the consensus is its
+    # deepest node whose fraction is acceptable
+    depth = len(path)
+    while depth and fractions[depth - 1] < min_consensus_fraction:
+        depth -= 1
+    if not depth:
+        return TaxonomyTable.root, 1.0
+    return path[depth - 1], fractions[depth - 1]
+
+
+def _compute_majority_path(node_counts, taxonomy_table):
+    """ Find the lineage that a majority of counted nodes agree with
+
+        Parameters
+        ----------
+        node_counts : dict
+            Number of annotations (int), or their total weight (float), of
+            each distinct lineage node identifier.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+
+        Returns
+        -------
+        list of int
+            Node identifier of the most common lineage prefix at each rank,
+            for as long as it is held by more than half of the annotations.
+        list of float
+            Fraction of the annotations that agree with the path at each
+            rank.
+
+        Notes
+        -----
+        Any consensus with a ``min_consensus_fraction`` greater than 0.5 is
+        a prefix of this path, so the consensus at every threshold can be
+        read from one computation.
+
+    """
+    num_input_annotations = sum(node_counts.values())
+    # each distinct node only needs to be expanded into its path once
+    candidates = [(taxonomy_table.path(node), count)
+                  for node, count in node_counts.items()]
+    num_levels = min([len(p) for p, _ in candidates])
+    if not num_input_annotations:
+        # annotations without any weight can't support an assignment
+        num_levels = 0
+
+    # as in _compute_consensus_annotation, only the paths that agree with
+    # the majority so far need to be counted at each level
+    majority_path = []
+    fractions = []
+    for level in range(num_levels):
+        if len(candidates) == 1:
+            path, count = candidates[0]
+            fraction = count / num_input_annotations
+            if fraction > 0.5:
+                majority_path.extend(path[level:num_levels])
+                fractions.extend([fraction] * (num_levels - level))
+            break
+        current_level_nodes = Counter()
+        for path, count in candidates:
+            current_level_nodes[path[level]] += count
+        node, max_count = current_level_nodes.most_common(1)[0]
+        fraction = max_count / num_input_annotations
+        if fraction <= 0.5:
+            break
+        majority_path.append(node)
+        fractions.append(fraction)
+        candidates = [(path, count) for path, count in candidates
+                      if path[level] == node]
+    return majority_path, fractions
+
+
+def _node_annotation(node, taxonomy_table, unassignable_label):
+    """ Return the annotation of a consensus node as a list of str """
+    if node == TaxonomyTable.root:
+        return [unassignable_label]
+    return taxonomy_table.lineage(node)
+
+
+def _batch_consensus_annotations(query_ids, query_index, nodes,
+                                 taxonomy_table, min_consensus_fraction,
+                                 unassignable_label, stats=None,
+                                 weights=None):
+    """ Compute consensus annotations of flat hit arrays
+
+        Parameters
+        ----------
+        query_ids : list of str
+            Query sequence identifiers.
+        query_index : np.ndarray of int
+            Index into ``query_ids`` of each hit.
+        nodes : np.ndarray of int
+            Lineage node identifier of each hit.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+        min_consensus_fraction : float
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted.
+        unassignable_label : str
+            The label to apply if no acceptable annotations are identified.
+        stats : ConsensusStats, optional
+            Statistics to count the queries in.
+        weights : np.ndarray of float, optional
+            The vote of each hit. By default each hit has one vote.
+
+        Returns
+        -------
+        ConsensusAssignments
+            Keys are query identifiers, and values are tuples of consensus
+            taxonomic annotation (list), consensus fraction (float), and
+            number of input annotations (int), as returned by
+            ``_compute_consensus_annotations``.
+
+    """
+    ancestors = _ancestor_matrix(nodes, taxonomy_table)
+    consensus_nodes, fractions, n_hits = _batch_consensus(
+        query_index, ancestors, len(query_ids), min_consensus_fraction,
+        weights)
+    if stats is not None:
+        for query_id, count in zip(query_ids, n_hits.tolist()):
+            stats._query(query_id, count)
+    return ConsensusAssignments(query_ids, taxonomy_table, consensus_nodes,
+                                fractions, n_hits, unassignable_label)
@@ -0,0 +1,752 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import mmap
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+
+from taxster._compression import _compression, _iter_decompressed
+from taxster._errors import _SKIP, _UNCHECKED, _RecordChecker
+
+_TAB, _NEWLINE, _CARRIAGE_RETURN, _SPACE = 9, 10, 13, 32
+_H, _N, _HASH = ord('H'), ord('N'), ord('#')
+# the longest words that are gathered into fixed-width arrays, and the number
+# of words gathered at a time
+_MAX_WORD_WIDTH = 128
+_GATHER_ROWS = 1 << 14
+# classes of bytes, so that fields are split as by str.split() in the line
+# by line parser: whitespace other than tabs and newlines, which delimit
+# fields and lines, and the lead bytes of the UTF-8 encodings of the other
+# characters that str.split() treats as whitespace, whose fields are split
+# one by one
+_WHITESPACE, _UNICODE_LEAD = 1, 2
+_BYTE_CLASSES = np.zeros(256, dtype=np.uint8)
+_BYTE_CLASSES[[_SPACE, _CARRIAGE_RETURN, 0x0b, 0x0c, 0x1c, 0x1d, 0x1e,
+               0x1f]] = _WHITESPACE
+_BYTE_CLASSES[[0xc2, 0xe1, 0xe2, 0xe3]] = _UNICODE_LEAD
+# lines starting with these bytes may start with whitespace, and are
+# stripped one by one
+_STRIPPED_STARTS = np.zeros(256, dtype=bool)
+_STRIPPED_STARTS[_BYTE_CLASSES != 0] = True
+_STRIPPED_STARTS[[_TAB, _NEWLINE]] = True
+_STRIPPED_STARTS[0x80:] = True
+
+
+class _UcRange(namedtuple('_UcRange', ['path', 'start', 'end'])):
+    """ A byte range of a .uc file on disk, starting at the start of a line
+    """
+    __slots__ = ()
+
+
+def _is_uc_file(uc):
+    """ Return whether ``uc`` is a path or range of a .uc file on disk """
+    return isinstance(uc, (str, _UcRange))
+
+
+def _iter_uc_chunks(uc, chunk_size=1 << 24):
+    """ Iterate over a uc file in blocks of whole lines
+
+        Parameters
+        ----------
+        uc : str or _UcRange
+            Path to a .uc file, or a byte range of one. Uncompressed files are
+            memory-mapped, and compressed files are decompressed in a
+            background thread.
+        chunk_size : int, optional
+            Approximate number of bytes per block.
+
+        Yields
+        ------
+        np.ndarray of uint8
+            Blocks of the file, each ending at the end of a line or at the
+            end of the range.
+
+    """
+    if not isinstance(uc, _UcRange) and _compression(uc) is not None:
+        return _iter_stream_chunks(_iter_decompressed(uc), chunk_size)
+    return _iter_mmap_chunks(uc, chunk_size)
+
+
+def _iter_stream_chunks(blocks, chunk_size):
+    """ Regroup blocks of bytes into arrays of whole lines """
+    pending = []
+    pending_size = 0
+    for block in blocks:
+        pending.append(block)
+        pending_size += len(block)
+        if pending_size < chunk_size:
+            continue
+        data = b''.join(pending)
+        start = 0
+        while len(data) - start >= chunk_size:
+            newline = data.rfind(b'\n', start, start + chunk_size)
+            if newline < 0:
+                newline = data.find(b'\n', start + chunk_size)
+                if newline < 0:
+                    break
+            yield np.frombuffer(data, dtype=np.uint8,
+                                count=newline + 1 - start, offset=start)
+            start = newline + 1
+        pending = [data[start:]]
+        pending_size = len(pending[0])
+    if pending_size:
+        yield np.frombuffer(b''.join(pending), dtype=np.uint8)
+
+
+def _iter_mmap_chunks(uc, chunk_size):
+    """ Iterate over views of a memory-mapped uc file in blocks of whole
+        lines
+    """
+    path, start, end = uc if isinstance(uc, _UcRange) else (uc, 0, None)
+    with open(path, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            return
+    # the buffer is closed when the last view of it is garbage collected
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if end is None:
+        end = len(data)
+    while start < end:
+        stop = min(start + chunk_size, end)
+        if stop < end:
+            newline = buffer.rfind(b'\n', start, stop)
+            if newline < 0:
+                newline = buffer.find(b'\n', stop, end)
+            stop = end if newline < 0 else newline + 1
+        yield data[start:stop]
+        start = stop
+
+
+def _scan_uc_chunk(data, identities=False, checker=None):
+    """ Locate the query and target labels of the H and N records in a block
+
+        Parameters
+        ----------
+        data : np.ndarray of uint8
+            Whole lines of a .uc file.
+        identities : bool, optional
+            Whether to also parse the percent identity (field 4) of each
+            record.
+        checker : _RecordChecker, optional
+            The error policy to apply to unusable records, which also counts
+            the lines of the input. If it is given, the line number of each
+            record is also returned. By default, the first unusable record
+            raises a ``UcRecordError``.
+
+        Returns
+        -------
+        np.ndarray of bool
+            Whether each record is an H (rather than N) record.
+        np.ndarray of bytes
+            First word of the query label (field 9) of each record.
+        np.ndarray of bytes
+            First word of the target label (field 10) of each record, or
+            ``b''`` for N records.
+        np.ndarray of float
+            Percent identity of each record, or 0 for N records. Only
+            returned if ``identities`` is True.
+        np.ndarray of int
+            Line of the input of each record, counted from 1. Only returned
+            if ``checker`` is given.
+
+        Raises
+        ------
+        UcRecordError
+            If the policy is strict and an H record has fewer than 10 fields
+            or no target label, or an N record has fewer than 9 fields, or a
+            record has no query label, or the percent identity of an H record
+            is not a number. Records of other types are counted and ignored.
+
+        Notes
+        -----
+        Field boundaries are found for all lines at once from the positions
+        of the tab and newline bytes, and the labels are gathered into
+        fixed-width arrays, so the other fields are never copied. Lines and
+        fields are split as ``str.strip`` and ``str.split`` split them, as
+        in the line by line parser. Unusable records, lines that start with
+        whitespace and fields that start with whitespace or hold non-ASCII
+        whitespace are rare, so they are only handled one by one once they
+        have been found.
+
+    """
+    record_checker = checker if checker is not None else _RecordChecker()
+    length = len(data)
+    delimiters = np.flatnonzero((data == _TAB) | (data == _NEWLINE))
+    if length and data[-1] != _NEWLINE:
+        delimiters = np.append(delimiters, length)
+        newline = np.append(data[delimiters[:-1]] == _NEWLINE, True)
+    else:
+        newline = data[delimiters] == _NEWLINE
+    # the i-th tab of a line is the i-th delimiter after the previous
+    # line's newline
+    line_ends = np.flatnonzero(newline)
+    first_delimiters = np.empty_like(line_ends)
+    first_delimiters[:1] = 0
+    first_delimiters[1:] = line_ends[:-1] + 1
+    tab_counts = line_ends - first_delimiters
+    line_ends = delimiters[line_ends]
+    line_starts = np.empty_like(line_ends)
+    line_starts[:1] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    first_line = record_checker.lines + 1
+    record_checker.lines += len(line_ends)
+
+    nonempty = line_starts < line_ends
+    first = data[np.minimum(line_starts, length - 1)]
+    stripped = np.flatnonzero(nonempty & _STRIPPED_STARTS[first])
+    if len(stripped):
+        first = first.copy()
+        line_starts, first_delimiters, tab_counts = (
+            line_starts.copy(), first_delimiters.copy(), tab_counts.copy())
+        _strip_lines(data, stripped, line_starts, line_ends,
+                     first_delimiters, tab_counts, first, nonempty,
+                     record_checker)
+    records = ((first == _H) | (first == _N)) & nonempty
+    others = nonempty & ~records & (first != _HASH)
+    others[stripped] = False
+    if others.any():
+        _count_other_records(first[others], record_checker)
+    records = np.flatnonzero(records)
+    is_hit = first[records] == _H
+    short = tab_counts[records] < np.where(is_hit, 9, 8)
+    malformed = records[short].tolist()
+    if malformed:
+        # the fields of short records can't be located
+        records, is_hit = records[~short], is_hit[~short]
+    first_delimiters = first_delimiters[records]
+
+    # fields 9 and 10 end at the next delimiter, and only H records have
+    # a target
+    hits = np.flatnonzero(is_hit)
+    hit_delimiters = first_delimiters[hits]
+    classes = _BYTE_CLASSES[data]
+    whitespace = np.append(np.flatnonzero(classes == _WHITESPACE), length)
+    unicode_leads = np.append(np.flatnonzero(classes == _UNICODE_LEAD),
+                              length)
+    queries = _first_words(data, delimiters[first_delimiters + 7] + 1,
+                           delimiters[first_delimiters + 8], whitespace,
+                           unicode_leads)
+    targets = _scatter(_first_words(
+        data, delimiters[hit_delimiters + 8] + 1,
+        delimiters[hit_delimiters + 9], whitespace, unicode_leads),
+        hits, len(records), b'')
+    # records without a query or target label are malformed, as they are
+    # for the line by line parser
+    bad = queries == b''
+    bad[hits] |= targets[hits] == b''
+    if identities:
+        # field 4 is parsed in the same pass, and N records have no identity
+        fields = _gather_fields(data, delimiters[hit_delimiters + 2] + 1,
+                                delimiters[hit_delimiters + 3])
+        try:
+            values = fields.astype(np.float64)
+        except ValueError:
+            values, parsed = _parse_identities(fields)
+            bad[hits] |= ~parsed
+        values = _scatter(values, hits, len(records), 0.0)
+    if malformed or bad.any():
+        # report in the order of the lines, so that a strict policy raises
+        # for the first of them
+        for i in sorted(malformed + records[bad].tolist()):
+            record_checker.malformed(first_line + i,
+                                     _line(data, line_starts[i],
+                                           line_ends[i]))
+        keep = ~bad
+        records, is_hit = records[keep], is_hit[keep]
+        queries, targets = queries[keep], targets[keep]
+        if identities:
+            values = values[keep]
+    result = (is_hit, queries, targets)
+    if identities:
+        result += (values,)
+    if checker is not None:
+        result += (first_line + records,)
+    return result
+
+
+def _strip_lines(data, lines, line_starts, line_ends, first_delimiters,
+                 tab_counts, first, nonempty, checker):
+    """ Strip the leading whitespace of lines, as ``str.strip`` does
+
+        The starts, first delimiters, tab counts and first bytes of the
+        lines are updated in place, blank lines are marked empty, and
+        records of types other than H and N are counted.
+
+    """
+    for i in lines.tolist():
+        start, end = int(line_starts[i]), int(line_ends[i])
+        line = data[start:end].tobytes().decode('utf-8', 'surrogateescape')
+        text = line.strip()
+        if not text or text.startswith('#'):
+            nonempty[i] = False
+            continue
+        if text[0] not in 'HN':
+            checker.other(text[0])
+            nonempty[i] = False
+            continue
+        prefix = len(line[:len(line) - len(line.lstrip())].encode(
+            'utf-8', 'surrogateescape'))
+        tabs = int(np.count_nonzero(data[start:start + prefix] == _TAB))
+        line_starts[i] = start + prefix
+        first_delimiters[i] += tabs
+        tab_counts[i] -= tabs
+        first[i] = ord(text[0])
+
+
+def _scatter(values, rows, size, fill):
+    """ Place ``values`` at ``rows`` of an array of ``fill`` values """
+    result = np.full(size, fill, dtype=values.dtype)
+    result[rows] = values
+    return result
+
+
+def _count_other_records(record_types, checker):
+    """ Count the records of types other than H and N by type """
+    types, counts = np.unique(record_types, return_counts=True)
+    for record_type, count in zip(types.tolist(), counts.tolist()):
+        checker.other(chr(record_type), count)
+
+
+def _parse_identities(words):
+    """ Parse percent identities one by one
+
+        Returns
+        -------
+        np.ndarray of float
+            The identities, or 0 where they aren't numbers.
+        np.ndarray of bool
+            Whether each identity is a number.
+
+    """
+    values = np.zeros(len(words))
+    parsed = np.ones(len(words), dtype=bool)
+    for i, word in enumerate(words.tolist()):
+        try:
+            values[i] = float(word.decode('utf-8', 'surrogateescape'))
+        except ValueError:
+            parsed[i] = False
+    return values, parsed
+
+
+def _first_words(data, starts, ends, whitespace, unicode_leads):
+    """ Gather the first word of each field into a fixed-width bytes array
+
+        ``whitespace`` and ``unicode_leads`` hold the sorted positions of the
+        bytes of those classes in ``data``, each followed by ``len(data)``.
+        Long words are returned as by ``_gather_fields``.
+
+    """
+    word_ends = np.minimum(ends,
+                           whitespace[np.searchsorted(whitespace, starts)])
+    lengths = word_ends - starts
+    # fields that are empty, start with whitespace or may hold non-ASCII
+    # whitespace are rare, so they are split one by one
+    irregular = lengths == 0
+    if len(unicode_leads) > 1:
+        irregular |= (unicode_leads[np.searchsorted(unicode_leads, starts)] <
+                      word_ends)
+    irregular = np.flatnonzero(irregular)
+    words = _gather_fields(data, starts, word_ends)
+    if len(irregular):
+        fixed_width = words.dtype != object
+        words = words.astype(object)
+        for i in irregular.tolist():
+            field = data[starts[i]:ends[i]].tobytes().decode(
+                'utf-8', 'surrogateescape').split()
+            word = words[i] = (field[0].encode('utf-8', 'surrogateescape')
+                               if field else b'')
+            fixed_width = fixed_width and len(word) <= _MAX_WORD_WIDTH
+        if fixed_width:
+            words = words.astype(bytes)
+    return words
+
+
+def _gather_fields(data, starts, ends):
+    """ Gather byte strings of ``data`` into a fixed-width bytes array
+
+        If any is longer than ``_MAX_WORD_WIDTH`` bytes, an object array of
+        bytes is returned instead.
+
+    """
+    lengths = ends - starts
+    if not len(lengths) or lengths.max() <= _MAX_WORD_WIDTH:
+        return _gather_words(data, starts, lengths)
+    # words of similar lengths are gathered together, so that one long
+    # label doesn't widen the labels of the whole block, and each group
+    # takes at most twice the memory of its words
+    words = np.empty(len(lengths), dtype=object)
+    groups = np.maximum(np.ceil(np.log2(np.maximum(lengths, 1))),
+                        np.log2(_MAX_WORD_WIDTH)).astype(int)
+    for group in np.unique(groups).tolist():
+        rows = np.flatnonzero(groups == group)
+        words[rows] = _gather_words(data, starts[rows],
+                                    lengths[rows]).astype(object)
+    return words
+
+
+def _gather_words(data, starts, lengths):
+    """ Gather byte strings of ``data`` into a fixed-width bytes array """
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    offsets = np.arange(width)
+    last = len(data) - 1
+    words = np.empty((len(lengths), width), dtype=np.uint8)
+    # the index matrix takes 8 bytes per gathered byte, so it is only built
+    # for a bounded number of words at a time
+    for start in range(0, len(lengths), _GATHER_ROWS):
+        rows = slice(start, start + _GATHER_ROWS)
+        block = data[np.minimum(starts[rows, np.newaxis] + offsets, last)]
+        block[offsets >= lengths[rows, np.newaxis]] = 0
+        words[rows] = block
+    return words.view('S%d' % width).ravel()
+
+
+def _line(data, start, end):
+    return data[start:end].tobytes().decode('utf-8', 'replace').strip()
+
+
+def _record_checker(uc, errors=None, taxonomy_map=None):
+    """ Create a ``_RecordChecker`` for the records of a .uc file
+
+        Line numbers of a byte range of a file are counted from the start of
+        the file, which is only read if a line number is reported.
+
+    """
+    line_base = 0
+    if isinstance(uc, _UcRange) and uc.start:
+        line_base = partial(_count_lines, uc.path, uc.start)
+    return _RecordChecker(errors, taxonomy_map, line_base)
+
+
+def _count_lines(path, end, block_size=1 << 24):
+    """ Count the newlines in the first ``end`` bytes of a file """
+    count = 0
+    with open(path, 'rb') as f:
+        while end > 0:
+            block = f.read(min(block_size, end))
+            if not block:
+                break
+            count += block.count(b'\n')
+            end -= len(block)
+    return count
+
+
+def _iter_uc_hits_mmap(uc, stats=None, checker=None, scored=False):
+    """ Iterate over the hit and no-hit records of a uc file on disk
+
+        Parameters
+        ----------
+        uc : str or _UcRange
+            Path to a .uc file, or a byte range of one, as for
+            ``_iter_uc_chunks``.
+        stats : ConsensusStats, optional
+            Statistics to count the bytes and records parsed in.
+        checker : _RecordChecker, optional
+            The error policy to apply to unusable records. By default, the
+            first one raises a ``UcRecordError``.
+        scored : bool, optional
+            Whether to also parse the percent identity of each record.
+
+        Yields
+        ------
+        tuple
+            Query sequence identifier and target sequence identifier of each
+            H record, or query sequence identifier and ``None`` for each N
+            record, and if ``scored``, the percent identity of the record,
+            as yielded by ``_iter_uc_hits``.
+
+    """
+    if checker is None:
+        checker = _record_checker(uc)
+    labels = {}
+    for data in _iter_uc_chunks(uc):
+        scan = _scan_uc_chunk(data, identities=scored, checker=checker)
+        is_hit, queries, target_labels, lines = scan[:3] + scan[-1:]
+        if stats is not None:
+            stats._chunk(len(data), len(is_hit))
+        query_ids, query_index, target_ids, keep = _check_records(
+            is_hit, queries, target_labels, lines, labels, checker)
+        if not scored:
+            for query, target_id in zip(query_index, target_ids):
+                yield query_ids[query], target_id
+            continue
+        identities = scan[3].tolist()
+        if keep is not None:
+            identities = [identities[i] for i in keep]
+        for query, target_id, identity in zip(query_index, target_ids,
+                                              identities):
+            yield query_ids[query], target_id, identity
+
+
+def _check_records(is_hit, queries, target_labels, lines, labels, checker):
+    """ Decode the labels of a block's records, and check their targets
+
+        Parameters
+        ----------
+        is_hit, queries, target_labels, lines : np.ndarray
+            The records of a block, as returned by ``_scan_uc_chunk``.
+        labels : dict
+            Cache of the checked target identifier of each target label,
+            which is shared by the blocks of a file.
+        checker : _RecordChecker
+            The error policy to apply to hits of missing targets.
+
+        Returns
+        -------
+        list of str
+            Distinct query sequence identifiers.
+        list of int
+            Index into the first list of the query of each record.
+        list
+            Target sequence identifier of each record, or ``None`` for N
+            records and, with the ``'unassigned'`` policy, hits of missing
+            targets.
+        list of int or None
+            The records that are kept, if any are skipped, or None. The
+            other lists only hold the records that are kept.
+
+    """
+    # labels are decoded once per block of query records, and each
+    # distinct target is checked once per block, in the order of its first
+    # hit, so that a strict policy raises for the first missing one
+    query_ids, query_index = _decode_runs(queries)
+    hits = np.flatnonzero(is_hit)
+    distinct, inverse = _unique_labels(target_labels[hits])
+    _, first_hits = np.unique(inverse, return_index=True)
+    counts = np.bincount(inverse, minlength=len(distinct)).tolist()
+    distinct_ids = [None] * len(distinct)
+    for i in np.argsort(first_hits).tolist():
+        label = distinct[i]
+        count = counts[i]
+        target_id = labels.get(label, _UNCHECKED)
+        if target_id is _UNCHECKED:
+            record = int(hits[first_hits[i]])
+            target_id = labels[label] = checker.target(
+                label.decode('utf-8'), query_ids[query_index[record]],
+                int(lines[record]))
+            # the first hit of a missing target is counted by the checker
+            count -= 1
+        if (target_id is None or target_id is _SKIP) and count:
+            checker.missing_hits(count)
+        distinct_ids[i] = target_id
+    target_ids = np.full(len(is_hit), None, dtype=object)
+    target_ids[hits] = np.array(distinct_ids, dtype=object)[inverse]
+    target_ids = target_ids.tolist()
+    query_index = query_index.tolist()
+    if not any(target_id is _SKIP for target_id in distinct_ids):
+        return query_ids, query_index, target_ids, None
+    keep = [i for i, target_id in enumerate(target_ids)
+            if target_id is not _SKIP]
+    return (query_ids, [query_index[i] for i in keep],
+            [target_ids[i] for i in keep], keep)
+
+
+def _decode_runs(labels):
+    """ Decode runs of equal labels
+
+        Returns
+        -------
+        list of str
+            The decoded label of each run.
+        np.ndarray of int
+            Index of the run of each label.
+
+    """
+    if len(labels) == 0:
+        return [], np.zeros(0, dtype=np.intp)
+    starts = np.ones(len(labels), dtype=bool)
+    starts[1:] = labels[1:] != labels[:-1]
+    return ([label.decode('utf-8') for label in labels[starts].tolist()],
+            np.cumsum(starts) - 1)
+
+
+def _unique_labels(labels):
+    """ Find the distinct labels of a fixed-width bytes array
+
+        Returns
+        -------
+        list of bytes
+            The distinct labels.
+        np.ndarray of int
+            Index into the distinct labels of each label.
+
+        Notes
+        -----
+        Labels are grouped by a 64-bit hash, which is much faster than
+        sorting them as strings. Each label is checked against the first
+        label with the same hash, and the labels are sorted instead if any
+        hashes collide.
+
+    """
+    if len(labels) == 0:
+        return [], np.zeros(0, dtype=np.intp)
+    if labels.dtype == object:
+        # a block with labels too long to gather
+        distinct, inverse = np.unique(labels, return_inverse=True)
+        return distinct.tolist(), inverse.ravel()
+    columns = labels.view(np.uint8).reshape(len(labels), -1)
+    hashes = np.full(len(labels), 14695981039346656037, dtype=np.uint64)
+    prime = np.uint64(1099511628211)
+    with np.errstate(over='ignore'):
+        for column in columns.T:
+            hashes = (hashes ^ column) * prime
+    _, first, inverse = np.unique(hashes, return_index=True,
+                                  return_inverse=True)
+    inverse = inverse.ravel()
+    distinct = labels[first]
+    if not (distinct[inverse] == labels).all():
+        distinct, inverse = np.unique(labels, return_inverse=True)
+        inverse = inverse.ravel()
+    return distinct.tolist(), inverse
+
+
+def _uc_hit_arrays_mmap(uc, taxonomy_table, stats=None, checker=None,
+                        scored=False):
+    """ Process a uc file on disk into flat arrays of hits
+
+        Parameters
+        ----------
+        uc : str or _UcRange
+            Path to a .uc file, or a byte range of one, as for
+            ``_iter_uc_chunks``.
+        taxonomy_table : TaxonomyTable
+            Taxonomic annotations of the target sequences.
+        stats : ConsensusStats, optional
+            Statistics to count the bytes and records parsed in, and to
+            charge the time spent looking up targets to the lookup stage of.
+        checker : _RecordChecker, optional
+            The error policy to apply to unusable records and to hits of
+            targets that are not in ``taxonomy_table``. By default, the first
+            one raises a ``UcRecordError``.
+        scored : bool, optional
+            Whether to also parse the percent identity of each hit.
+
+        Returns
+        -------
+        tuple
+            Query identifiers, query index of each hit, lineage node
+            identifier of each hit and, if ``scored``, percent identity of
+            each hit, as returned by ``_uc_to_hit_arrays``.
+
+    """
+    if checker is None:
+        checker = _record_checker(uc)
+    query_ids = []
+    query_indices = {}
+    target_nodes = {}
+    query_index = []
+    nodes = []
+    identities = []
+    for data in _iter_uc_chunks(uc):
+        scan = _scan_uc_chunk(data, identities=scored, checker=checker)
+        is_hit, queries, targets, lines = scan[:3] + scan[-1:]
+        block_identities = scan[3] if scored else None
+        if stats is not None:
+            stats._chunk(len(data), len(is_hit))
+
+        # look up each distinct target once, and the targets that are new
+        # in this block together
+        if stats is not None:
+            stats._switch('lookup')
+        hits = np.flatnonzero(is_hit)
+        labels, inverse = _unique_labels(targets[hits])
+        new_labels = [label for label in labels if label not in target_nodes]
+        if new_labels:
+            try:
+                target_nodes.update(zip(new_labels, taxonomy_table.nodes(
+                    [label.decode('utf-8') for label in new_labels])))
+            except KeyError:
+                _check_new_targets(new_labels, labels, inverse, hits,
+                                   queries, lines, taxonomy_table,
+                                   target_nodes, checker)
+        label_nodes = np.array([target_nodes[label] for label in labels],
+                               dtype=np.intc)
+        block_nodes = np.zeros(len(is_hit), dtype=np.intc)
+        block_nodes[hits] = label_nodes[inverse]
+        if len(label_nodes) and label_nodes.min() < 0:
+            block_nodes, queries, block_identities = _apply_missing_targets(
+                block_nodes, queries, block_identities, checker)
+        nodes.append(block_nodes)
+        if scored:
+            identities.append(block_identities)
+        if stats is not None:
+            stats._switch('parse')
+
+        run_ids, runs = _decode_runs(queries)
+        # the first query may continue from the previous block
+        continued = int(bool(run_ids) and run_ids[0] in query_indices)
+        new_ids = run_ids[continued:]
+        if (query_indices.keys().isdisjoint(new_ids) and
+                len(set(new_ids)) == len(new_ids)):
+            # every other query is seen for the first time, which is the
+            # usual case for input that is grouped by query
+            run_index = np.arange(len(query_ids) - continued,
+                                  len(query_ids) + len(new_ids))
+            if continued:
+                run_index[0] = query_indices[run_ids[0]]
+            query_indices.update(zip(new_ids, run_index[continued:].tolist()))
+            query_ids.extend(new_ids)
+        else:
+            run_index = np.empty(len(run_ids), dtype=np.intp)
+            for i, query_id in enumerate(run_ids):
+                index = query_indices.get(query_id)
+                if index is None:
+                    index = query_indices[query_id] = len(query_ids)
+                    query_ids.append(query_id)
+                run_index[i] = index
+        query_index.append(run_index[runs].astype(np.intc))
+    if not nodes:
+        result = ([], np.zeros(0, dtype=np.intc), np.zeros(0, dtype=np.intc))
+        return result + (np.zeros(0),) if scored else result
+    result = (query_ids, np.concatenate(query_index), np.concatenate(nodes))
+    if scored:
+        result += (np.concatenate(identities),)
+    return result
+
+
+# node identifiers of missing targets, whose hits are skipped or unassigned
+_SKIPPED_NODE, _UNASSIGNED_NODE = -1, -2
+
+
+def _check_new_targets(new_labels, labels, inverse, hits, queries, lines,
+                       taxonomy_table, target_nodes, checker):
+    """ Look up targets one by one, applying the error policy to missing
+        ones, which are given a negative node identifier
+    """
+    label_index = {label: i for i, label in enumerate(labels)}
+    missing = []
+    for label in new_labels:
+        try:
+            target_nodes[label] = taxonomy_table.node(label.decode('utf-8'))
+        except KeyError:
+            # the first hit of the target in this block
+            missing.append((hits[np.argmax(inverse == label_index[label])],
+                            label))
+    # in file order, so that a strict policy reports the first one
+    for hit, label in sorted(missing):
+        result = checker.missing(label.decode('utf-8'),
+                                 queries[hit].decode('utf-8'),
+                                 int(lines[hit]), count=0)
+        target_nodes[label] = (_SKIPPED_NODE if result is _SKIP else
+                               _UNASSIGNED_NODE)
+
+
+def _apply_missing_targets(block_nodes, queries, identities, checker):
+    """ Count the hits of missing targets, and unassign or drop them, along
+        with their identities if they are given
+    """
+    missing = block_nodes < 0
+    checker.missing_hits(int(missing.sum()))
+    block_nodes[block_nodes == _UNASSIGNED_NODE] = 0
+    keep = block_nodes != _SKIPPED_NODE
+    if identities is not None:
+        identities = identities[keep]
+    return block_nodes[keep], queries[keep], identities
@@ -0,0 +1,293 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from __future__ import division
+
+import numpy as np
+
+
+def _ancestor_matrix(nodes, taxonomy_table):
+    """ Expand lineage node identifiers into their paths
+
+        Parameters
+        ----------
+        nodes : np.ndarray of int
+            Lineage node identifiers.
+        taxonomy_table : TaxonomyTable
+            The table that the node identifiers refer to.
+
+        Returns
+        -------
+        np.ndarray of int
+            Array of shape ``(len(nodes), max_depth)``, where row ``i`` is
+            ``taxonomy_table.path(nodes[i])`` padded with ``-1``.
+
+    """
+    parents = np.frombuffer(taxonomy_table.parents, dtype=np.intc)
+    depths = np.frombuffer(taxonomy_table.depths, dtype=np.uint16)
+    nodes = np.asarray(nodes, dtype=np.intc)
+    node_depths = depths[nodes].astype(np.intp)
+    max_depth = int(node_depths.max()) if len(nodes) else 0
+    result = np.full((len(nodes), max_depth), -1, dtype=np.intc)
+    rows = np.flatnonzero(node_depths > 0)
+    columns = node_depths[rows] - 1
+    current = nodes[rows]
+    # walk all hits up the tree together, filling each path from its end
+    while len(rows):
+        result[rows, columns] = current
+        keep = columns > 0
+        rows, columns = rows[keep], columns[keep] - 1
+        current = parents[current[keep]]
+    return result
+
+
+def _batch_consensus(query_index, ancestors, n_queries,
+                     min_consensus_fraction, weights=None):
+    """ Compute the consensus of many queries' hits at once
+
+        This is a vectorized equivalent of calling
+        ``_compute_consensus_annotation`` on each query. The majority
+        lineage of each query is found with ``_batch_majority``, and the
+        consensus is its deepest rank that at least
+        ``min_consensus_fraction`` of the hits agree with.
+
+        Parameters
+        ----------
+        query_index : np.ndarray of int
+            Index of the query of each hit, in ``range(n_queries)``.
+        ancestors : np.ndarray of int
+            Array of shape ``(n_hits, max_depth)`` holding the lineage node
+            identifier of each hit at each rank, padded with ``-1`` (see
+            ``_ancestor_matrix``).
+        n_queries : int
+            The number of queries.
+        min_consensus_fraction : float
+            The minimum fraction of the annotations that a specfic annotation
+            must be present in for that annotation to be accepted. This must
+            be greater than or equal to 0.51.
+        weights : np.ndarray of float, optional
+            The vote of each hit, such as its percent identity. By default
+            each hit has one vote.
+
+        Returns
+        -------
+        np.ndarray of int
+            Consensus node identifier of each query, or the root node if
+            there is no acceptable assignment.
+        np.ndarray of float
+            Consensus fraction of each query.
+        np.ndarray of int
+            Number of hits of each query.
+
+        Raises
+        ------
+        ValueError
+            If min_consensus_fraction <= 0.50.
+
+    """
+    if min_consensus_fraction <= 0.5:
+        raise ValueError("min_consensus_fraction must be greater than 0.5.")
+    rank_nodes, rank_fractions, n_hits = _batch_majority(
+        query_index, ancestors, n_queries, weights)
+    consensus_nodes, consensus_fractions = _rank_consensus(
+        rank_nodes, rank_fractions, min_consensus_fraction)
+    return consensus_nodes, consensus_fractions, n_hits
+
+
+def _batch_majority(query_index, ancestors, n_queries, weights=None):
+    """ Find the lineage that a majority of each query's hits agree with
+
+        At each level, hits are grouped by query and lineage prefix, and the
+        most common prefix of each query is found with a sort. Queries stop
+        at the first level where no prefix is held by more than half of
+        their hits, or at the depth of their shallowest hit. With
+        ``weights``, prefixes are compared by the total weight of their hits
+        rather than by their number, and queries whose hits have no weight
+        have no majority lineage.
+
+        Parameters are as for ``_batch_consensus``.
+
+        Returns
+        -------
+        np.ndarray of int
+            Array of shape ``(n_queries, max_depth)`` holding the majority
+            lineage node identifier of each query at each rank, padded with
+            ``-1``.
+        np.ndarray of float
+            Array of the same shape holding the fraction of each query's
+            hits (or of their weight) that agree with its majority lineage
+            at each rank, padded with NaN. The fractions of a query never
+            increase with depth.
+        np.ndarray of int
+            Number of hits of each query.
+
+        Notes
+        -----
+        As ``min_consensus_fraction`` is greater than 0.5, the consensus at
+        any threshold only accepts majority prefixes, and it stops at the
+        first rank whose fraction is below the threshold, so it is a prefix
+        of the majority lineage. Consensus at several thresholds can thus
+        be derived from one majority lineage with ``_rank_consensus``.
+
+    """
+    query_index = np.asarray(query_index, dtype=np.int64)
+    ancestors = np.asarray(ancestors)
+    n_hits = np.bincount(query_index, minlength=n_queries)
+    max_depth = ancestors.shape[1] if ancestors.ndim == 2 else 0
+    rank_nodes = np.full((n_queries, max_depth), -1, dtype=np.int64)
+    rank_fractions = np.full((n_queries, max_depth), np.nan)
+    if len(query_index) == 0 or max_depth == 0:
+        return rank_nodes, rank_fractions, n_hits
+
+    # as in _compute_consensus_annotation, the result is no deeper than the
+    # shallowest annotation of the query
+    hit_depths = (ancestors >= 0).sum(axis=1)
+    min_depths = np.full(n_queries, max_depth, dtype=np.int64)
+    np.minimum.at(min_depths, query_index, hit_depths)
+    totals = n_hits
+    if weights is not None:
+        query_index, ancestors, weights = _merge_weights(
+            query_index, ancestors, hit_depths,
+            np.asarray(weights, dtype=np.float64))
+        totals = np.bincount(query_index, weights=weights,
+                             minlength=n_queries)
+        # hits without any weight can't support an assignment
+        min_depths[totals == 0] = 0
+    # node identifiers are unique per lineage prefix, so (query, node)
+    # pairs can be packed into a single sortable key
+    key_base = int(ancestors.max()) + 1
+
+    hits = np.flatnonzero(min_depths[query_index] > 0)
+    for level in range(max_depth):
+        if len(hits) == 0:
+            break
+        queries = query_index[hits]
+        keys = queries * key_base + ancestors[hits, level]
+        if weights is None:
+            keys, counts = np.unique(keys, return_counts=True)
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=weights[hits])
+        key_queries = keys // key_base
+        # keys are sorted by query, so ordering by (query, -count) puts the
+        # most common prefix of each query first
+        order = np.lexsort((-counts, key_queries))
+        key_queries = key_queries[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = key_queries[1:] != key_queries[:-1]
+        best = order[first]
+        best_queries = key_queries[first]
+        fractions = counts[best] / totals[best_queries]
+        majority = fractions > 0.5
+        majority_queries = best_queries[majority]
+        rank_nodes[majority_queries, level] = keys[best][majority] % key_base
+        rank_fractions[majority_queries, level] = fractions[majority]
+
+        # only the hits that agree with the majority prefix can continue it
+        continuing = np.zeros(n_queries, dtype=bool)
+        continuing[majority_queries] = min_depths[majority_queries] > level + 1
+        hits = hits[continuing[queries]]
+        hits = hits[ancestors[hits, level] ==
+                    rank_nodes[query_index[hits], level]]
+    return rank_nodes, rank_fractions, n_hits
+
+
+def _merge_weights(query_index, ancestors, hit_depths, weights):
+    """ Sum the weights of each query's hits of each lineage
+
+        The merged lineages of a query are in the order they are first hit,
+        and their weights are summed in the order of the hits, as in
+        ``_weight_sums``, so that the fractions are the same as those of the
+        query by query computation.
+
+        Returns
+        -------
+        tuple
+            Query index, ancestor matrix row and total weight of each
+            distinct (query, lineage) pair.
+
+    """
+    rows = np.arange(len(query_index))
+    leaves = np.where(hit_depths > 0,
+                      ancestors[rows, np.maximum(hit_depths - 1, 0)], -1)
+    keys = query_index * (int(ancestors.max()) + 2) + leaves + 1
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=weights)
+    order = np.argsort(first, kind='stable')
+    first = first[order]
+    return query_index[first], ancestors[first], sums[order]
+
+
+def _top_hits(query_index, identities, max_hits):
+    """ Select the hits with the highest percent identities of each query
+
+        This is a vectorized equivalent of adding each query's hits to a
+        ``_TopHits``.
+
+        Parameters
+        ----------
+        query_index : np.ndarray of int
+            Index of the query of each hit.
+        identities : np.ndarray of float
+            Percent identity of each hit.
+        max_hits : int
+            The maximum number of hits to keep per query.
+
+        Returns
+        -------
+        np.ndarray of int
+            Indices of the kept hits, in their original order. Of hits with
+            equal identities, the earlier ones are kept.
+
+    """
+    n = len(query_index)
+    # order by query, then by decreasing identity, then by position
+    order = np.lexsort((np.arange(n), -np.asarray(identities),
+                        query_index))
+    queries = np.asarray(query_index)[order]
+    starts = np.ones(n, dtype=bool)
+    starts[1:] = queries[1:] != queries[:-1]
+    starts = np.flatnonzero(starts)
+    ranks = np.arange(n) - np.repeat(starts, np.diff(np.append(starts, n)))
+    return np.sort(order[ranks < max_hits])
+
+
+def _rank_consensus(rank_nodes, rank_fractions, min_consensus_fraction):
+    """ Cut majority lineages at a consensus threshold
+
+        Parameters
+        ----------
+        rank_nodes, rank_fractions : np.ndarray
+            The majority lineages and their fractions, as returned by
+            ``_batch_majority``.
+        min_consensus_fraction : float
+            The minimum consensus fraction, greater than 0.5.
+
+        Returns
+        -------
+        np.ndarray of int
+            Consensus node identifier of each query, or the root node if
+            there is no acceptable assignment.
+        np.ndarray of float
+            Consensus fraction of each query, or 1.0 for the root node.
+
+    """
+    n_queries = len(rank_nodes)
+    consensus_nodes = np.zeros(n_queries, dtype=np.int64)
+    consensus_fractions = np.ones(n_queries, dtype=np.float64)
+    if rank_nodes.shape[1] == 0:
+        return consensus_nodes, consensus_fractions
+    # the fractions never increase with depth, so the accepted ranks are a
+    # prefix of each lineage. NaN padding is never accepted.
+    with np.errstate(invalid='ignore'):
+        depths = (rank_fractions >= min_consensus_fraction).sum(axis=1)
+    rows = np.flatnonzero(depths)
+    consensus_nodes[rows] = rank_nodes[rows, depths[rows] - 1]
+    consensus_fractions[rows] = rank_fractions[rows, depths[rows] - 1]
+    return consensus_nodes, consensus_fractions
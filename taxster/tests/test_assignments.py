@@ -0,0 +1,135 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import pickle
+from unittest import TestCase, main
+
+import numpy as np
+
+from taxster import (ConsensusAssignments, TaxonomyTable,
+                     uc_consensus_assignments)
+from taxster.tests.test_uc import uc1
+
+
+class ConsensusAssignmentsTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.table = TaxonomyTable(self.id_to_taxonomy)
+        self.expected = {'q3': (['x'], 1.0, 1),
+                         'q2': (['A', 'H', 'I', 'J'], 2. / 3., 3),
+                         'q1': (['A', 'B', 'C'], 1.0, 2)}
+        self.assignments = ConsensusAssignments(
+            ['q3', 'q2', 'q1'], self.table,
+            [TaxonomyTable.root, self.table.node('r3'),
+             self.table.path(self.table.node('r2'))[2]],
+            [1.0, 2. / 3., 1.0], [1, 3, 2], 'x')
+
+    def test_mapping(self):
+        assignments = self.assignments
+        self.assertEqual(len(assignments), 3)
+        self.assertEqual(list(assignments), ['q3', 'q2', 'q1'])
+        self.assertEqual(assignments['q2'], (['A', 'H', 'I', 'J'], 2. / 3., 3))
+        self.assertEqual(assignments.get('q4'), None)
+        self.assertRaises(KeyError, assignments.__getitem__, 'q4')
+        self.assertTrue('q1' in assignments)
+        self.assertFalse('q4' in assignments)
+        self.assertEqual(list(assignments.items()),
+                         [(q, self.expected[q]) for q in ['q3', 'q2', 'q1']])
+        self.assertEqual(list(assignments.values()),
+                         [self.expected[q] for q in ['q3', 'q2', 'q1']])
+        self.assertEqual(assignments, self.expected)
+        self.assertEqual(dict(assignments), self.expected)
+        self.assertNotEqual(assignments, {'q1': (['A'], 1.0, 2)})
+        self.assertEqual(repr(assignments), 'ConsensusAssignments(queries=3)')
+
+    def test_arrays(self):
+        assignments = self.assignments
+        self.assertEqual(assignments.query_ids, ['q3', 'q2', 'q1'])
+        self.assertTrue(assignments.taxonomy_table is self.table)
+        self.assertEqual(assignments.nodes.dtype, np.intc)
+        self.assertEqual(assignments.n_hits.dtype, np.uint32)
+        self.assertEqual(assignments.n_hits.tolist(), [1, 3, 2])
+        self.assertEqual(assignments.fractions.tolist(), [1.0, 2. / 3., 1.0])
+        self.assertEqual(assignments.unassignable_label, 'x')
+        self.assertRaises(ValueError, ConsensusAssignments, ['q1'],
+                          self.table, [0, 0], [1.0], [1])
+
+    def test_annotations_are_copies(self):
+        self.assignments['q1'][0].append('D')
+        next(iter(self.assignments.values()))[0].append('y')
+        self.assertEqual(self.assignments, self.expected)
+
+    def test_pickle(self):
+        self.assertTrue('q1' in self.assignments)
+        assignments = pickle.loads(pickle.dumps(self.assignments))
+        self.assertEqual(assignments, self.expected)
+        self.assertEqual(assignments.unassignable_label, 'x')
+
+    def test_from_tuples(self):
+        assignments = ConsensusAssignments._from_tuples(
+            [(q, a, f, n) for q, (a, f, n) in self.expected.items()], 'x')
+        self.assertEqual(assignments, self.expected)
+        # only the consensus lineages are interned, and unassigned queries
+        # are stored as the root
+        self.assertEqual(assignments.taxonomy_table.n_nodes, 7)
+        self.assertEqual(assignments.nodes[0], TaxonomyTable.root)
+
+    def test_nodes_match_across_taxonomy_maps(self):
+        # dicts are assigned from tuples, and tables from node identifiers
+        expected = uc_consensus_assignments(io.StringIO(uc1), self.table)
+        for taxonomy_map in (self.id_to_taxonomy, self.table):
+            for params in [{}, {'max_hits': 3}]:
+                actual = uc_consensus_assignments(io.StringIO(uc1),
+                                                  taxonomy_map, **params)
+                self.assertEqual(actual, expected)
+                self.assertEqual(
+                    [actual.taxonomy_table.lineage(n) for n in actual.nodes],
+                    [expected.taxonomy_table.lineage(n)
+                     for n in expected.nodes])
+
+    def test_detach(self):
+        detached = self.assignments._detach()
+        self.assertEqual(detached, self.expected)
+        self.assertFalse(detached.taxonomy_table is self.table)
+        self.assertEqual(detached.taxonomy_table.n_nodes, 7)
+        self.assertTrue(len(pickle.dumps(detached)) <
+                        len(pickle.dumps(self.assignments)))
+
+    def test_concatenate(self):
+        first = ConsensusAssignments._from_tuples(
+            [('q1', ['A', 'B', 'C'], 1.0, 2)], 'x')
+        second = self.assignments
+        concatenated = ConsensusAssignments._concatenate([second, first],
+                                                         'x')
+        self.assertEqual(concatenated,
+                         dict(self.expected, q1=(['A', 'B', 'C'], 1.0, 2)))
+        self.assertEqual(concatenated.query_ids, ['q3', 'q2', 'q1', 'q1'])
+        same_table = ConsensusAssignments._concatenate([second, second], 'x')
+        self.assertTrue(same_table.taxonomy_table is self.table)
+        self.assertEqual(len(same_table), 6)
+        empty = ConsensusAssignments._concatenate([], 'x')
+        self.assertEqual(empty, {})
+
+    def test_returned_by_uc_consensus_assignments(self):
+        for taxonomy_map in (self.id_to_taxonomy, self.table):
+            actual = uc_consensus_assignments(io.StringIO(uc1), taxonomy_map)
+            self.assertTrue(isinstance(actual, ConsensusAssignments))
+            self.assertEqual(actual['q2'], (['A', 'H', 'I', 'J'], 2. / 3., 3))
+        actual = uc_consensus_assignments(io.StringIO(uc1), self.table)
+        self.assertTrue(actual.taxonomy_table is self.table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, main
+
+from taxster import (TaxonomyTable, aiter_uc_consensus_assignments,
+                     iter_uc_consensus_assignments)
+from taxster._async import _complete_queries_end
+from taxster.tests.test_uc import uc1, uc_many_queries, uc_ungrouped
+
+
+class AiterUcConsensusAssignmentsTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.data = (uc1 + uc_many_queries).encode('utf-8')
+
+    def _collect(self, stream, *args, **kwargs):
+        async def collect():
+            return [a async for a in aiter_uc_consensus_assignments(
+                await stream() if callable(stream) else stream,
+                *args, **kwargs)]
+        return asyncio.run(collect())
+
+    def _reader(self, data):
+        async def reader():
+            stream = asyncio.StreamReader()
+            stream.feed_data(data)
+            stream.feed_eof()
+            return stream
+        return reader
+
+    def _expected(self, *params):
+        return list(iter_uc_consensus_assignments(
+            io.StringIO(self.data.decode('utf-8')), *params))
+
+    def test_stream_reader(self):
+        for taxonomy_map in (self.id_to_taxonomy,
+                             TaxonomyTable(self.id_to_taxonomy)):
+            for batch_size in (1, 7, 100, 1 << 20):
+                actual = self._collect(self._reader(self.data), taxonomy_map,
+                                       batch_size=batch_size)
+                self.assertEqual(actual, self._expected(taxonomy_map))
+
+    def test_async_iterable(self):
+        async def blocks():
+            for i in range(0, len(self.data), 50):
+                yield self.data[i:i + 50]
+        with ThreadPoolExecutor(2) as executor:
+            actual = self._collect(blocks(), self.id_to_taxonomy, 1.0, 'x',
+                                   executor=executor, max_pending_batches=1)
+        self.assertEqual(actual, self._expected(self.id_to_taxonomy, 1.0,
+                                                'x'))
+
+    def test_batch_size(self):
+        data = b''.join(b'H\tr%d\t1\t1\t+\t0\t0\t1M\tq%d\tr%d\n'
+                        % (i % 5 + 1, i, i % 5 + 1) for i in range(2000))
+        batches = []
+
+        class Executor(ThreadPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                batches.append(args[0])
+                return super(Executor, self).submit(fn, *args, **kwargs)
+
+        async def blocks():
+            for i in range(0, len(data), 50):
+                yield data[i:i + 50]
+        for batch_size in (1000, 1 << 20):
+            del batches[:]
+            with Executor(2) as executor:
+                actual = self._collect(blocks(), self.id_to_taxonomy,
+                                       executor=executor,
+                                       batch_size=batch_size)
+            self.assertEqual(b''.join(batches), data)
+            # small blocks are collected into batches of about batch_size
+            self.assertLessEqual(len(batches), len(data) // batch_size + 2)
+            self.assertTrue(all(len(batch) > batch_size - 200
+                                for batch in batches[:-1]))
+            self.assertEqual(len(actual), 2000)
+
+    def test_large_query(self):
+        # a query whose records span several batches is kept whole
+        data = (b'H\tr1\t1\t1\t+\t0\t0\t1M\tq1\tr1\n' * 1000 +
+                b'H\tr2\t1\t1\t+\t0\t0\t1M\tq2\tr2\n')
+
+        async def blocks():
+            for i in range(0, len(data), 64):
+                yield data[i:i + 64]
+        self.assertEqual(self._collect(blocks(), self.id_to_taxonomy,
+                                       batch_size=100),
+                         [('q1', ['A', 'F', 'G'], 1.0, 1000),
+                          ('q2', ['A', 'B', 'C', 'D'], 1.0, 1)])
+
+    def test_no_trailing_newline(self):
+        actual = self._collect(self._reader(self.data.rstrip(b'\n')),
+                               self.id_to_taxonomy)
+        self.assertEqual(actual, self._expected(self.id_to_taxonomy))
+
+    def test_line_boundaries(self):
+        # characters that str.splitlines splits at are part of labels
+        self.data = (u'H\tr1\t1\t1\t+\t0\t0\t1M\tq1\x0bx\tr1\n'
+                     u'H\tr2\t1\t1\t+\t0\t0\t1M\tq1\x1c\tr2\x85\n'
+                     u'N\t*\t1\t*\t*\t*\t*\t*\tq2\u2028\t*\r\n'
+                     u'H\tr3\t1\t1\t+\t0\t0\t1M\tq3\tr3\n').encode('utf-8')
+        actual = self._collect(self._reader(self.data), self.id_to_taxonomy)
+        self.assertEqual(actual, self._expected(self.id_to_taxonomy))
+        self.assertEqual([a[0] for a in actual], ['q1', 'q2', 'q3'])
+
+    def test_empty(self):
+        self.assertEqual(self._collect(self._reader(b''),
+                                       self.id_to_taxonomy), [])
+
+    def test_ungrouped_input(self):
+        data = uc_ungrouped.encode('utf-8')
+        for batch_size in (1, 1 << 20):
+            self.assertRaises(ValueError, self._collect, self._reader(data),
+                              self.id_to_taxonomy, batch_size=batch_size)
+
+    def test_invalid_parameters(self):
+        self.assertRaises(ValueError, self._collect, self._reader(self.data),
+                          self.id_to_taxonomy, 0.5)
+        self.assertRaises(ValueError, self._collect, self._reader(self.data),
+                          self.id_to_taxonomy, max_pending_batches=0)
+
+    def test_concurrent(self):
+        taxonomy_map = TaxonomyTable(self.id_to_taxonomy)
+
+        async def run():
+            async def one():
+                return [a async for a in aiter_uc_consensus_assignments(
+                    await self._reader(self.data)(), taxonomy_map,
+                    batch_size=100)]
+            return await asyncio.gather(*[one() for _ in range(8)])
+        expected = self._expected(taxonomy_map)
+        for actual in asyncio.run(run()):
+            self.assertEqual(actual, expected)
+
+    def test_stop_early(self):
+        read = []
+
+        async def blocks():
+            for i in range(0, len(self.data), 10):
+                read.append(i)
+                yield self.data[i:i + 10]
+
+        async def first():
+            assignments = aiter_uc_consensus_assignments(
+                blocks(), self.id_to_taxonomy, batch_size=100,
+                max_pending_batches=1)
+            result = await assignments.__anext__()
+            await assignments.aclose()
+            return result
+        self.assertEqual(asyncio.run(first()),
+                         self._expected(self.id_to_taxonomy)[0])
+        # backpressure stopped reading long before the end of the stream
+        self.assertTrue(len(read) < len(self.data) // 10)
+
+    def test_complete_queries_end(self):
+        data = (b'H\tr1\t1\t1\t+\t0\t0\t1M\tq1\tr1\n'
+                b'H\tr2\t1\t1\t+\t0\t0\t1M\tq1 x\tr2\n'
+                b'# comment\n'
+                b'H\tr1\t1\t1\t+\t0\t0\t1M\tq2\tr1\n'
+                b'H\tr1\t1\t1\t+\t0\t0\t1M\tq3')
+        self.assertEqual(_complete_queries_end(data),
+                         data.index(b'# comment'))
+        self.assertEqual(_complete_queries_end(data[:data.index(b'# ')]), 0)
+        self.assertEqual(_complete_queries_end(b''), 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from taxster import (ConsensusCache, TaxonomyTable, load_taxonomy_map,
+                     uc_consensus_assignments, iter_uc_consensus_assignments)
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+
+class ConsensusCacheTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_matches_uncached(self):
+        for taxonomy_map in (self.id_to_taxonomy,
+                             TaxonomyTable(self.id_to_taxonomy)):
+            for params in [(), (1.0, 'x')]:
+                cache = ConsensusCache()
+                expected = uc_consensus_assignments(
+                    io.StringIO(uc1 + uc_many_queries), taxonomy_map,
+                    *params)
+                actual = uc_consensus_assignments(
+                    io.StringIO(uc1 + uc_many_queries), taxonomy_map,
+                    *params, cache=cache)
+                self.assertEqual(actual, expected)
+                expected = list(iter_uc_consensus_assignments(
+                    io.StringIO(uc1 + uc_many_queries), taxonomy_map,
+                    *params))
+                actual = list(iter_uc_consensus_assignments(
+                    io.StringIO(uc1 + uc_many_queries), taxonomy_map,
+                    *params, cache=cache))
+                self.assertEqual(actual, expected)
+
+    def test_statistics(self):
+        cache = ConsensusCache()
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 self.id_to_taxonomy, cache=cache)
+        # uc_many_queries has 40 queries with 6 distinct sets of hits
+        self.assertEqual((cache.misses, cache.hits), (6, 34))
+        self.assertEqual(len(cache), 6)
+        self.assertAlmostEqual(cache.hit_rate, 34 / 40)
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 self.id_to_taxonomy, cache=cache)
+        self.assertEqual((cache.misses, cache.hits), (6, 74))
+        # the parameters are part of the key
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 self.id_to_taxonomy, 1.0, cache=cache)
+        self.assertEqual((cache.misses, cache.hits), (12, 108))
+        cache.clear()
+        self.assertEqual((len(cache), cache.misses, cache.hits), (0, 0, 0))
+
+    def test_hit_order(self):
+        uc = (u"H\tr2\t1\t99.0\t+\t0\t0\t1M\tq1\tr2\n"
+              u"H\tr4\t1\t99.0\t+\t0\t0\t1M\tq1\tr4\n"
+              u"H\tr4\t1\t99.0\t+\t0\t0\t1M\tq2\tr4\n"
+              u"H\tr2\t1\t99.0\t+\t0\t0\t1M\tq2\tr2\n"
+              u"H\tr4\t1\t99.0\t+\t0\t0\t1M\tq3\tr4\n"
+              u"H\tr4\t1\t99.0\t+\t0\t0\t1M\tq3\tr4\n")
+        cache = ConsensusCache()
+        actual = uc_consensus_assignments(io.StringIO(uc),
+                                          self.id_to_taxonomy, cache=cache)
+        self.assertEqual(actual['q2'], (['A', 'B', 'C'], 1.0, 2))
+        self.assertEqual(actual['q3'], (['A', 'B', 'C', 'E'], 1.0, 2))
+        self.assertEqual((cache.misses, cache.hits), (2, 1))
+
+    def test_lru_eviction(self):
+        cache = ConsensusCache(maxsize=2)
+        results = iter(['a', 'b', 'c', 'd'])
+
+        def compute():
+            return [next(results)], 1.0
+
+        self.assertEqual(cache.consensus(['r1'], 0.51, 'x', compute),
+                         (['a'], 1.0))
+        cache.consensus(['r2'], 0.51, 'x', compute)
+        # r1 becomes the most recently used, so r2 is evicted
+        cache.consensus(['r1'], 0.51, 'x', compute)
+        cache.consensus(['r3'], 0.51, 'x', compute)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.consensus(['r1'], 0.51, 'x', compute),
+                         (['a'], 1.0))
+        self.assertEqual(cache.consensus(['r2'], 0.51, 'x', compute),
+                         (['d'], 1.0))
+        self.assertEqual(len(cache), 2)
+
+    def test_invalid_maxsize(self):
+        self.assertRaises(ValueError, ConsensusCache, maxsize=0)
+
+    def test_cached_result_is_a_copy(self):
+        cache = ConsensusCache()
+        first = uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                         self.id_to_taxonomy, cache=cache)
+        first['m0'][0].append('modified')
+        second = uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                          self.id_to_taxonomy, cache=cache)
+        self.assertEqual(second['m0'][0], ['A', 'F', 'G'])
+
+    def test_persistence(self):
+        path = os.path.join(self.temp_dir, 'consensus.cache')
+        cache = ConsensusCache(path=path)
+        expected = uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                            self.id_to_taxonomy, cache=cache)
+        self.assertTrue(os.path.exists(path))
+        cache = ConsensusCache(path=path)
+        actual = uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                          self.id_to_taxonomy, cache=cache)
+        self.assertEqual(actual, expected)
+        self.assertEqual((cache.misses, cache.hits), (0, 40))
+
+    def test_persistence_with_different_taxonomy(self):
+        path = os.path.join(self.temp_dir, 'consensus.cache')
+        cache = ConsensusCache(path=path)
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 self.id_to_taxonomy, cache=cache)
+        self.id_to_taxonomy['r1'] = ['A', 'F', 'X']
+        cache = ConsensusCache(path=path)
+        actual = uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                          self.id_to_taxonomy, cache=cache)
+        self.assertEqual(cache.hits, 34)
+        self.assertEqual(actual['m0'][0], ['A', 'F', 'X'])
+
+    def test_persistence_with_loaded_taxonomy(self):
+        tax_path = os.path.join(self.temp_dir, 'tax-map.tsv')
+        with open(tax_path, 'w') as f:
+            for reference_id, lineage in sorted(self.id_to_taxonomy.items()):
+                f.write('%s\t%s\n' % (reference_id, '; '.join(lineage)))
+        path = os.path.join(self.temp_dir, 'consensus.cache')
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 load_taxonomy_map(tax_path),
+                                 cache=ConsensusCache(path=path))
+        cache = ConsensusCache(path=path)
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 load_taxonomy_map(tax_path), cache=cache)
+        self.assertEqual(cache.hits, 40)
+
+    def test_rebinding_clears_entries(self):
+        cache = ConsensusCache()
+        uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                 self.id_to_taxonomy, cache=cache)
+        other = dict(self.id_to_taxonomy, r1=['A', 'F', 'X'])
+        actual = uc_consensus_assignments(io.StringIO(uc_many_queries),
+                                          other, cache=cache)
+        self.assertEqual(actual['m0'][0], ['A', 'F', 'X'])
+
+    def test_requires_serial(self):
+        path = os.path.join(self.temp_dir, 'in.uc')
+        with open(path, 'w') as f:
+            f.write(uc1)
+        self.assertRaises(ValueError, uc_consensus_assignments, path,
+                          self.id_to_taxonomy, n_jobs=2,
+                          cache=ConsensusCache())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+
+from taxster import (iter_uc_consensus_assignments,
+                     write_uc_consensus_assignments)
+from taxster._cli import main as cli_main
+from taxster._export import _TSV_HEADER, _TSV_ROW
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+
+class UcConsensusCommandTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+        self.tax_path = os.path.join(self.temp_dir, 'tax-map.tsv')
+        with open(self.tax_path, 'w') as f:
+            for reference_id, lineage in sorted(self.id_to_taxonomy.items()):
+                f.write('%s\t%s\n' % (reference_id, '; '.join(lineage)))
+        self.uc_path = os.path.join(self.temp_dir, 'in.uc')
+        with open(self.uc_path, 'w') as f:
+            f.write(uc1 + uc_many_queries)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _run(self, args, stdin=u''):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch('sys.stdin', io.StringIO(stdin)), \
+                mock.patch('sys.stdout', stdout), \
+                mock.patch('sys.stderr', stderr):
+            try:
+                status = cli_main(args)
+            except SystemExit as e:
+                status = e.code
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def _expected(self, *params):
+        out = io.StringIO()
+        write_uc_consensus_assignments(io.StringIO(uc1 + uc_many_queries),
+                                       self.id_to_taxonomy, out, *params)
+        return out.getvalue()
+
+    def test_path(self):
+        status, stdout, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path, self.uc_path])
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, self._expected())
+        self.assertEqual(stderr, '')
+        self.assertTrue(os.path.exists(self.tax_path + '.taxster-cache'))
+
+    def test_stdin(self):
+        status, stdout, _ = self._run(
+            ['uc-consensus', '-t', self.tax_path, '-f', '1.0', '-u', 'x'],
+            stdin=uc1 + uc_many_queries)
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, self._expected(1.0, 'x'))
+
+    def test_output_file(self):
+        out_path = os.path.join(self.temp_dir, 'out.tsv')
+        status, stdout, _ = self._run(
+            ['uc-consensus', '-t', self.tax_path, '-o', out_path,
+             self.uc_path])
+        self.assertEqual((status, stdout), (0, ''))
+        with open(out_path) as f:
+            self.assertEqual(f.read(), self._expected())
+
+    def test_jobs(self):
+        status, stdout, _ = self._run(
+            ['uc-consensus', '-t', self.tax_path, '-j', '2', self.uc_path])
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, self._expected())
+        status, _, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path, '-j', '2', '-'])
+        self.assertEqual(status, 1)
+        self.assertIn('--jobs requires', stderr)
+
+    def test_max_hits_weighted(self):
+        expected = _TSV_HEADER + ''.join(
+            _TSV_ROW % (query_id, '; '.join(taxonomy), fraction, n_hits)
+            for query_id, taxonomy, fraction, n_hits in
+            iter_uc_consensus_assignments(
+                io.StringIO(uc1 + uc_many_queries), self.id_to_taxonomy,
+                max_hits=2, weighted=True))
+        for jobs in ('1', '2'):
+            status, stdout, _ = self._run(
+                ['uc-consensus', '-t', self.tax_path, '-n', '2', '-w', '-j',
+                 jobs, self.uc_path])
+            self.assertEqual(status, 0)
+            self.assertEqual(stdout, expected)
+        status, _, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path, '--max-hits', '0',
+             self.uc_path])
+        self.assertEqual(status, 2)
+        self.assertIn('must be at least 1', stderr)
+
+    def test_taxonomy_cache(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        self._run(['uc-consensus', '-t', self.tax_path, '--taxonomy-cache',
+                   cache_dir, self.uc_path])
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, 'meta.json')))
+        os.remove(self.tax_path)
+        status, stdout, _ = self._run(
+            ['uc-consensus', '-t', cache_dir, self.uc_path])
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, self._expected())
+
+    def test_no_taxonomy_cache(self):
+        status, _, _ = self._run(['uc-consensus', '-t', self.tax_path,
+                                  '--no-taxonomy-cache', self.uc_path])
+        self.assertEqual(status, 0)
+        self.assertFalse(os.path.exists(self.tax_path + '.taxster-cache'))
+
+    def test_lazy_taxonomy(self):
+        status, stdout, _ = self._run(
+            ['uc-consensus', '-t', self.tax_path, '--lazy-taxonomy',
+             self.uc_path])
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, self._expected())
+        self.assertTrue(os.path.exists(self.tax_path + '.taxster-index'))
+        self.assertFalse(os.path.exists(self.tax_path + '.taxster-cache'))
+
+    def test_progress(self):
+        status, _, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path, '--progress',
+             '--progress-interval', '0', self.uc_path])
+        self.assertEqual(status, 0)
+        self.assertIn('taxster: loaded 6 references', stderr)
+        self.assertIn('taxster: done: 45 queries, ', stderr)
+        self.assertIn('queries/s', stderr)
+        self.assertIn('RSS', stderr)
+
+    def test_invalid_min_consensus_fraction(self):
+        status, stdout, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path, '-f', '0.5', self.uc_path])
+        self.assertEqual((status, stdout), (2, ''))
+        self.assertIn('must be greater than 0.5', stderr)
+
+    def test_missing_reference(self):
+        status, _, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path],
+            stdin=u'H\tr9\t1\t99.0\t+\t0\t0\t1M\tq1\tr9\n')
+        self.assertEqual(status, 1)
+        self.assertIn("Target sequence 'r9' of query 'q1' on line 1 is not "
+                      "in the taxonomy map", stderr)
+
+    def test_internal_key_error(self):
+        # only missing target sequences are reported as such
+        with mock.patch('taxster._cli.iter_uc_consensus_assignments',
+                        side_effect=KeyError('x')):
+            self.assertRaises(KeyError, self._run,
+                              ['uc-consensus', '-t', self.tax_path,
+                               self.uc_path])
+
+    def test_on_error(self):
+        data = (u'H\tr1\t1\t99.0\t+\t0\t0\t1M\tq1\tr1\n'
+                u'H\tr9\t1\t99.0\t+\t0\t0\t1M\tq1\tr9\n'
+                u'H\tr1\t1\t99.0\n'
+                u'H\tr9\t1\t99.0\t+\t0\t0\t1M\tq2\tr9\n')
+        path = os.path.join(self.temp_dir, 'errors.uc')
+        with open(path, 'w') as f:
+            f.write(data)
+        status, _, stderr = self._run(['uc-consensus', '-t', self.tax_path,
+                                       path])
+        self.assertEqual(status, 1)
+        self.assertIn("Malformed .uc record on line 3", stderr)
+        for args in ([path], [path, '-j', '2'], ['-']):
+            status, stdout, stderr = self._run(
+                ['uc-consensus', '-t', self.tax_path, '--on-error', 'skip'] +
+                args, stdin=data)
+            self.assertEqual(status, 0)
+            self.assertEqual(stdout, _TSV_HEADER +
+                             _TSV_ROW % ('q1', 'A; F; G', 1.0, 1))
+            self.assertIn('skipped 1 malformed records', stderr)
+            self.assertIn('skipped 2 hits of 1 target sequences that are '
+                          'not in the taxonomy map: r9', stderr)
+            self.assertIn("line 3: Malformed .uc record on line 3", stderr)
+        status, stdout, stderr = self._run(
+            ['uc-consensus', '-t', self.tax_path, '--on-error', 'unassigned',
+             path])
+        self.assertEqual(stdout, _TSV_HEADER +
+                         _TSV_ROW % ('q1', 'Unassigned', 1.0, 2) +
+                         _TSV_ROW % ('q2', 'Unassigned', 1.0, 1))
+        self.assertIn('unassigned 2 hits of 1 target sequences', stderr)
+
+    def test_no_command(self):
+        status, _, stderr = self._run([])
+        self.assertEqual(status, 2)
+        self.assertIn('usage: taxster', stderr)
+
+
+if __name__ == "__main__":
+    main()
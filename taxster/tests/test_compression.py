@@ -0,0 +1,256 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from unittest import TestCase, main, mock, skipIf
+
+from taxster import (load_taxonomy_map, uc_consensus_assignments,
+                     iter_uc_consensus_assignments)
+from taxster import _compression as compression
+from taxster._compression import (_background, _compression,
+                                  _iter_decompressed,
+                                  _iter_decompressed_lines,
+                                  _read_decompressed)
+from taxster._ucio import _iter_uc_chunks
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def bgzf_compress(data, block_size=65280):
+    """ Compress data as BGZF blocks of at most block_size bytes """
+    blocks = [_bgzf_block(data[start:start + block_size])
+              for start in range(0, len(data), block_size)]
+    # BGZF files end with an empty block
+    blocks.append(_bgzf_block(b''))
+    return b''.join(blocks)
+
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    header = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' +
+              struct.pack('<H2sHH', 6, b'BC', 2, len(payload) + 25))
+    return header + payload + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class CompressionTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = (uc1 + uc_many_queries).encode('utf-8') * 50
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data, name='in.uc'):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_compression(self):
+        for compress, expected in [(gzip.compress, 'gzip'),
+                                   (bz2.compress, 'bz2'),
+                                   (lzma.compress, 'xz'),
+                                   (bgzf_compress, 'gzip'),
+                                   (lambda d: d, None)]:
+            self.assertEqual(_compression(self._write(compress(self.data))),
+                             expected)
+
+    def test_read_decompressed(self):
+        for compress in (gzip.compress, bz2.compress, lzma.compress,
+                         bgzf_compress, lambda d: d):
+            path = self._write(compress(self.data))
+            self.assertEqual(_read_decompressed(path), self.data)
+
+    def test_iter_decompressed_lines(self):
+        for data in (self.data, self.data[:-1]):
+            path = self._write(bgzf_compress(data, block_size=1000))
+            self.assertEqual(list(_iter_decompressed_lines(path)),
+                             data.decode('utf-8').splitlines())
+        self.assertEqual(list(_iter_decompressed_lines(
+            self._write(gzip.compress(b'')))), [])
+        # lines longer than a block, and characters that str.splitlines
+        # splits at
+        data = b'a\x0bb\xc2\x85\r\n' + b'c' * 3000 + b'\n\nd'
+        path = self._write(bgzf_compress(data, block_size=1000))
+        self.assertEqual(list(_iter_decompressed_lines(path)),
+                         [u'a\x0bb\x85\r', u'c' * 3000, u'', u'd'])
+
+    def test_concatenated_streams(self):
+        half = len(self.data) // 2
+        for compress in (gzip.compress, bz2.compress, lzma.compress):
+            path = self._write(compress(self.data[:half]) +
+                               compress(self.data[half:]))
+            self.assertEqual(_read_decompressed(path), self.data)
+
+    def test_bgzf(self):
+        path = self._write(bgzf_compress(self.data, block_size=1000))
+        blocks = list(_iter_decompressed(path))
+        self.assertEqual(b''.join(blocks), self.data)
+        # BGZF blocks are decompressed in batches rather than all at once
+        self.assertTrue(len(blocks) > 1)
+
+    def test_bgzf_followed_by_gzip(self):
+        half = len(self.data) // 2
+        path = self._write(bgzf_compress(self.data[:half], block_size=1000) +
+                           gzip.compress(self.data[half:]))
+        self.assertEqual(_read_decompressed(path), self.data)
+
+    def test_truncated(self):
+        for compress in (gzip.compress, bz2.compress, lzma.compress):
+            path = self._write(compress(self.data)[:-20])
+            self.assertRaises(EOFError, _read_decompressed, path)
+
+    @skipIf(zstandard is not None, 'zstandard is installed')
+    def test_zstd_requires_zstandard(self):
+        path = self._write(b'\x28\xb5\x2f\xfd' + b'\x00' * 10)
+        self.assertRaisesRegex(ImportError, 'pip install zstandard',
+                               _iter_decompressed, path)
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        compressor = zstandard.ZstdCompressor()
+        path = self._write(compressor.compress(self.data[:100]) +
+                           compressor.compress(self.data[100:]))
+        self.assertEqual(_compression(path), 'zstd')
+        self.assertEqual(_read_decompressed(path), self.data)
+
+    def test_iter_uc_chunks(self):
+        path = self._write(gzip.compress(self.data))
+        chunks = list(_iter_uc_chunks(path, chunk_size=1000))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(chunk[-1] == ord('\n') for chunk in chunks))
+        self.assertEqual(b''.join(chunk.tobytes() for chunk in chunks),
+                         self.data)
+
+    def test_iter_uc_chunks_without_final_newline(self):
+        path = self._write(bz2.compress(self.data[:-1]))
+        chunks = list(_iter_uc_chunks(path, chunk_size=1000))
+        self.assertEqual(b''.join(chunk.tobytes() for chunk in chunks),
+                         self.data[:-1])
+
+    def test_background_error(self):
+        def blocks():
+            yield b'a'
+            raise ValueError('failed')
+
+        actual = _background(blocks())
+        self.assertEqual(next(actual), b'a')
+        self.assertRaisesRegex(ValueError, 'failed', next, actual)
+
+    def test_background_close(self):
+        closed = threading.Event()
+
+        def blocks():
+            try:
+                while True:
+                    yield b'a'
+            finally:
+                closed.set()
+
+        actual = _background(blocks(), max_pending=2)
+        self.assertEqual(next(actual), b'a')
+        actual.close()
+        self.assertTrue(closed.is_set())
+
+
+class CompressedInputTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+        self.uc = (uc1 + uc_many_queries).encode('utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data, name='in.uc.gz'):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_uc_consensus_assignments(self):
+        expected = uc_consensus_assignments(
+            io.StringIO(uc1 + uc_many_queries), self.id_to_taxonomy)
+        for compress in (gzip.compress, bz2.compress, lzma.compress,
+                         bgzf_compress):
+            path = self._write(compress(self.uc))
+            self.assertEqual(
+                uc_consensus_assignments(path, self.id_to_taxonomy),
+                expected)
+            self.assertEqual(
+                dict((q, (t, f, n)) for q, t, f, n in
+                     iter_uc_consensus_assignments(path,
+                                                   self.id_to_taxonomy)),
+                expected)
+
+    def test_parallel_requires_uncompressed(self):
+        path = self._write(gzip.compress(self.uc))
+        self.assertRaisesRegex(ValueError, 'uncompressed',
+                               uc_consensus_assignments, path,
+                               self.id_to_taxonomy, n_jobs=2)
+
+    def test_load_taxonomy_map(self):
+        text = ''.join('%s\t%s\n' % (r, '; '.join(t))
+                       for r, t in sorted(self.id_to_taxonomy.items()))
+        for compress in (gzip.compress, bz2.compress, lzma.compress,
+                         bgzf_compress):
+            path = self._write(compress(text.encode('utf-8')), 'tax.tsv.gz')
+            actual = load_taxonomy_map(path, cache=False)
+            self.assertEqual(dict(actual), self.id_to_taxonomy)
+        # the cache is keyed on the compressed file
+        load_taxonomy_map(path)
+        actual = load_taxonomy_map(path)
+        self.assertTrue(actual._children is None)
+        self.assertEqual(dict(actual), self.id_to_taxonomy)
+
+    def test_load_taxonomy_map_while_decompressing(self):
+        # a malformed first line is found before the rest of the file has
+        # been decompressed, since lines are parsed as blocks arrive
+        text = 'r0\n' + ''.join('r%d\tA; B; C%d\n' % (i, i)
+                                for i in range(1, 20000))
+        path = self._write(bgzf_compress(text.encode('utf-8'),
+                                         block_size=100), 'tax.tsv.gz')
+        total = len(list(_iter_decompressed(path)))
+        consumed = []
+        iter_decompressed = compression._iter_decompressed
+
+        def counted(path):
+            for block in iter_decompressed(path):
+                consumed.append(block)
+                yield block
+
+        with mock.patch('taxster._compression._iter_decompressed', counted):
+            self.assertRaisesRegex(ValueError, 'Line 1 ', load_taxonomy_map,
+                                   path, cache=False)
+        self.assertTrue(total > 1)
+        self.assertEqual(len(consumed), 1)
+
+
+if __name__ == "__main__":
+    main()
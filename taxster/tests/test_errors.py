@@ -0,0 +1,289 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import io
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from taxster import (ConsensusCache, ConsensusStats, MissingReferenceError,
+                     TaxonomyTable, UcErrors, UcRecordError,
+                     aiter_uc_consensus_assignments,
+                     iter_uc_consensus_assignments, uc_consensus_assignments,
+                     uc_consensus_lineages)
+from taxster._errors import _RecordChecker
+from taxster._ucio import _scan_uc_chunk
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+import numpy as np
+
+
+class UcErrorsTests(TestCase):
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, UcErrors, 'ignore')
+
+    def test_summary(self):
+        errors = UcErrors('skip', max_examples=1)
+        self.assertEqual(errors.summary(),
+                         {'policy': 'skip', 'skipped_records': 0,
+                          'malformed_records': 0,
+                          'missing_reference_records': 0,
+                          'missing_references': [], 'other_records': {},
+                          'examples': []})
+        other = errors._empty()
+        other.malformed_records = 2
+        other.missing_reference_records = 3
+        other.missing_references.update(['r9', 'r8'])
+        other.other_records['L'] += 1
+        other.examples.extend([(4, 'a'), (7, 'b')])
+        errors._merge(other)
+        summary = errors.summary()
+        self.assertEqual(summary['skipped_records'], 5)
+        self.assertEqual(summary['missing_references'], ['r8', 'r9'])
+        self.assertEqual(summary['other_records'], {'L': 1})
+        self.assertEqual(summary['examples'], [(4, 'a')])
+        errors.policy = 'unassigned'
+        self.assertEqual(errors.skipped_records, 2)
+
+    def test_exceptions(self):
+        e = MissingReferenceError('r9', 'q1', 12)
+        self.assertTrue(isinstance(e, KeyError))
+        self.assertTrue(isinstance(e, ValueError))
+        self.assertEqual(str(e), "Target sequence 'r9' of query 'q1' on line "
+                                 "12 is not in the taxonomy map.")
+        e = pickle.loads(pickle.dumps(e))
+        self.assertEqual((e.reference_id, e.query_id, e.line_number),
+                         ('r9', 'q1', 12))
+        e = pickle.loads(pickle.dumps(UcRecordError('bad', 3)))
+        self.assertEqual((str(e), e.line_number), ('bad', 3))
+
+
+class ErrorPolicyTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.taxonomy_maps = (self.id_to_taxonomy,
+                              TaxonomyTable(self.id_to_taxonomy))
+        self.temp_dir = tempfile.mkdtemp()
+        lines = (uc1 + uc_many_queries).splitlines(True)
+        self.clean = u''.join(lines)
+        # a hit of a missing target and truncated H and N records, and the
+        # same with the hit replaced by an N record
+        m30 = next(i for i, line in enumerate(lines) if '\tm30\t' in line)
+        bad = [u'H\tr9\t193\t99.0\t+\t0\t0\t193M\tm30\tr9\n',
+               u'H\tr1\t193\t97.0\n',
+               u'N\t*\t*\n']
+        self.data = u''.join(lines[:m30] + bad + lines[m30:])
+        self.unassigned = u''.join(
+            lines[:m30] + [u'N\t*\t*\t*\t*\t*\t*\t*\tm30\t*\n'] + lines[m30:])
+        self.missing_line = m30 + 1
+        self.malformed_lines = [m30 + 2, m30 + 3]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data, name='in.uc'):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def _all_paths(self, data, **kwargs):
+        """ Compute the assignments of ``data`` by every code path, each
+            with its own ``UcErrors`` if a policy is given
+        """
+        policy = kwargs.pop('policy', None)
+        path = self._write(data)
+        runs = []
+        for taxonomy_map in self.taxonomy_maps:
+            for uc in (lambda: io.StringIO(data), lambda: path):
+                runs.append(lambda e, m=taxonomy_map, uc=uc:
+                            uc_consensus_assignments(uc(), m, errors=e,
+                                                     **kwargs))
+                runs.append(lambda e, m=taxonomy_map, uc=uc: {
+                    q: (a, f, n) for q, a, f, n in
+                    iter_uc_consensus_assignments(uc(), m, errors=e,
+                                                  **kwargs)})
+                runs.append(lambda e, m=taxonomy_map, uc=uc:
+                            uc_consensus_assignments(
+                                uc(), m, stats=ConsensusStats(), errors=e,
+                                **kwargs))
+            runs.append(lambda e, m=taxonomy_map: uc_consensus_assignments(
+                path, m, n_jobs=2, errors=e, **kwargs))
+            if 'weighted' not in kwargs:
+                runs.append(lambda e, m=taxonomy_map:
+                            uc_consensus_assignments(
+                                path, m, cache=ConsensusCache(), errors=e,
+                                **kwargs))
+        results = []
+        for run in runs:
+            errors = None if policy is None else UcErrors(policy)
+            results.append((run(errors), errors))
+        return results
+
+    def test_strict(self):
+        path = self._write(self.data)
+        for taxonomy_map in self.taxonomy_maps:
+            # file objects are checked line by line
+            with self.assertRaises(MissingReferenceError) as context:
+                uc_consensus_assignments(io.StringIO(self.data),
+                                         taxonomy_map)
+            self.assertEqual(context.exception.line_number, self.missing_line)
+            self.assertEqual(context.exception.reference_id, 'r9')
+            self.assertEqual(context.exception.query_id, 'm30')
+            # files on disk are parsed in blocks before targets are checked
+            for kwargs in ({}, {'n_jobs': 2}, {'max_hits': 2}):
+                with self.assertRaises(UcRecordError) as context:
+                    uc_consensus_assignments(path, taxonomy_map,
+                                             errors='strict', **kwargs)
+                self.assertEqual(context.exception.line_number,
+                                 self.malformed_lines[0])
+                self.assertIn("Malformed .uc record on line %d"
+                              % self.malformed_lines[0],
+                              str(context.exception))
+
+    def test_strict_missing_reference(self):
+        data = self.unassigned.replace(u'N\t*\t*\t*\t*\t*\t*\t*\tm30\t*',
+                                       u'H\tr9\t1\t99.0\t+\t0\t0\t1M\tm30\tr9')
+        path = self._write(data)
+        for taxonomy_map in self.taxonomy_maps:
+            for uc in (io.StringIO(data), path):
+                with self.assertRaises(KeyError) as context:
+                    uc_consensus_assignments(uc, taxonomy_map)
+                self.assertEqual(context.exception.line_number,
+                                 self.missing_line)
+            with self.assertRaises(MissingReferenceError) as context:
+                list(iter_uc_consensus_assignments(path, taxonomy_map,
+                                                   max_hits=1))
+            self.assertEqual(context.exception.line_number,
+                             self.missing_line)
+            with self.assertRaises(MissingReferenceError) as context:
+                uc_consensus_lineages(path, taxonomy_map)
+            self.assertEqual(context.exception.line_number,
+                             self.missing_line)
+
+    def test_skip(self):
+        for kwargs in ({}, {'max_hits': 2}, {'weighted': True}):
+            expected = uc_consensus_assignments(
+                io.StringIO(self.clean), self.id_to_taxonomy, **kwargs)
+            for actual, errors in self._all_paths(self.data, policy='skip',
+                                                  **kwargs):
+                self.assertEqual(actual, expected)
+                self.assertEqual(errors.malformed_records, 2)
+                self.assertEqual(errors.missing_reference_records, 1)
+                self.assertEqual(errors.skipped_records, 3)
+                self.assertEqual(errors.missing_references, {'r9'})
+                self.assertEqual(errors.other_records, {'L': 2})
+                self.assertEqual(sorted(e[0] for e in errors.examples),
+                                 [self.missing_line] + self.malformed_lines)
+
+    def test_unassigned(self):
+        for kwargs in ({}, {'max_hits': 2}):
+            expected = uc_consensus_assignments(
+                io.StringIO(self.unassigned), self.id_to_taxonomy, **kwargs)
+            for actual, errors in self._all_paths(
+                    self.data, policy='unassigned', **kwargs):
+                self.assertEqual(actual, expected)
+                self.assertEqual(errors.skipped_records, 2)
+                self.assertEqual(errors.missing_reference_records, 1)
+
+    def test_other_record_types(self):
+        # usearch and vsearch write S and C records for cluster seeds and
+        # clusters, which are ignored like records of any other type
+        lines = self.clean.splitlines(True)
+        data = u''.join([u'S\t0\t193\t*\t*\t*\t*\t*\ts1\t*\n'] +
+                        lines[:10] +
+                        [u'C\t0\t2\t*\t*\t*\t*\t*\ts1\t*\n',
+                         u'X\tnot a hit\n'] + lines[10:])
+        expected = uc_consensus_assignments(io.StringIO(self.clean),
+                                            self.id_to_taxonomy)
+        for policy in (None, 'strict', 'skip', 'unassigned'):
+            for actual, errors in self._all_paths(data, policy=policy):
+                self.assertEqual(actual, expected)
+                if errors is not None:
+                    self.assertEqual(errors.malformed_records, 0)
+                    self.assertEqual(errors.other_records,
+                                     {'S': 1, 'C': 1, 'X': 1, 'L': 2})
+
+    def test_repeated_missing_references(self):
+        data = self.clean + u''.join(
+            u'H\tr%d\t1\t99.0\t+\t0\t0\t1M\tx%d\tr%d\n' % (r, q, r)
+            for q in range(5) for r in (7, 8, 1))
+        for actual, errors in self._all_paths(data, policy='skip'):
+            self.assertEqual(errors.missing_reference_records, 10)
+            self.assertEqual(errors.missing_references, {'r7', 'r8'})
+            self.assertEqual(actual['x4'], (['A', 'F', 'G'], 1.0, 1))
+        for actual, errors in self._all_paths(data, policy='unassigned'):
+            self.assertEqual(errors.missing_reference_records, 10)
+            self.assertEqual(actual['x4'], (['Unassigned'], 1.0, 3))
+
+    def test_all_records_skipped(self):
+        data = self.clean + u'H\tr9\t1\t99.0\t+\t0\t0\t1M\tx\tr9\n'
+        for actual, _ in self._all_paths(data, policy='skip'):
+            self.assertFalse('x' in actual)
+
+    def test_parallel_line_numbers(self):
+        # the bad records are in the last of several shards
+        offset = 5000
+        data = u''.join(u'H\tr1\t1\t99.0\t+\t0\t0\t1M\tp%d\tr1\n' % i
+                        for i in range(offset)) + self.data
+        path = self._write(data)
+        errors = UcErrors('skip')
+        uc_consensus_assignments(path, self.id_to_taxonomy, n_jobs=2,
+                                 errors=errors)
+        self.assertEqual(sorted(e[0] for e in errors.examples),
+                         [offset + self.missing_line] +
+                         [offset + line for line in self.malformed_lines])
+
+    def test_aiter(self):
+        data = self.data.encode('utf-8')
+
+        async def collect(errors):
+            async def blocks():
+                for i in range(0, len(data), 100):
+                    yield data[i:i + 100]
+            return {q: (a, f, n) async for q, a, f, n in
+                    aiter_uc_consensus_assignments(
+                        blocks(), self.id_to_taxonomy, batch_size=100,
+                        errors=errors)}
+
+        errors = UcErrors('skip')
+        actual = asyncio.run(collect(errors))
+        self.assertEqual(actual, uc_consensus_assignments(
+            io.StringIO(self.clean), self.id_to_taxonomy))
+        self.assertEqual(sorted(e[0] for e in errors.examples),
+                         [self.missing_line] + self.malformed_lines)
+        with self.assertRaises(MissingReferenceError) as context:
+            asyncio.run(collect(None))
+        self.assertEqual(context.exception.line_number, self.missing_line)
+
+    def test_scan_uc_chunk(self):
+        data = np.frombuffer(self.data.encode('utf-8'), dtype=np.uint8)
+        self.assertRaises(UcRecordError, _scan_uc_chunk, data)
+        errors = UcErrors('skip')
+        checker = _RecordChecker(errors)
+        is_hit, queries, targets, lines = _scan_uc_chunk(data,
+                                                         checker=checker)
+        self.assertEqual(len(is_hit), len(lines))
+        self.assertEqual(errors.malformed_records, 2)
+        self.assertEqual(checker.lines, len(self.data.splitlines()))
+        self.assertEqual(targets[lines == self.missing_line].tolist(),
+                         [b'r9'])
+
+
+if __name__ == "__main__":
+    main()
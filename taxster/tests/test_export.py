@@ -0,0 +1,166 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase, main, mock, skipIf
+
+import pandas as pd
+
+from taxster import (TaxonomyTable, uc_consensus_assignments,
+                     uc_consensus_dataframe, uc_consensus_arrow,
+                     write_uc_consensus_assignments)
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _expected_rows(self, uc, *params):
+        return uc_consensus_assignments(io.StringIO(uc),
+                                        self.id_to_taxonomy, *params)
+
+    def test_dataframe(self):
+        df = uc_consensus_dataframe(io.StringIO(uc1), self.id_to_taxonomy)
+        self.assertEqual(list(df.columns),
+                         ['query_id', 'rank_1', 'rank_2', 'rank_3', 'rank_4',
+                          'confidence', 'n_hits'])
+        self.assertEqual(list(df['query_id']), ['q3', 'q4', 'q5', 'q2', 'q1'])
+        self.assertEqual(df['rank_1'].dtype.name, 'category')
+        self.assertEqual(list(df.iloc[3, 1:5]), ['A', 'H', 'I', 'J'])
+        self.assertEqual(list(df.iloc[4, 1:4]), ['A', 'B', 'C'])
+        self.assertTrue(pd.isna(df.iloc[4, 4]))
+        self.assertEqual(df.iloc[0, 1], 'Unassigned')
+        self.assertTrue(df.iloc[0, 2:5].isna().all())
+
+    def test_dataframe_matches_assignments(self):
+        for table in (self.id_to_taxonomy,
+                      TaxonomyTable(self.id_to_taxonomy)):
+            for params in [(), (1.0, 'x')]:
+                df = uc_consensus_dataframe(
+                    io.StringIO(uc1 + uc_many_queries), table, *params)
+                expected = self._expected_rows(uc1 + uc_many_queries,
+                                               *params)
+                ranks = [c for c in df.columns if c.startswith('rank_')]
+                actual = {}
+                for row in df.itertuples(index=False):
+                    row = row._asdict()
+                    actual[row['query_id']] = (
+                        [row[r] for r in ranks if not pd.isna(row[r])],
+                        row['confidence'], row['n_hits'])
+                self.assertEqual(actual, expected)
+
+    def test_dataframe_rank_names(self):
+        ranks = ['domain', 'phylum', 'class', 'order', 'family', 'genus']
+        df = uc_consensus_dataframe(io.StringIO(uc1), self.id_to_taxonomy,
+                                    ranks=ranks)
+        self.assertEqual(list(df.columns),
+                         ['query_id'] + ranks + ['confidence', 'n_hits'])
+        self.assertTrue(df['genus'].isna().all())
+        self.assertRaises(ValueError, uc_consensus_dataframe,
+                          io.StringIO(uc1), self.id_to_taxonomy,
+                          ranks=['domain'])
+
+    def test_dataframe_unassignable_label_in_taxonomy(self):
+        df = uc_consensus_dataframe(io.StringIO(uc1), self.id_to_taxonomy,
+                                    unassignable_label='A')
+        self.assertEqual(list(df['rank_1']), ['A'] * 5)
+
+    def test_dataframe_empty(self):
+        df = uc_consensus_dataframe(io.StringIO(u''), self.id_to_taxonomy)
+        self.assertEqual(len(df), 0)
+
+    def test_invalid_min_consensus_fraction(self):
+        self.assertRaises(ValueError, uc_consensus_dataframe,
+                          io.StringIO(uc1), self.id_to_taxonomy, 0.5)
+
+    def test_write_tsv(self):
+        out = io.StringIO()
+        write_uc_consensus_assignments(io.StringIO(uc1 + uc_many_queries),
+                                       self.id_to_taxonomy, out)
+        lines = out.getvalue().split('\n')
+        self.assertEqual(lines[0], '#query_id\ttaxonomy\tconfidence\tn_hits')
+        self.assertEqual(lines[4], 'q2\tA; H; I; J\t0.6666666666666666\t3')
+        self.assertEqual(lines[-1], '')
+        expected = {query_id: '\t'.join(map(str, [
+            query_id, '; '.join(taxonomy), fraction, n_hits]))
+            for query_id, (taxonomy, fraction, n_hits)
+            in self._expected_rows(uc1 + uc_many_queries).items()}
+        self.assertEqual(lines[1:-1], [expected[line.split('\t')[0]]
+                                       for line in lines[1:-1]])
+        self.assertEqual(len(lines[1:-1]), len(expected))
+
+    def test_write_tsv_path(self):
+        path = os.path.join(self.temp_dir, 'out.tsv')
+        write_uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                       path)
+        out = io.StringIO()
+        write_uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                       out)
+        with open(path) as f:
+            self.assertEqual(f.read(), out.getvalue())
+
+    def test_write_invalid_format(self):
+        self.assertRaises(ValueError, write_uc_consensus_assignments,
+                          io.StringIO(uc1), self.id_to_taxonomy,
+                          io.StringIO(), format='csv')
+
+    def test_arrow_requires_pyarrow(self):
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            self.assertRaisesRegex(ImportError, 'pip install pyarrow',
+                                   uc_consensus_arrow, io.StringIO(uc1),
+                                   self.id_to_taxonomy)
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        table = uc_consensus_arrow(io.StringIO(uc1 + uc_many_queries),
+                                   self.id_to_taxonomy)
+        df = uc_consensus_dataframe(io.StringIO(uc1 + uc_many_queries),
+                                    self.id_to_taxonomy)
+        self.assertEqual(table.column_names, list(df.columns))
+        self.assertTrue(pyarrow.types.is_dictionary(table.schema[1].type))
+        for name in df.columns:
+            self.assertEqual(
+                [None if pd.isna(v) else v for v in df[name]],
+                table.column(name).to_pylist())
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_write_parquet(self):
+        path = os.path.join(self.temp_dir, 'out.parquet')
+        write_uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                       path, format='parquet')
+        actual = pyarrow.parquet.read_table(path)
+        expected = uc_consensus_arrow(io.StringIO(uc1), self.id_to_taxonomy)
+        self.assertEqual(actual.column_names, expected.column_names)
+        for name in expected.column_names:
+            self.assertEqual(actual.column(name).to_pylist(),
+                             expected.column(name).to_pylist())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from taxster import (IncrementalConsensus, TaxonomyTable, load_taxonomy_map,
+                     uc_consensus_assignments)
+from taxster.tests.test_uc import uc1, uc_many_queries, uc_ungrouped
+
+
+class IncrementalConsensusTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _expected(self, data, *params):
+        return dict(uc_consensus_assignments(io.StringIO(data),
+                                             self.id_to_taxonomy, *params))
+
+    def test_append_matches_full_recompute(self):
+        split = uc_many_queries.index('\n', 1000) + 1
+        chunks = [uc1, uc_ungrouped, uc_many_queries[:split],
+                  uc_many_queries[split:], uc1]
+        for params in [(), (1.0, 'x')]:
+            state = IncrementalConsensus(self.id_to_taxonomy, *params)
+            for i, chunk in enumerate(chunks):
+                changed = state.update(io.StringIO(chunk))
+                expected = self._expected(''.join(chunks[:i + 1]), *params)
+                self.assertEqual(state.assignments(), expected)
+                self.assertEqual(
+                    changed, dict((q, expected[q]) for q in
+                                  self._expected(chunk, *params)))
+            self.assertEqual(len(state), len(expected))
+
+    def test_replace(self):
+        state = IncrementalConsensus(TaxonomyTable(self.id_to_taxonomy))
+        state.update(io.StringIO(uc1 + uc_many_queries))
+        # q2 is rerun with one more hit, and q1 with the same hits
+        rerun = (u"H\tr3\t1\t1\t+\t0\t0\t1M\tq2\tr3\n"
+                 u"H\tr5\t1\t1\t+\t0\t0\t1M\tq2\tr5\n"
+                 u"H\tr6\t1\t1\t+\t0\t0\t1M\tq2\tr6\n"
+                 u"H\tr1\t1\t1\t+\t0\t0\t1M\tq2\tr1\n"
+                 u"H\tr4\t1\t1\t+\t0\t0\t1M\tq1\tr4\n"
+                 u"H\tr2\t1\t1\t+\t0\t0\t1M\tq1\tr2\n")
+        changed = state.update(io.StringIO(rerun), mode='replace')
+        self.assertEqual(changed, {'q2': (['A', 'H'], 0.75, 4)})
+        expected = self._expected(uc1 + uc_many_queries)
+        expected['q2'] = (['A', 'H'], 0.75, 4)
+        self.assertEqual(state.assignments(), expected)
+        self.assertRaises(ValueError, state.update, io.StringIO(rerun),
+                          mode='merge')
+
+    def test_path(self):
+        state = IncrementalConsensus(self.id_to_taxonomy, 1.0,
+                                     path=os.path.join(self.temp_dir, 'i.uc'))
+        uc_path = os.path.join(self.temp_dir, 'in.uc')
+        with open(uc_path, 'w') as f:
+            f.write(uc1)
+        state.update(uc_path)
+        self.assertEqual(state.assignments(), self._expected(uc1, 1.0))
+        self.assertRaises(ValueError, IncrementalConsensus(
+            self.id_to_taxonomy).save)
+
+    def test_save_and_load(self):
+        tax_path = os.path.join(self.temp_dir, 'tax-map.tsv')
+        with open(tax_path, 'w') as f:
+            for reference_id, lineage in sorted(self.id_to_taxonomy.items()):
+                f.write('%s\t%s\n' % (reference_id, '; '.join(lineage)))
+        state_path = os.path.join(self.temp_dir, 'state')
+        state = IncrementalConsensus(load_taxonomy_map(tax_path),
+                                     path=state_path)
+        state.update(io.StringIO(uc1))
+        state.save()
+        state = IncrementalConsensus(load_taxonomy_map(tax_path), 0.51, 'x',
+                                     path=state_path)
+        self.assertEqual(len(state), 5)
+        self.assertTrue('q1' in state)
+        changed = state.update(io.StringIO(uc_many_queries))
+        self.assertEqual(len(changed), 40)
+        self.assertEqual(state.assignments(),
+                         self._expected(uc1 + uc_many_queries, 0.51, 'x'))
+
+        # the state can't be used with a different taxonomy map
+        other = dict(self.id_to_taxonomy, r7=['B'])
+        self.assertRaisesRegex(ValueError, 'different taxonomy map',
+                               IncrementalConsensus, other, path=state_path)
+        self.assertRaisesRegex(ValueError, 'min_consensus_fraction',
+                               IncrementalConsensus,
+                               load_taxonomy_map(tax_path), 0.9,
+                               path=state_path)
+
+    def test_save_and_load_lazy(self):
+        tax_path = os.path.join(self.temp_dir, 'tax-map.tsv')
+        with open(tax_path, 'w') as f:
+            for reference_id, lineage in sorted(self.id_to_taxonomy.items()):
+                f.write('%s\t%s\n' % (reference_id, '; '.join(lineage)))
+        state_path = os.path.join(self.temp_dir, 'state')
+        table = load_taxonomy_map(tax_path, lazy=True)
+        table.nodes(['r5', 'r3'])
+        state = IncrementalConsensus(table, path=state_path)
+        state.update(io.StringIO(uc1))
+        state.save()
+        # lazy tables number nodes in the order references are resolved
+        other_table = load_taxonomy_map(tax_path, lazy=True)
+        other_table.nodes(['r1', 'r4', 'r2'])
+        self.assertNotEqual(other_table.node('r1'), table.node('r1'))
+        state = IncrementalConsensus(other_table, path=state_path)
+        self.assertEqual(state.assignments(), self._expected(uc1))
+        state.update(io.StringIO(uc_many_queries))
+        self.assertEqual(state.assignments(),
+                         self._expected(uc1 + uc_many_queries))
+        # the loaded counts compare equal to newly counted ones
+        changed = state.update(io.StringIO(uc1), mode='replace')
+        self.assertEqual(changed, {})
+
+    def test_invalid_min_consensus_fraction(self):
+        self.assertRaises(ValueError, IncrementalConsensus,
+                          self.id_to_taxonomy, 0.5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from taxster._parallel import (_record_query, _resolve_n_jobs, _uc_path,
+                               _uc_shard_offsets)
+from taxster._uc import _iter_uc_query_hits
+from taxster._ucio import _UcRange
+
+
+class ParallelTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'in.uc')
+        lines = ['# header\n']
+        for q in range(50):
+            for h in range(q % 4):
+                lines.append('H\tr%d\t193\t97.0\t+\t0\t0\t193M\tq%d desc\t'
+                             'r%d\n' % (h, q, h))
+            if q % 4 == 0:
+                lines.append('N\t*\t195\t*\t*\t*\t*\t*\tq%d\t*\n' % q)
+        with open(self.path, 'w') as f:
+            f.write(''.join(lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_resolve_n_jobs(self):
+        self.assertEqual(_resolve_n_jobs(1), 1)
+        self.assertEqual(_resolve_n_jobs(8), 8)
+        self.assertEqual(_resolve_n_jobs(-1), os.cpu_count())
+        self.assertEqual(_resolve_n_jobs(-1000), 1)
+        self.assertRaises(ValueError, _resolve_n_jobs, 0)
+
+    def test_uc_path(self):
+        self.assertEqual(_uc_path(self.path), self.path)
+        with open(self.path) as f:
+            self.assertEqual(_uc_path(f), self.path)
+        self.assertRaises(ValueError, _uc_path, io.StringIO(u''))
+        self.assertRaises(ValueError, _uc_path,
+                          os.path.join(self.temp_dir, 'missing.uc'))
+
+    def test_record_query(self):
+        # the query label is split from its line as the parsers split it
+        self.assertEqual(_record_query(
+            b'  H\tr1\t193\t99.0\t+\t0\t0\t1M\tq1\xc2\xa0x\tr1\n'), b'q1')
+        self.assertEqual(_record_query(
+            b'N\t*\t195\t*\t*\t*\t*\t*\t\xc3\xa9q2\x1cx\t*\r\n'),
+            u'\xe9q2'.encode('utf-8'))
+        for line in (b'  # comment\n', b'N\t*\n',
+                     b'N\t*\t195\t*\t*\t*\t*\t*\t\x0b\t*\n'):
+            self.assertIsNone(_record_query(line))
+
+    def test_uc_shard_offsets(self):
+        size = os.path.getsize(self.path)
+        with open(self.path) as f:
+            expected = list(_iter_uc_query_hits(f))
+        for n_shards in (1, 2, 3, 7, 1000):
+            offsets = _uc_shard_offsets(self.path, n_shards)
+            self.assertTrue(len(offsets) <= n_shards)
+            self.assertEqual(offsets[0][0], 0)
+            self.assertEqual(offsets[-1][1], size)
+            actual = []
+            for (start, end), (next_start, _) in zip(offsets,
+                                                     offsets[1:] + [(size,
+                                                                     None)]):
+                self.assertEqual(end, next_start)
+                actual.extend(_iter_uc_query_hits(
+                    _UcRange(self.path, start, end)))
+            # no query is split across shards
+            self.assertEqual(actual, expected)
+
+    def test_uc_shard_offsets_empty(self):
+        open(self.path, 'w').close()
+        self.assertEqual(_uc_shard_offsets(self.path, 4), [(0, 0)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+import pandas as pd
+
+from taxster import (ConsensusCache, uc_consensus_assignments,
+                     uc_consensus_samples)
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+
+class UcConsensusSamplesTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = {'s1': uc1, 's2': uc_many_queries,
+                     's3': uc1 + uc_many_queries, 's4': u''}
+        self.paths = {}
+        for sample_id, data in self.data.items():
+            path = self.paths[sample_id] = os.path.join(self.temp_dir,
+                                                        sample_id + '.uc')
+            with open(path, 'w') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _expected(self, *params):
+        return {sample_id: uc_consensus_assignments(
+                    io.StringIO(data), self.id_to_taxonomy, *params)
+                for sample_id, data in self.data.items()}
+
+    def test_serial(self):
+        results, _ = uc_consensus_samples(
+            {s: io.StringIO(d) for s, d in self.data.items()},
+            self.id_to_taxonomy, 1.0, 'x')
+        self.assertEqual(results, self._expected(1.0, 'x'))
+
+    def test_parallel(self):
+        for n_jobs in (2, 10, -1):
+            results, counts = uc_consensus_samples(
+                self.paths, self.id_to_taxonomy, n_jobs=n_jobs)
+            self.assertEqual(results, self._expected())
+            self.assertEqual(list(results), list(self.paths))
+            self.assertEqual(list(counts.columns), list(self.paths))
+
+    def test_list_of_paths(self):
+        paths = [self.paths['s2'], self.paths['s1']]
+        results, counts = uc_consensus_samples(paths, self.id_to_taxonomy)
+        self.assertEqual(list(results), paths)
+        expected = self._expected()
+        self.assertEqual(results[paths[0]], expected['s2'])
+        self.assertEqual(results[paths[1]], expected['s1'])
+        self.assertRaises(ValueError, uc_consensus_samples, paths + paths[:1],
+                          self.id_to_taxonomy)
+
+    def test_taxonomy_counts(self):
+        _, counts = uc_consensus_samples(
+            {'s1': self.paths['s1'], 's4': self.paths['s4']},
+            self.id_to_taxonomy)
+        expected = pd.DataFrame(
+            [[1, 0], [1, 0], [3, 0]],
+            index=pd.Index(['A; B; C', 'A; H; I; J', 'Unassigned'],
+                           name='taxonomy'),
+            columns=['s1', 's4'])
+        pd.testing.assert_frame_equal(counts, expected)
+        _, counts = uc_consensus_samples({'s4': self.paths['s4']},
+                                         self.id_to_taxonomy)
+        self.assertEqual(counts.shape, (0, 1))
+
+    def test_cache(self):
+        cache_path = os.path.join(self.temp_dir, 'consensus.cache')
+        cache = ConsensusCache(path=cache_path)
+        results, _ = uc_consensus_samples(self.paths, self.id_to_taxonomy,
+                                          cache=cache)
+        self.assertEqual(results, self._expected())
+        # s3 repeats the hits of s1 and s2
+        self.assertEqual(cache.misses, len(cache))
+        self.assertTrue(cache.hits >= len(results['s3']))
+        self.assertTrue(os.path.exists(cache_path))
+        os.remove(cache_path)
+        cache = ConsensusCache(path=cache_path)
+        results, _ = uc_consensus_samples(self.paths, self.id_to_taxonomy,
+                                          n_jobs=2, cache=cache)
+        self.assertEqual(results, self._expected())
+        self.assertEqual(len(cache), 0)
+        self.assertFalse(os.path.exists(cache_path))
+
+    def test_compressed(self):
+        path = os.path.join(self.temp_dir, 's1.uc.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write(uc1)
+        results, _ = uc_consensus_samples(
+            {'s1': path, 's2': self.paths['s2']}, self.id_to_taxonomy,
+            n_jobs=2)
+        expected = self._expected()
+        self.assertEqual(results, {'s1': expected['s1'],
+                                   's2': expected['s2']})
+
+    def test_parallel_requires_paths(self):
+        self.assertRaises(ValueError, uc_consensus_samples,
+                          {'s1': io.StringIO(uc1), 's2': io.StringIO(uc1)},
+                          self.id_to_taxonomy, n_jobs=2)
+
+    def test_invalid_min_consensus_fraction(self):
+        self.assertRaises(ValueError, uc_consensus_samples, self.paths,
+                          self.id_to_taxonomy, 0.5)
+
+
+if __name__ == "__main__":
+    main()
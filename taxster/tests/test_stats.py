@@ -0,0 +1,155 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from taxster import (ConsensusCache, ConsensusStats, TaxonomyTable,
+                     uc_consensus_assignments, iter_uc_consensus_assignments)
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+
+class ConsensusStatsTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'in.uc')
+        with open(self.path, 'w') as f:
+            f.write(uc1)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _inputs(self):
+        return [lambda: io.StringIO(uc1), lambda: self.path]
+
+    def assertCounts(self, stats, runs=1):
+        # uc1 has 5 queries with 1, 1, 1, 3 and 2 hits
+        self.assertEqual(stats.queries, 5 * runs)
+        self.assertEqual(stats.records_parsed, 8 * runs)
+        self.assertEqual(stats.bytes_parsed, len(uc1) * runs)
+        self.assertEqual(stats.hit_histogram,
+                         {1: 3 * runs, 2: runs, 3: runs})
+        self.assertTrue(stats.elapsed > 0)
+        for stage in ('parse', 'lookup', 'consensus'):
+            self.assertTrue(stats.wall_time[stage] >= 0)
+            self.assertTrue(stats.cpu_time[stage] >= 0)
+        self.assertTrue(stats.wall_time['parse'] > 0)
+        self.assertTrue(stats.wall_time['consensus'] > 0)
+        self.assertTrue(sum(stats.wall_time.values()) <= stats.elapsed)
+
+    def test_uc_consensus_assignments(self):
+        for taxonomy_map in (self.id_to_taxonomy,
+                             TaxonomyTable(self.id_to_taxonomy)):
+            for uc in self._inputs():
+                stats = ConsensusStats()
+                expected = uc_consensus_assignments(uc(), taxonomy_map)
+                actual = uc_consensus_assignments(uc(), taxonomy_map,
+                                                  stats=stats)
+                self.assertEqual(actual, expected)
+                self.assertCounts(stats)
+
+    def test_iter_uc_consensus_assignments(self):
+        for taxonomy_map in (self.id_to_taxonomy,
+                             TaxonomyTable(self.id_to_taxonomy)):
+            for uc in self._inputs():
+                stats = ConsensusStats()
+                expected = list(iter_uc_consensus_assignments(uc(),
+                                                              taxonomy_map))
+                actual = list(iter_uc_consensus_assignments(
+                    uc(), taxonomy_map, stats=stats))
+                self.assertEqual(actual, expected)
+                self.assertCounts(stats)
+
+    def test_cache(self):
+        stats = ConsensusStats()
+        cache = ConsensusCache()
+        uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                 cache=cache, stats=stats)
+        list(iter_uc_consensus_assignments(io.StringIO(uc1),
+                                           self.id_to_taxonomy, cache=cache,
+                                           stats=stats))
+        self.assertCounts(stats, runs=2)
+
+    def test_parallel(self):
+        with open(self.path, 'w') as f:
+            f.write(uc1 + uc_many_queries)
+        stats = ConsensusStats()
+        actual = uc_consensus_assignments(self.path, self.id_to_taxonomy,
+                                          n_jobs=2, stats=stats)
+        self.assertEqual(actual, uc_consensus_assignments(
+            self.path, self.id_to_taxonomy))
+        self.assertEqual(stats.queries, len(actual))
+        self.assertEqual(stats.records_parsed,
+                         sum(n_hits for _, _, n_hits in actual.values()))
+        self.assertEqual(stats.bytes_parsed, len(uc1 + uc_many_queries))
+        self.assertTrue(stats.wall_time['parse'] > 0)
+
+    def test_hooks(self):
+        stages = []
+        queries = []
+        stats = ConsensusStats(
+            on_stage=lambda *args: stages.append(args),
+            on_query=lambda *args: queries.append(args))
+        uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                 stats=stats)
+        self.assertEqual([s[0] for s in stages],
+                         ['parse', 'lookup', 'consensus'])
+        for stage, wall, cpu in stages:
+            self.assertEqual(wall, stats.wall_time[stage])
+            self.assertEqual(cpu, stats.cpu_time[stage])
+        self.assertEqual(sorted(queries), [('q1', 2), ('q2', 3), ('q3', 1),
+                                           ('q4', 1), ('q5', 1)])
+
+    def test_closed_generator(self):
+        stages = []
+        stats = ConsensusStats(on_stage=lambda *args: stages.append(args))
+        assignments = iter_uc_consensus_assignments(
+            io.StringIO(uc1), self.id_to_taxonomy, stats=stats)
+        next(assignments)
+        self.assertEqual(stages, [])
+        assignments.close()
+        self.assertEqual(len(stages), 3)
+        self.assertEqual(stats.queries, 1)
+
+    def test_summary(self):
+        stats = ConsensusStats()
+        uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                 stats=stats)
+        summary = stats.summary()
+        self.assertEqual(summary['queries'], 5)
+        self.assertEqual(summary['hit_histogram'], {1: 3, 2: 1, 3: 1})
+        self.assertEqual(summary['queries_per_second'],
+                         5 / stats.elapsed)
+        if summary['peak_memory'] is not None:
+            self.assertTrue(summary['peak_memory'] > 0)
+        self.assertIn('queries=5', repr(stats))
+
+    def test_pickle_drops_hooks(self):
+        stats = ConsensusStats(on_stage=lambda *args: None,
+                               on_query=lambda *args: None)
+        uc_consensus_assignments(io.StringIO(uc1), self.id_to_taxonomy,
+                                 stats=stats)
+        copy = pickle.loads(pickle.dumps(stats))
+        self.assertIsNone(copy.on_stage)
+        self.assertIsNone(copy.on_query)
+        self.assertEqual(copy.summary(), stats.summary())
+
+
+if __name__ == "__main__":
+    main()
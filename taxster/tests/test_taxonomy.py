@@ -0,0 +1,398 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import gzip
+import io
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+
+from taxster import (ConsensusCache, TaxonomyTable, load_taxonomy_map,
+                     uc_consensus_assignments, iter_uc_consensus_assignments)
+from taxster._taxonomy import _hash_bytes, _hash_fields
+from taxster.tests.test_uc import uc1, uc_many_queries
+
+import numpy as np
+
+
+class TaxonomyTableTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+
+    def test_mapping(self):
+        t = TaxonomyTable(self.id_to_taxonomy)
+        self.assertEqual(len(t), 6)
+        self.assertEqual(dict(t), self.id_to_taxonomy)
+        self.assertEqual(t['r5'], ['A', 'H', 'K', 'L', 'M'])
+        self.assertTrue('r1' in t)
+        self.assertFalse('r7' in t)
+        self.assertRaises(KeyError, t.__getitem__, 'r7')
+        self.assertRaises(KeyError, t.node, 'r7')
+
+    def test_empty(self):
+        t = TaxonomyTable()
+        self.assertEqual(len(t), 0)
+        self.assertEqual(t.n_nodes, 1)
+        self.assertEqual(t.path(t.root), [])
+        self.assertEqual(t.lineage(t.root), [])
+        self.assertEqual(t.depth(t.root), 0)
+
+    def test_lineages_interned(self):
+        t = TaxonomyTable(self.id_to_taxonomy)
+        self.assertEqual(t.node('r3'), t.node('r6'))
+        self.assertNotEqual(t.node('r2'), t.node('r4'))
+        # root, A, F, G, B, C, D, E, H, I, J, K, L, M
+        self.assertEqual(t.n_nodes, 14)
+
+    def test_path(self):
+        t = TaxonomyTable(self.id_to_taxonomy)
+        path = t.path(t.node('r2'))
+        self.assertEqual(len(path), 4)
+        self.assertEqual(path[-1], t.node('r2'))
+        self.assertEqual([t.lineage(n) for n in path],
+                         [['A'], ['A', 'B'], ['A', 'B', 'C'],
+                          ['A', 'B', 'C', 'D']])
+        self.assertEqual(path[:3], t.path(t.node('r4'))[:3])
+        self.assertEqual(t.depth(t.node('r5')), 5)
+
+    def test_same_label_different_prefix(self):
+        t = TaxonomyTable({'r1': ['a', 'b', 'c'], 'r2': ['z', 'y', 'c']})
+        self.assertNotEqual(t.node('r1'), t.node('r2'))
+        self.assertEqual(t['r2'], ['z', 'y', 'c'])
+
+    def test_add_and_intern(self):
+        t = TaxonomyTable()
+        node = t.intern(['A', 'B'])
+        self.assertEqual(len(t), 0)
+        self.assertEqual(t.add('r1', ['A', 'B']), node)
+        self.assertEqual(t.add('r2', ['A']), t.path(node)[0])
+        self.assertEqual(t.add('r3', []), t.root)
+        self.assertEqual(t['r3'], [])
+
+    def test_mutate_table_from_arrays(self):
+        t = TaxonomyTable(self.id_to_taxonomy)
+        t = TaxonomyTable._from_arrays(t.parents, t._labels, t.depths,
+                                       t._label_pool, dict(t._references))
+        self.assertEqual(dict(t), self.id_to_taxonomy)
+        n_nodes = t.n_nodes
+        self.assertEqual(t.intern(['A', 'H', 'I']), t.path(t.node('r3'))[2])
+        self.assertEqual(t.n_nodes, n_nodes)
+        t.add('r7', ['A', 'H', 'N'])
+        self.assertEqual(t['r7'], ['A', 'H', 'N'])
+        self.assertEqual(t.n_nodes, n_nodes + 1)
+
+
+class LoadTaxonomyMapTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'tax-map.tsv')
+        with open(self.path, 'w') as f:
+            f.write(tax_map1)
+        self.expected = {'r1': ['A', 'F', 'G'],
+                         'r2': ['A', 'B', 'C', 'D'],
+                         'r3': ['A', 'H', 'I', 'J'],
+                         'r4': ['A', 'B', 'C', 'E'],
+                         'r5': ['A', 'H', 'K', 'L', 'M'],
+                         'r6': ['A', 'H', 'I', 'J']}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_load_taxonomy_map(self):
+        actual = load_taxonomy_map(self.path, cache=False)
+        self.assertTrue(isinstance(actual, TaxonomyTable))
+        self.assertEqual(dict(actual), self.expected)
+        self.assertEqual(actual.node('r3'), actual.node('r6'))
+        self.assertFalse(os.path.exists(self.path + '.taxster-cache'))
+
+    def test_line_boundaries(self):
+        # characters that str.splitlines splits at are part of taxa
+        data = (u'r1\tA; B\x85C\n'
+                u'r2\tA; D\x0bE; F\u2028\r\n'
+                u'r3\tA; G\x1c')
+        expected = {'r1': ['A', u'B\x85C'], 'r2': ['A', u'D\x0bE', 'F'],
+                    'r3': ['A', 'G']}
+        with io.open(self.path, 'w', encoding='utf-8', newline='') as f:
+            f.write(data)
+        with gzip.open(self.path + '.gz', 'wb') as f:
+            f.write(data.encode('utf-8'))
+        for path in (self.path, self.path + '.gz'):
+            actual = load_taxonomy_map(path, cache=False)
+            self.assertEqual(dict(actual), expected)
+            # once to write the cache and once to read it
+            for _ in range(2):
+                self.assertEqual(dict(load_taxonomy_map(path)), expected)
+        self.assertEqual(load_taxonomy_map(self.path, lazy=True)['r2'],
+                         expected['r2'])
+
+    def test_cache(self):
+        first = load_taxonomy_map(self.path)
+        cache_dir = self.path + '.taxster-cache'
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, 'meta.json')))
+        second = load_taxonomy_map(self.path)
+        self.assertEqual(dict(second), self.expected)
+        self.assertEqual(second.n_nodes, first.n_nodes)
+        self.assertEqual([second.node(r) for r in sorted(second)],
+                         [first.node(r) for r in sorted(first)])
+        # loaded from the cache, so the interning indices are not built
+        self.assertTrue(second._children is None)
+
+    def test_cache_stays_mapped(self):
+        load_taxonomy_map(self.path)
+        table = load_taxonomy_map(self.path)
+        # the arrays are views of the memory-mapped cache, not copies
+        self.assertTrue(isinstance(table.parents, memoryview))
+        self.assertTrue(table.parents.readonly)
+        self.assertEqual(dict(pickle.loads(pickle.dumps(table))),
+                         self.expected)
+        # rewriting the cache doesn't change the arrays of loaded tables
+        with open(self.path, 'a') as f:
+            f.write('r7\tA; H; N\n')
+        load_taxonomy_map(self.path)
+        self.assertEqual(dict(table), self.expected)
+        # the arrays are copied to be extended
+        table.add('r7', ['A', 'H', 'N'])
+        self.assertFalse(isinstance(table.parents, memoryview))
+        self.expected['r7'] = ['A', 'H', 'N']
+        self.assertEqual(dict(table), self.expected)
+
+    def test_cache_directory(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        load_taxonomy_map(self.path, cache=cache_dir)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, 'meta.json')))
+        actual = load_taxonomy_map(self.path, cache=cache_dir)
+        self.assertTrue(actual._children is None)
+        self.assertEqual(dict(actual), self.expected)
+
+    def test_load_cache_directory(self):
+        load_taxonomy_map(self.path)
+        os.remove(self.path)
+        actual = load_taxonomy_map(self.path + '.taxster-cache')
+        self.assertEqual(dict(actual), self.expected)
+        self.assertRaises(ValueError, load_taxonomy_map, self.temp_dir)
+
+    def test_stale_cache(self):
+        load_taxonomy_map(self.path)
+        with open(self.path, 'a') as f:
+            f.write('r7\tA; H; N\n')
+        actual = load_taxonomy_map(self.path)
+        self.assertFalse(actual._children is None)
+        self.expected['r7'] = ['A', 'H', 'N']
+        self.assertEqual(dict(actual), self.expected)
+        actual = load_taxonomy_map(self.path)
+        self.assertTrue(actual._children is None)
+        self.assertEqual(dict(actual), self.expected)
+
+    def test_cache_checks_size_and_mtime(self):
+        load_taxonomy_map(self.path)
+        # the file isn't hashed while its size and modification time match
+        with mock.patch('taxster._taxonomy.hashlib.sha1') as sha1:
+            actual = load_taxonomy_map(self.path)
+        sha1.assert_not_called()
+        self.assertTrue(actual._children is None)
+        # a file that was only touched matches the cache by its hash, which
+        # is then recorded with the new modification time
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 10 ** 9))
+        actual = load_taxonomy_map(self.path)
+        self.assertTrue(actual._children is None)
+        self.assertEqual(dict(actual), self.expected)
+        with mock.patch('taxster._taxonomy.hashlib.sha1') as sha1:
+            actual = load_taxonomy_map(self.path)
+        sha1.assert_not_called()
+        self.assertEqual(dict(actual), self.expected)
+
+    def test_cached_references(self):
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(u'r2\tA; B\nr10\tA; C\n\xe9\tA; B\nr1\tA; B\n')
+        ids = ['r2', 'r10', '\xe9', 'r1']
+        first = load_taxonomy_map(self.path)
+        table = load_taxonomy_map(self.path)
+        # references are looked up in the cache instead of a dict
+        self.assertFalse(isinstance(table._references, dict))
+        self.assertEqual(list(table), ids)
+        self.assertEqual(table.nodes(ids), first.nodes(ids))
+        self.assertEqual(table['r10'], ['A', 'C'])
+        self.assertEqual(table['\xe9'], ['A', 'B'])
+        for missing in ('r0', 'r3', 'r', '', '\xff', 1):
+            self.assertFalse(missing in table)
+            self.assertRaises(KeyError, table.node, missing)
+        self.assertRaises(KeyError, table.nodes, ['r1', 'r3'])
+        self.assertEqual(dict(pickle.loads(pickle.dumps(table))),
+                         dict(first))
+        # they are copied into a dict to be extended
+        table.add('r3', ['A'])
+        self.assertTrue(isinstance(table._references, dict))
+        self.assertEqual(list(table), ids + ['r3'])
+        self.assertEqual(table.nodes(ids), first.nodes(ids))
+
+    def test_corrupt_cache(self):
+        load_taxonomy_map(self.path)
+        os.remove(os.path.join(self.path + '.taxster-cache', 'labels.npy'))
+        actual = load_taxonomy_map(self.path)
+        self.assertEqual(dict(actual), self.expected)
+
+    def test_empty_labels(self):
+        with open(self.path, 'w') as f:
+            f.write('r1\t\textra\n')
+        load_taxonomy_map(self.path)
+        actual = load_taxonomy_map(self.path)
+        self.assertTrue(actual._children is None)
+        self.assertEqual(dict(actual), {'r1': ['']})
+
+    def test_missing_annotation(self):
+        with open(self.path, 'w') as f:
+            f.write('# comment\nr1\tA; B\nr2\n')
+        self.assertRaisesRegex(ValueError, 'Line 3', load_taxonomy_map,
+                               self.path)
+
+
+class LazyTaxonomyMapTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'tax-map.tsv')
+        with open(self.path, 'w') as f:
+            f.write(tax_map1)
+        self.expected = load_taxonomy_map(self.path, cache=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_resolves_on_demand(self):
+        actual = load_taxonomy_map(self.path, lazy=True)
+        self.assertTrue(isinstance(actual, TaxonomyTable))
+        self.assertEqual(len(actual), 0)
+        self.assertEqual(actual['r5'], ['A', 'H', 'K', 'L', 'M'])
+        self.assertEqual(actual.nodes(['r3', 'r6', 'r5']),
+                         [actual.node('r6')] * 2 + [actual.node('r5')])
+        self.assertEqual(sorted(actual), ['r3', 'r5', 'r6'])
+        self.assertTrue('r1' in actual)
+        self.assertFalse('r7' in actual)
+        self.assertRaises(KeyError, actual.node, 'r7')
+        self.assertRaises(KeyError, actual.nodes, ['r1', 'r7'])
+        self.assertEqual(dict((r, actual[r]) for r in self.expected),
+                         dict(self.expected))
+
+    def test_single_lookups(self):
+        actual = load_taxonomy_map(self.path, lazy=True)
+        self.assertEqual(actual['r5'], ['A', 'H', 'K', 'L', 'M'])
+        # the taxonomy map stays mapped for later lookups
+        buffer = actual._buffer
+        self.assertFalse(buffer is None)
+        self.assertEqual(actual['r2'], ['A', 'B', 'C', 'D'])
+        self.assertTrue(actual._buffer is buffer)
+        # single and batched lookups hash identifiers the same way
+        ids = ['r1', 'r22', '', u'\xe9\u00e8x', 'a' * 40]
+        encoded = [i.encode('utf-8') for i in ids]
+        lengths = np.array([len(e) for e in encoded])
+        self.assertEqual(
+            [_hash_bytes(e) for e in encoded],
+            _hash_fields(np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                         np.cumsum(lengths) - lengths, lengths).tolist())
+        # the mapping isn't pickled
+        actual = pickle.loads(pickle.dumps(actual))
+        self.assertTrue(actual._buffer is None)
+        self.assertEqual(actual['r3'], ['A', 'H', 'I', 'J'])
+
+    def test_index(self):
+        index_dir = self.path + '.taxster-index'
+        load_taxonomy_map(self.path, lazy=True)
+        self.assertTrue(os.path.exists(os.path.join(index_dir, 'meta.json')))
+        self.assertFalse(os.path.exists(self.path + '.taxster-cache'))
+        actual = load_taxonomy_map(self.path, lazy=True)
+        self.assertEqual(actual['r2'], ['A', 'B', 'C', 'D'])
+        # the index is rebuilt when the file changes
+        with open(self.path, 'a') as f:
+            f.write('r7\tA; H; N\n')
+        actual = load_taxonomy_map(self.path, lazy=True)
+        self.assertEqual(actual['r7'], ['A', 'H', 'N'])
+        index_dir = os.path.join(self.temp_dir, 'index')
+        load_taxonomy_map(self.path, cache=index_dir, lazy=True)
+        self.assertTrue(os.path.exists(os.path.join(index_dir, 'meta.json')))
+        actual = load_taxonomy_map(self.path, cache=False, lazy=True)
+        self.assertEqual(actual['r7'], ['A', 'H', 'N'])
+
+    def test_irregular_lines(self):
+        with open(self.path, 'w') as f:
+            f.write('\n  # comment\n r1\tA; B\r\nr2\tA; C\n\r\n'
+                    'r1\tA; D\nr3\t\textra\nr4\tA; \xe9')
+        actual = load_taxonomy_map(self.path, cache=False, lazy=True)
+        self.assertEqual(actual['r1'], ['A', 'D'])
+        self.assertEqual(actual['r2'], ['A', 'C'])
+        self.assertEqual(actual['r3'], [''])
+        self.assertEqual(actual['r4'], ['A', '\xe9'])
+
+    def test_missing_annotation(self):
+        with open(self.path, 'w') as f:
+            f.write('# comment\nr1\tA; B\nr2\n')
+        self.assertRaisesRegex(ValueError, 'Line 3', load_taxonomy_map,
+                               self.path, lazy=True)
+
+    def test_empty(self):
+        open(self.path, 'w').close()
+        actual = load_taxonomy_map(self.path, lazy=True)
+        self.assertRaises(KeyError, actual.node, 'r1')
+
+    def test_compressed(self):
+        with gzip.open(self.path + '.gz', 'wt') as f:
+            f.write(tax_map1)
+        self.assertRaises(ValueError, load_taxonomy_map, self.path + '.gz',
+                          lazy=True)
+
+    def test_uc_consensus_assignments(self):
+        uc_path = os.path.join(self.temp_dir, 'in.uc')
+        with open(uc_path, 'w') as f:
+            f.write(uc1 + uc_many_queries)
+        expected = uc_consensus_assignments(uc_path, self.expected)
+        for uc in (lambda: uc_path,
+                   lambda: io.StringIO(uc1 + uc_many_queries)):
+            for kwargs in ({}, {'cache': ConsensusCache()}):
+                actual = load_taxonomy_map(self.path, lazy=True)
+                self.assertEqual(
+                    uc_consensus_assignments(uc(), actual, **kwargs),
+                    expected)
+                actual = load_taxonomy_map(self.path, lazy=True)
+                self.assertEqual(
+                    dict((a[0], a[1:]) for a in iter_uc_consensus_assignments(
+                        uc(), actual, **kwargs)),
+                    expected)
+        actual = load_taxonomy_map(self.path, lazy=True)
+        self.assertEqual(uc_consensus_assignments(uc_path, actual, n_jobs=2),
+                         expected)
+
+    def test_resolves_hit_references_only(self):
+        actual = load_taxonomy_map(self.path, lazy=True)
+        uc_consensus_assignments(io.StringIO(uc1), actual)
+        # uc1 doesn't hit r1
+        self.assertEqual(sorted(actual), ['r2', 'r3', 'r4', 'r5', 'r6'])
+
+
+tax_map1 = u"""# id\ttaxonomy
+r1\tA; F; G\textra\tinfo\tis\tignored
+r2\tA; B; C; D
+
+r3\tA; H; I; J
+r4\tA; B; C; E
+r5\tA; H; K; L; M
+r6\tA; H; I; J
+"""
+
+
+if __name__ == "__main__":
+    main()
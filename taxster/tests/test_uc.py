@@ -7,12 +7,24 @@
 # ----------------------------------------------------------------------------
 
 import io
+import os
+import pickle
+import random
+import shutil
+import tempfile
 from unittest import TestCase, main
 
-from taxster._uc import (_compute_consensus_annotation,
+from taxster._uc import (_CompletedQueries, _TopHits,
+                         _compute_consensus_annotation,
                          _compute_consensus_annotations,
+                         _compute_consensus_node,
+                         _compute_consensus_nodes,
+                         _iter_uc_query_taxonomy,
+                         _uc_to_hit_arrays,
                          _uc_to_taxonomy)
-from taxster import uc_consensus_assignments
+from taxster import (uc_consensus_assignments, iter_uc_consensus_assignments,
+                     uc_consensus_lineages, uc_consensus_thresholds,
+                     ConsensusCache, ConsensusStats, TaxonomyTable)
 
 
 class ConsensusAnnotationTests(TestCase):
@@ -124,6 +136,46 @@ class ConsensusAnnotationTests(TestCase):
         expected = (['Ab', 'Bc', 'Fg'], 1.0)
         self.assertEqual(actual, expected)
 
+    def test_identical_annotations(self):
+        in_ = [['Ab', 'Bc', 'De']] * 5
+        actual = _compute_consensus_annotation(in_, 0.51, "Unassigned")
+        expected = (['Ab', 'Bc', 'De'], 1.0)
+        self.assertEqual(actual, expected)
+
+        actual = _compute_consensus_annotation([[]] * 3, 0.51, "Unassigned")
+        expected = (['Unassigned'], 1.0)
+        self.assertEqual(actual, expected)
+
+        # no level can be accepted if min_consensus_fraction > 1.0
+        actual = _compute_consensus_annotation(in_, 1.5, "Unassigned")
+        expected = (['Unassigned'], 1.0)
+        self.assertEqual(actual, expected)
+
+    def test_single_remaining_lineage(self):
+        # after the second level only one distinct lineage remains, and
+        # it is truncated to the depth of the shallowest annotation
+        in_ = [['Ab', 'Bc', 'De', 'Fg', 'Hi'],
+               ['Ab', 'Bc', 'De', 'Fg', 'Hi'],
+               ['Ab', 'Bc', 'De', 'Fg', 'Hi'],
+               ['Ab', 'Cd', 'Ef', 'Gh']]
+        actual = _compute_consensus_annotation(in_, 0.51, "Unassigned")
+        expected = (['Ab', 'Bc', 'De', 'Fg'], 0.75)
+        self.assertEqual(actual, expected)
+
+        actual = _compute_consensus_annotation(in_, 0.8, "Unassigned")
+        expected = (['Ab'], 1.0)
+        self.assertEqual(actual, expected)
+
+    def test_many_annotations(self):
+        # 60% of the hits agree to the genus level, and the species are all
+        # different
+        in_ = [['k', 'p', 'c', 'o', 'f', 'g1', 's%d' % i] for i in range(60)]
+        in_ += [['k', 'p', 'c', 'o', 'f', 'g2', 's%d' % i]
+                for i in range(40)]
+        actual = _compute_consensus_annotation(in_, 0.51, "Unassigned")
+        expected = (['k', 'p', 'c', 'o', 'f', 'g1'], 0.6)
+        self.assertEqual(actual, expected)
+
 
 class ConsensusAnnotationsTests(TestCase):
 
@@ -174,6 +226,65 @@ class ConsensusAnnotationsTests(TestCase):
         self.assertEqual(actual, expected)
 
 
+class ConsensusNodeTests(TestCase):
+
+    def assertMatchesAnnotationConsensus(self, annotations,
+                                         min_consensus_fraction):
+        expected = _compute_consensus_annotation(
+            annotations, min_consensus_fraction, "Unassigned")
+        table = TaxonomyTable()
+        nodes = [table.intern(a) for a in annotations]
+        node, fraction = _compute_consensus_node(nodes, table,
+                                                 min_consensus_fraction)
+        if expected[0] == ["Unassigned"]:
+            self.assertEqual(node, table.root)
+        else:
+            self.assertEqual(table.lineage(node), expected[0])
+        self.assertEqual(fraction, expected[1])
+
+    def test_matches_annotation_consensus(self):
+        ins = [[['Ab', 'Bc', 'De'],
+                ['Ab', 'Bc', 'Fg', 'Hi'],
+                ['Ab', 'Bc', 'Fg', 'Jk']],
+               [['Ab', 'Bc', 'De']],
+               [['Ab', 'Bc', 'De'],
+                ['Cd', 'Bc', 'Fg', 'Hi'],
+                ['Ef', 'Bc', 'Fg', 'Jk']],
+               [['Ab', 'Bc', 'De', 'Jk'],
+                ['Ab', 'Bc', 'Fg', 'Jk'],
+                ['Ab', 'Bc', 'Hi', 'Jk']],
+               [['a', 'b', 'c'],
+                ['a', 'd', 'e'],
+                ['a', 'b', 'c'],
+                ['a', 'b', 'c'],
+                ['z', 'y', 'c']],
+               [['Ab', 'Bc', 'Fg'],
+                ['Ab', 'Bc', 'Fg', 'Hi', 'Jk'],
+                ['Ab', 'Bc', 'Fg', 'Hi', 'Jk']],
+               [[]],
+               [['A', 'B'], []]]
+        for in_ in ins:
+            for min_consensus_fraction in (0.51, 0.6, 0.99, 1.0):
+                self.assertMatchesAnnotationConsensus(in_,
+                                                      min_consensus_fraction)
+
+    def test_invalid_min_consensus_fraction(self):
+        table = TaxonomyTable()
+        nodes = [table.intern(['Ab', 'Bc'])]
+        self.assertRaises(ValueError, _compute_consensus_node, nodes, table,
+                          0.50)
+
+    def test_compute_consensus_nodes(self):
+        table = TaxonomyTable()
+        in_ = {'q1': [table.intern(['A', 'B', 'C', 'D']),
+                      table.intern(['A', 'B', 'C', 'E'])],
+               'q2': [table.root]}
+        expected = {'q1': (['A', 'B', 'C'], 1.0, 2),
+                    'q2': (['x'], 1.0, 1)}
+        actual = _compute_consensus_nodes(in_, table, 0.51, "x")
+        self.assertEqual(actual, expected)
+
+
 class UcToAssignments(TestCase):
 
     # This code has been ported to taxster from QIIME 1.9.1 with
@@ -198,6 +309,23 @@ class UcToAssignments(TestCase):
         actual = _uc_to_taxonomy(in_, id_to_taxonomy)
         self.assertEqual(actual, expected)
 
+    def test_uc_to_hit_arrays(self):
+        table = TaxonomyTable({'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']})
+        in_ = io.StringIO(uc1)
+        query_ids, query_index, nodes = _uc_to_hit_arrays(in_, table)
+        self.assertEqual(query_ids, ['q3', 'q4', 'q5', 'q2', 'q1'])
+        self.assertEqual(query_index.tolist(), [0, 1, 2, 3, 3, 3, 4, 4])
+        self.assertEqual(nodes.tolist(),
+                         [table.root, table.root, table.root,
+                          table.node('r3'), table.node('r5'),
+                          table.node('r6'), table.node('r2'),
+                          table.node('r4')])
+
 
 class UcConsensusAssignments(TestCase):
 
@@ -236,6 +364,444 @@ class UcConsensusAssignments(TestCase):
         actual = uc_consensus_assignments(in_, id_to_taxonomy, 1.0, 'x')
         self.assertEqual(actual, expected)
 
+    def test_taxonomy_table(self):
+        id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                          'r2': ['A', 'B', 'C', 'D'],
+                          'r3': ['A', 'H', 'I', 'J'],
+                          'r4': ['A', 'B', 'C', 'E'],
+                          'r5': ['A', 'H', 'K', 'L', 'M'],
+                          'r6': ['A', 'H', 'I', 'J']}
+        table = TaxonomyTable(id_to_taxonomy)
+        for params in [(), (1.0, 'x')]:
+            expected = uc_consensus_assignments(io.StringIO(uc1),
+                                                id_to_taxonomy, *params)
+            actual = uc_consensus_assignments(io.StringIO(uc1), table,
+                                              *params)
+            self.assertEqual(actual, expected)
+
+
+class ParallelUcConsensusAssignments(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data):
+        path = os.path.join(self.temp_dir, 'in.uc')
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_matches_serial(self):
+        path = self._write(uc1 + uc_many_queries)
+        for taxonomy_map in (self.id_to_taxonomy,
+                             TaxonomyTable(self.id_to_taxonomy)):
+            for params in [(), (1.0, 'x')]:
+                expected = uc_consensus_assignments(
+                    io.StringIO(uc1 + uc_many_queries), taxonomy_map,
+                    *params)
+                actual = uc_consensus_assignments(path, taxonomy_map,
+                                                  *params, n_jobs=2)
+                self.assertEqual(actual, expected)
+                with open(path) as f:
+                    actual = uc_consensus_assignments(f, taxonomy_map,
+                                                      *params, n_jobs=3)
+                self.assertEqual(actual, expected)
+
+    def test_ungrouped_input(self):
+        path = self._write(uc_many_queries + uc_many_queries)
+        self.assertRaisesRegex(ValueError, 'not adjacent',
+                               uc_consensus_assignments, path,
+                               self.id_to_taxonomy, n_jobs=2)
+
+    def test_requires_path(self):
+        self.assertRaises(ValueError, uc_consensus_assignments,
+                          io.StringIO(uc1), self.id_to_taxonomy, n_jobs=2)
+
+    def test_path(self):
+        path = self._write(uc1)
+        for taxonomy_map in (self.id_to_taxonomy,
+                             TaxonomyTable(self.id_to_taxonomy)):
+            expected = uc_consensus_assignments(io.StringIO(uc1),
+                                                taxonomy_map)
+            actual = uc_consensus_assignments(path, taxonomy_map)
+            self.assertEqual(actual, expected)
+            expected = list(iter_uc_consensus_assignments(io.StringIO(uc1),
+                                                          taxonomy_map))
+            actual = list(iter_uc_consensus_assignments(path, taxonomy_map))
+            self.assertEqual(actual, expected)
+
+    def test_invalid_min_consensus_fraction(self):
+        path = self._write(uc1)
+        self.assertRaises(ValueError, uc_consensus_assignments, path,
+                          self.id_to_taxonomy, 0.5, n_jobs=2)
+
+
+class IterUcConsensusAssignments(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+
+    def test_iter_uc_consensus_assignments(self):
+        expected = [('q3', ['Unassigned'], 1.0, 1),
+                    ('q4', ['Unassigned'], 1.0, 1),
+                    ('q5', ['Unassigned'], 1.0, 1),
+                    ('q2', ['A', 'H', 'I', 'J'], 2. / 3., 3),
+                    ('q1', ['A', 'B', 'C'], 1.0, 2)]
+        in_ = io.StringIO(uc1)
+        actual = list(iter_uc_consensus_assignments(in_, self.id_to_taxonomy))
+        self.assertEqual(actual, expected)
+
+    def test_matches_uc_consensus_assignments(self):
+        in_ = io.StringIO(uc1)
+        expected = uc_consensus_assignments(in_, self.id_to_taxonomy, 1.0, 'x')
+        in_ = io.StringIO(uc1)
+        actual = {q: (a, f, n) for q, a, f, n in
+                  iter_uc_consensus_assignments(in_, self.id_to_taxonomy,
+                                                1.0, 'x')}
+        self.assertEqual(actual, expected)
+
+    def test_yields_before_end_of_input(self):
+        in_ = io.StringIO(uc1)
+        gen = iter_uc_consensus_assignments(in_, self.id_to_taxonomy)
+        self.assertEqual(next(gen)[0], 'q3')
+        self.assertTrue(in_.tell() < len(uc1))
+
+    def test_ungrouped_input(self):
+        in_ = io.StringIO(uc_ungrouped)
+        gen = iter_uc_consensus_assignments(in_, self.id_to_taxonomy)
+        self.assertEqual(next(gen)[0], 'q2')
+        self.assertEqual(next(gen)[0], 'q1')
+        self.assertRaisesRegex(ValueError, 'q2', next, gen)
+
+    def test_completed_queries(self):
+        completed = _CompletedQueries(size=4096)
+        query_ids = ['q%d' % i for i in range(100000)]
+        for query_id in query_ids:
+            # grouped input is never rejected
+            self.assertFalse(query_id in completed)
+            completed.add(query_id)
+            self.assertTrue(query_id in completed)
+        # the table doesn't grow past its size
+        self.assertEqual(len(completed._slots), 4096)
+        # recent queries are still detected
+        self.assertTrue(sum(q in completed for q in query_ids[-100:]) > 90)
+
+    def test_invalid_min_consensus_fraction(self):
+        in_ = io.StringIO(uc1)
+        gen = iter_uc_consensus_assignments(in_, self.id_to_taxonomy, 0.5)
+        self.assertRaises(ValueError, next, gen)
+
+    def test_taxonomy_table(self):
+        table = TaxonomyTable(self.id_to_taxonomy)
+        expected = list(iter_uc_consensus_assignments(
+            io.StringIO(uc1), self.id_to_taxonomy, 1.0, 'x'))
+        actual = list(iter_uc_consensus_assignments(
+            io.StringIO(uc1), table, 1.0, 'x'))
+        self.assertEqual(actual, expected)
+
+    def test_iter_uc_query_taxonomy(self):
+        in_ = io.StringIO(uc1)
+        actual = dict(_iter_uc_query_taxonomy(in_, self.id_to_taxonomy))
+        in_ = io.StringIO(uc1)
+        expected = _uc_to_taxonomy(in_, self.id_to_taxonomy)
+        self.assertEqual(actual, expected)
+
+
+class HitSelectionTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.taxonomy_maps = (self.id_to_taxonomy,
+                              TaxonomyTable(self.id_to_taxonomy))
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data):
+        path = os.path.join(self.temp_dir, 'in.uc')
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def _all_paths(self, data, *args, **kwargs):
+        """ Compute the assignments of ``data`` by every code path """
+        path = self._write(data)
+        results = []
+        for taxonomy_map in self.taxonomy_maps:
+            for uc in (io.StringIO(data), path):
+                results.append(uc_consensus_assignments(
+                    uc, taxonomy_map, *args, **kwargs))
+            for uc in (io.StringIO(data), path):
+                results.append({q: (a, f, n) for q, a, f, n in
+                                iter_uc_consensus_assignments(
+                                    uc, taxonomy_map, *args, **kwargs)})
+            results.append(uc_consensus_assignments(
+                path, taxonomy_map, *args, n_jobs=2, **kwargs))
+            results.append(uc_consensus_assignments(
+                path, taxonomy_map, *args, stats=ConsensusStats(), **kwargs))
+        return results
+
+    def test_max_hits(self):
+        expected = {'q1': (['A', 'B', 'C', 'E'], 1.0, 1),
+                    'q2': (['A', 'H', 'I', 'J'], 1.0, 1),
+                    'q3': (['Unassigned'], 1.0, 1),
+                    'q4': (['Unassigned'], 1.0, 1),
+                    'q5': (['Unassigned'], 1.0, 1)}
+        for actual in self._all_paths(uc1, max_hits=1):
+            self.assertEqual(actual, expected)
+        # r5 and r6 have the same identity, so the first is kept
+        expected['q1'] = (['A', 'B', 'C'], 1.0, 2)
+        expected['q2'] = (['A', 'H'], 1.0, 2)
+        for actual in self._all_paths(uc1, max_hits=2):
+            self.assertEqual(actual, expected)
+
+    def test_max_hits_matches_all_hits(self):
+        data = uc1 + uc_many_queries
+        expected = uc_consensus_assignments(io.StringIO(data),
+                                            self.id_to_taxonomy, 1.0, 'x')
+        for actual in self._all_paths(data, 1.0, 'x', max_hits=3):
+            self.assertEqual(actual, expected)
+
+    def test_max_hits_keeps_highest_identities(self):
+        data = (u"H\tr1\t1\t90.0\t+\t0\t0\t1M\tq1\tr1\n"
+                u"H\tr3\t1\t99.0\t+\t0\t0\t1M\tq1\tr3\n"
+                u"H\tr2\t1\t95.0\t+\t0\t0\t1M\tq1\tr2\n"
+                u"H\tr6\t1\t99.5\t+\t0\t0\t1M\tq1\tr6\n")
+        expected = {'q1': (['A', 'H', 'I', 'J'], 1.0, 2)}
+        for actual in self._all_paths(data, max_hits=2):
+            self.assertEqual(actual, expected)
+
+    def test_ungrouped_input(self):
+        expected = {'q1': (['A', 'B', 'C', 'D'], 1.0, 1),
+                    'q2': (['A', 'H', 'I', 'J'], 1.0, 1)}
+        for taxonomy_map in self.taxonomy_maps:
+            actual = uc_consensus_assignments(io.StringIO(uc_ungrouped),
+                                              taxonomy_map, max_hits=1)
+            self.assertEqual(actual, expected)
+            gen = iter_uc_consensus_assignments(io.StringIO(uc_ungrouped),
+                                                taxonomy_map, max_hits=1)
+            self.assertRaisesRegex(ValueError, 'q2', list, gen)
+
+    def test_weighted(self):
+        expected = {'q1': (['A', 'B', 'C'], 1.0, 2),
+                    'q2': (['A', 'H', 'I', 'J'], 197. / 294., 3),
+                    'q3': (['Unassigned'], 1.0, 1),
+                    'q4': (['Unassigned'], 1.0, 1),
+                    'q5': (['Unassigned'], 1.0, 1)}
+        for actual in self._all_paths(uc1, weighted=True):
+            self.assertEqual(actual, expected)
+
+    def test_weighted_changes_consensus(self):
+        data = (u"H\tr3\t1\t100.0\t+\t0\t0\t1M\tq1\tr3\n"
+                u"H\tr5\t1\t60.0\t+\t0\t0\t1M\tq1\tr5\n")
+        self.assertEqual(
+            uc_consensus_assignments(io.StringIO(data), self.id_to_taxonomy,
+                                     0.6),
+            {'q1': (['A', 'H'], 1.0, 2)})
+        for actual in self._all_paths(data, 0.6, weighted=True):
+            self.assertEqual(actual, {'q1': (['A', 'H', 'I', 'J'], 0.625, 2)})
+        for actual in self._all_paths(data, 0.6, max_hits=1, weighted=True):
+            self.assertEqual(actual, {'q1': (['A', 'H', 'I', 'J'], 1.0, 1)})
+
+    def test_weighted_without_weight(self):
+        data = u"H\tr3\t1\t0.0\t+\t0\t0\t1M\tq1\tr3\n"
+        for actual in self._all_paths(data, weighted=True):
+            self.assertEqual(actual, {'q1': (['Unassigned'], 1.0, 1)})
+
+    def test_selection_matches_query_by_query(self):
+        rng = random.Random(0)
+        lines = []
+        for q in range(40):
+            for _ in range(rng.randint(1, 8)):
+                if rng.random() < 0.1:
+                    lines.append('N\t*\t*\t*\t*\t*\t*\t*\tq%d\t*' % q)
+                    continue
+                target = rng.choice(['r1', 'r2', 'r3', 'r4', 'r5', 'r6',
+                                     'missing'])
+                lines.append('H\t0\t100\t%.1f\t+\t0\t0\t*\tq%d\t%s'
+                             % (rng.choice([90.0, 97.5, rng.uniform(80, 100)]),
+                                q, target))
+        data = '\n'.join(lines) + '\n'
+        for kwargs in ({'max_hits': 3}, {'weighted': True},
+                       {'max_hits': 2, 'weighted': True}):
+            for errors in ('skip', 'unassigned'):
+                expected = {q: (a, f, n) for q, a, f, n in
+                            iter_uc_consensus_assignments(
+                                io.StringIO(data), self.id_to_taxonomy,
+                                0.6, 'x', errors=errors, **kwargs)}
+                for actual in self._all_paths(data, 0.6, 'x', errors=errors,
+                                              **kwargs):
+                    self.assertEqual(actual, expected)
+
+    def test_cache(self):
+        cache = ConsensusCache()
+        expected = uc_consensus_assignments(io.StringIO(uc1),
+                                            self.id_to_taxonomy, max_hits=2)
+        actual = uc_consensus_assignments(io.StringIO(uc1),
+                                          self.id_to_taxonomy, max_hits=2,
+                                          cache=cache)
+        self.assertEqual(actual, expected)
+        actual = {q: (a, f, n) for q, a, f, n in
+                  iter_uc_consensus_assignments(
+                      io.StringIO(uc1), self.id_to_taxonomy, max_hits=2,
+                      cache=cache, stats=ConsensusStats())}
+        self.assertEqual(actual, expected)
+        # q3, q4 and q5 share a key, and the second run only hits
+        self.assertEqual(cache.hits, 7)
+        self.assertRaises(ValueError, uc_consensus_assignments,
+                          io.StringIO(uc1), self.id_to_taxonomy,
+                          weighted=True, cache=cache)
+
+    def test_stats(self):
+        stats = ConsensusStats()
+        list(iter_uc_consensus_assignments(io.StringIO(uc1),
+                                           self.id_to_taxonomy, max_hits=2,
+                                           stats=stats))
+        self.assertEqual(stats.records_parsed, 8)
+        self.assertEqual(stats.queries, 5)
+        self.assertEqual(stats.hit_histogram, {1: 3, 2: 2})
+
+    def test_invalid_max_hits(self):
+        self.assertRaises(ValueError, uc_consensus_assignments,
+                          io.StringIO(uc1), self.id_to_taxonomy, max_hits=0)
+        gen = iter_uc_consensus_assignments(io.StringIO(uc1),
+                                            self.id_to_taxonomy, max_hits=0)
+        self.assertRaises(ValueError, next, gen)
+
+    def test_malformed_identity(self):
+        data = u"H\tr3\t1\tx\t+\t0\t0\t1M\tq1\tr3\n"
+        path = self._write(data)
+        for uc in (io.StringIO(data), path):
+            self.assertRaisesRegex(ValueError, 'Malformed .uc record',
+                                   uc_consensus_assignments, uc,
+                                   self.id_to_taxonomy, weighted=True)
+
+    def test_top_hits(self):
+        top_hits = _TopHits(2)
+        for i, identity in enumerate([90.0, 97.0, 95.0, 97.0, 99.0]):
+            top_hits.add('r%d' % i, identity)
+            self.assertTrue(len(top_hits._hits) <= 2)
+        self.assertEqual(top_hits.hits(), (['r1', 'r4'], [97.0, 99.0]))
+        top_hits = _TopHits()
+        top_hits.add('r1', 90.0)
+        top_hits.add(None, 0.0)
+        self.assertEqual(top_hits.hits(), (['r1', None], [90.0, 0.0]))
+
+
+class ConsensusLineagesTests(TestCase):
+
+    def setUp(self):
+        self.id_to_taxonomy = {'r1': ['A', 'F', 'G'],
+                               'r2': ['A', 'B', 'C', 'D'],
+                               'r3': ['A', 'H', 'I', 'J'],
+                               'r4': ['A', 'B', 'C', 'E'],
+                               'r5': ['A', 'H', 'K', 'L', 'M'],
+                               'r6': ['A', 'H', 'I', 'J']}
+        self.taxonomy_maps = (self.id_to_taxonomy,
+                              TaxonomyTable(self.id_to_taxonomy))
+
+    def test_uc_consensus_lineages(self):
+        expected = {'q1': (['A', 'B', 'C'], [1.0, 1.0, 1.0], 2),
+                    'q2': (['A', 'H', 'I', 'J'],
+                           [1.0, 1.0, 2. / 3., 2. / 3.], 3),
+                    'q3': ([], [], 1),
+                    'q4': ([], [], 1),
+                    'q5': ([], [], 1)}
+        for taxonomy_map in self.taxonomy_maps:
+            actual = uc_consensus_lineages(io.StringIO(uc1), taxonomy_map)
+            self.assertEqual(actual, expected)
+            self.assertEqual(actual.rank_fractions.shape, (5, 4))
+
+    def test_weighted(self):
+        actual = uc_consensus_lineages(io.StringIO(uc1), self.id_to_taxonomy,
+                                       weighted=True)
+        self.assertEqual(actual['q1'][0], ['A', 'B', 'C', 'E'])
+        self.assertAlmostEqual(actual['q1'][1][3], 100.0 / 199.0)
+        actual = uc_consensus_lineages(io.StringIO(uc1), self.id_to_taxonomy,
+                                       max_hits=1)
+        self.assertEqual(actual['q2'], (['A', 'H', 'I', 'J'],
+                                        [1.0, 1.0, 1.0, 1.0], 1))
+
+    def test_assignments(self):
+        for kwargs in ({}, {'max_hits': 2}, {'weighted': True}):
+            lineages = uc_consensus_lineages(io.StringIO(uc1),
+                                             self.id_to_taxonomy, **kwargs)
+            for min_consensus_fraction in (0.51, 0.6, 0.7, 1.0):
+                expected = uc_consensus_assignments(
+                    io.StringIO(uc1), self.id_to_taxonomy,
+                    min_consensus_fraction, 'x', **kwargs)
+                self.assertEqual(
+                    lineages.assignments(min_consensus_fraction, 'x'),
+                    expected)
+        self.assertRaises(ValueError, lineages.assignments, 0.5)
+
+    def test_uc_consensus_thresholds(self):
+        rng = random.Random(0)
+        references = {}
+        for i in range(30):
+            depth = rng.randint(1, 6)
+            references['r%d' % i] = ['%d%d' % (level, rng.randrange(2))
+                                     for level in range(depth)]
+        lines = []
+        for q in range(50):
+            for _ in range(rng.randint(1, 10)):
+                if rng.random() < 0.05:
+                    lines.append('N\t*\t*\t*\t*\t*\t*\t*\tq%d\t*' % q)
+                    continue
+                lines.append('H\t0\t100\t%.1f\t+\t0\t0\t*\tq%d\tr%d'
+                             % (rng.uniform(90, 100), q, rng.randrange(30)))
+        data = '\n'.join(lines) + '\n'
+        thresholds = [0.51, 0.67, 0.8, 1.0]
+        for kwargs in ({}, {'max_hits': 3}, {'weighted': True}):
+            for taxonomy_map in (references, TaxonomyTable(references)):
+                actual = uc_consensus_thresholds(
+                    io.StringIO(data), taxonomy_map, thresholds, 'x',
+                    **kwargs)
+                self.assertEqual(list(actual), thresholds)
+                for threshold in thresholds:
+                    self.assertEqual(actual[threshold],
+                                     uc_consensus_assignments(
+                                         io.StringIO(data), taxonomy_map,
+                                         threshold, 'x', **kwargs))
+
+    def test_empty(self):
+        actual = uc_consensus_lineages(io.StringIO(u''), self.id_to_taxonomy)
+        self.assertEqual(actual, {})
+        self.assertEqual(actual.assignments(), {})
+        self.assertEqual(uc_consensus_thresholds(
+            io.StringIO(u''), self.id_to_taxonomy, [0.51]), {0.51: {}})
+
+    def test_pickle(self):
+        lineages = uc_consensus_lineages(io.StringIO(uc1),
+                                         self.id_to_taxonomy)
+        self.assertEqual(pickle.loads(pickle.dumps(lineages)), lineages)
+
+    def test_invalid_parameters(self):
+        self.assertRaises(ValueError, uc_consensus_thresholds,
+                          io.StringIO(uc1), self.id_to_taxonomy, [0.51, 0.5])
+        self.assertRaises(ValueError, uc_consensus_lineages,
+                          io.StringIO(uc1), self.id_to_taxonomy, max_hits=0)
+
 
 uc1 = u"""# uclust --input /Users/caporaso/Dropbox/code/short-read...
 # version=1.2.22
@@ -257,6 +823,15 @@ H	r2	189	99.0	+	0	0	531I189M821I	q1	r2
 H	r4	189	100.0	+	0	0	531I189M821I	q1	r4
 """
 
+uc_ungrouped = u"""H	r3	193	100.0	+	0	0	534I193M787I	q2	r3
+H	r2	189	99.0	+	0	0	531I189M821I	q1	r2
+H	r5	193	97.0	+	0	0	534I193M787I	q2	r5
+"""
+
+uc_many_queries = u"".join(
+    u"H\tr%d\t193\t97.0\t+\t0\t0\t193M\tm%d\tr%d\n" % (r, q, r)
+    for q in range(40) for r in range(1, 7)[q % 6:q % 6 + 1 + q % 3])
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,189 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+
+import numpy as np
+import numpy.testing as npt
+
+from taxster import TaxonomyTable, UcErrors, uc_consensus_assignments
+from taxster._errors import _RecordChecker
+from taxster._uc import _iter_uc_lines, _uc_to_hit_arrays
+from taxster._ucio import (_UcRange, _gather_words, _iter_uc_chunks,
+                           _iter_uc_hits_mmap, _scan_uc_chunk,
+                           _uc_hit_arrays_mmap, _unique_labels)
+from taxster.tests.test_uc import uc1
+
+
+class UcMmapTests(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.table = TaxonomyTable({'r1': ['A', 'F', 'G'],
+                                    'r2': ['A', 'B', 'C', 'D'],
+                                    'r3': ['A', 'H', 'I', 'J'],
+                                    'r4': ['A', 'B', 'C', 'E'],
+                                    'r5': ['A', 'H', 'K', 'L', 'M'],
+                                    'r6': ['A', 'H', 'I', 'J']})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data):
+        path = os.path.join(self.temp_dir, 'in.uc')
+        with io.open(path, 'w', newline='') as f:
+            f.write(data)
+        return path
+
+    def test_scan_uc_chunk(self):
+        data = (b'# comment\n'
+                b'\n'
+                b'L\t748\t1374\t*\t*\t*\t*\t*\t1081058\t*\n'
+                b'H\tr3\t193\t100.0\t+\t0\t0\t534I\tq2 some desc\tr3\r\n'
+                b'N\t*\t195\t*\t*\t*\t*\t*\t q3\n'
+                b'H\tr5\t193\t97.0\t+\t0\t0\t534I\tq2\tr5 x\textra')
+        is_hit, queries, targets = _scan_uc_chunk(
+            np.frombuffer(data, dtype=np.uint8))
+        npt.assert_array_equal(is_hit, [True, False, True])
+        self.assertEqual(queries.tolist(), [b'q2', b'q3', b'q2'])
+        self.assertEqual(targets[is_hit].tolist(), [b'r3', b'r5'])
+
+    def test_scan_uc_chunk_malformed(self):
+        data = b'H\tr3\t193\t100.0\t+\t0\t0\t534I\tq2\n'
+        self.assertRaisesRegex(ValueError, 'Malformed', _scan_uc_chunk,
+                               np.frombuffer(data, dtype=np.uint8))
+
+    def test_scan_uc_chunk_long_label(self):
+        long_label = b'q' * 100000
+        data = (b'H\tr1\t193\t99.0\t+\t0\t0\t1M\tq1\tr1\n' * 1000 +
+                b'H\tr2\t193\t99.0\t+\t0\t0\t1M\t' + long_label +
+                b' desc\tr2\n'
+                b'N\t*\t195\t*\t*\t*\t*\t*\t' + b'p' * 300 + b'\t*\n')
+        gathered = []
+
+        def gather_words(*args):
+            words = _gather_words(*args)
+            gathered.append(words.nbytes)
+            return words
+        with mock.patch('taxster._ucio._gather_words', gather_words):
+            is_hit, queries, targets = _scan_uc_chunk(
+                np.frombuffer(data, dtype=np.uint8))
+        # the other labels aren't widened to the longest one
+        self.assertLess(sum(gathered), 2 * len(data))
+        queries = queries.tolist()
+        self.assertEqual(queries[-3:], [b'q1', long_label, b'p' * 300])
+        self.assertEqual(targets[is_hit].tolist()[-2:], [b'r1', b'r2'])
+        path = self._write(data.decode('utf-8'))
+        expected = _uc_to_hit_arrays(io.StringIO(data.decode('utf-8')),
+                                     self.table)
+        actual = _uc_hit_arrays_mmap(path, self.table)
+        self.assertEqual(actual[0], expected[0])
+        npt.assert_array_equal(actual[2], expected[2])
+
+    def test_whitespace_as_line_parser(self):
+        # fields are split as str.strip and str.split split them
+        data = (u'  H\tr1\t193\t99.0\t+\t0\t0\t1M\tq1\tr1\n'
+                u'\tH\tr2\t193\t99.0\t+\t0\t0\t1M\tq1 x\tr2\n'
+                u'H\tr3\t193\t99.0\t+\t0\t0\t1M\tq2\x0bx\tr3\n'
+                u'H\tr4\t193\t99.0\t+\t0\t0\t1M\tq2\x1c\tr4\x0c\n'
+                u'N\t*\t195\t*\t*\t*\t*\t*\tq3\xa0x\t*\n'
+                u'\xa0N\t*\t195\t*\t*\t*\t*\t*\tq4\u2003\t*\n'
+                u'H\tr5\t193\t99.0\t+\t0\t0\t1M\t\xe9q5\tr5 \xe9\n' +
+                u'N\t*\t195\t*\t*\t*\t*\t*\tq6\t*\r\n' * 20 +
+                u'H\tr1\t193\t99.0\t+\t0\t0\t1M\tq7\t\x0b\n'
+                u'N\t*\t195\t*\t*\t*\t*\t*\t \t*\n'
+                u'  # comment\n'
+                u' \x0c\r\n'
+                u'S\t0\t193\t*\t*\t*\t*\t*\tq8\t*\n'
+                u' C\t0\t1\t*\t*\t*\t*\t*\tq8\t*\n'
+                u'\xe9\t*\n'
+                u'H\tr1\t193\n')
+        path = self._write(data)
+        expected_errors = UcErrors('skip')
+        expected = list(_iter_uc_lines(
+            io.StringIO(data), checker=_RecordChecker(expected_errors)))
+        errors = UcErrors('skip')
+        self.assertEqual(
+            list(_iter_uc_hits_mmap(path, checker=_RecordChecker(errors))),
+            expected)
+        self.assertEqual(errors.summary(), expected_errors.summary())
+        self.assertEqual(expected_errors.malformed_records, 3)
+        self.assertEqual([query for query, _ in expected[:6]],
+                         ['q1', 'q1', 'q2', 'q2', 'q3', 'q4'])
+        for policy, n_jobs in (('skip', 1), ('unassigned', 1),
+                               ('skip', 2)):
+            expected_errors = UcErrors(policy)
+            expected = uc_consensus_assignments(
+                io.StringIO(data), self.table, errors=expected_errors)
+            errors = UcErrors(policy)
+            self.assertEqual(
+                uc_consensus_assignments(path, self.table, n_jobs=n_jobs,
+                                         errors=errors),
+                expected)
+            self.assertEqual(errors.summary(), expected_errors.summary())
+
+    def test_iter_uc_chunks(self):
+        path = self._write(uc1)
+        for chunk_size in (1, 10, 100, 1 << 24):
+            chunks = [c.tobytes() for c in _iter_uc_chunks(path, chunk_size)]
+            self.assertEqual(b''.join(chunks), uc1.encode('utf-8'))
+            for chunk in chunks:
+                self.assertTrue(chunk.endswith(b'\n'))
+        self.assertEqual(list(_iter_uc_chunks(self._write(u''))), [])
+
+    def test_iter_uc_hits_mmap(self):
+        data = uc1 + uc1.replace('q', 'p')
+        path = self._write(data)
+        expected = list(_iter_uc_lines(io.StringIO(data)))
+        self.assertEqual(list(_iter_uc_hits_mmap(path)), expected)
+        size = os.path.getsize(path)
+        self.assertEqual(list(_iter_uc_hits_mmap(_UcRange(path, 0, size))),
+                         expected)
+        self.assertEqual(list(_iter_uc_hits_mmap(self._write(u''))), [])
+
+    def test_range(self):
+        path = self._write(uc1 + uc1.replace('q', 'p'))
+        start = len(uc1.encode('utf-8'))
+        expected = list(_iter_uc_lines(io.StringIO(uc1.replace('q', 'p'))))
+        self.assertEqual(
+            list(_iter_uc_hits_mmap(_UcRange(path, start,
+                                             os.path.getsize(path)))),
+            expected)
+
+    def test_uc_hit_arrays_mmap(self):
+        data = uc1 + uc1.replace('q', 'p') + uc1
+        path = self._write(data)
+        expected = _uc_to_hit_arrays(io.StringIO(data), self.table)
+        actual = _uc_hit_arrays_mmap(path, self.table)
+        self.assertEqual(actual[0], expected[0])
+        npt.assert_array_equal(actual[1], expected[1])
+        npt.assert_array_equal(actual[2], expected[2])
+        self.assertEqual(_uc_to_hit_arrays(path, self.table)[0], expected[0])
+
+    def test_uc_hit_arrays_mmap_missing_reference(self):
+        path = self._write(uc1.replace('\tr5\n', '\tr7\n'))
+        self.assertRaises(KeyError, _uc_hit_arrays_mmap, path, self.table)
+
+    def test_unique_labels(self):
+        labels = np.array([b'b', b'a', b'b', b'', b'ab', b'a'])
+        distinct, inverse = _unique_labels(labels)
+        self.assertEqual(sorted(distinct), [b'', b'a', b'ab', b'b'])
+        self.assertEqual([distinct[i] for i in inverse], labels.tolist())
+        distinct, inverse = _unique_labels(labels.astype(object))
+        self.assertEqual([distinct[i] for i in inverse], labels.tolist())
+        distinct, inverse = _unique_labels(np.array([], dtype='S1'))
+        self.assertEqual(distinct, [])
+        self.assertEqual(len(inverse), 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016--, taxster development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import random
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+from taxster import TaxonomyTable
+from taxster._uc import (_TopHits, _compute_consensus_annotation,
+                         _batch_consensus_annotations,
+                         _compute_majority_path, _weight_sums)
+from taxster._vectorized import (_ancestor_matrix, _batch_consensus,
+                                 _batch_majority, _top_hits)
+
+
+class AncestorMatrixTests(TestCase):
+
+    def test_ancestor_matrix(self):
+        table = TaxonomyTable({'r1': ['A', 'B', 'C'],
+                               'r2': ['A', 'D'],
+                               'r3': []})
+        nodes = [table.node('r1'), table.node('r2'), table.node('r3')]
+        expected = [table.path(nodes[0]),
+                    table.path(nodes[1]) + [-1],
+                    [-1, -1, -1]]
+        actual = _ancestor_matrix(np.array(nodes), table)
+        npt.assert_array_equal(actual, expected)
+
+    def test_empty(self):
+        actual = _ancestor_matrix(np.array([], dtype=int), TaxonomyTable())
+        self.assertEqual(actual.shape, (0, 0))
+
+
+class BatchConsensusTests(TestCase):
+
+    def test_batch_consensus(self):
+        table = TaxonomyTable()
+        in_ = [['A', 'B', 'C', 'D'],
+               ['A', 'B', 'C', 'E'],
+               ['A', 'H', 'I', 'J'],
+               ['A', 'H', 'K', 'L', 'M'],
+               ['A', 'H', 'I', 'J'],
+               []]
+        nodes = np.array([table.intern(a) for a in in_])
+        query_index = np.array([0, 0, 1, 1, 1, 2])
+        ancestors = _ancestor_matrix(nodes, table)
+
+        actual_nodes, fractions, n_hits = _batch_consensus(
+            query_index, ancestors, 3, 0.51)
+        self.assertEqual([table.lineage(n) for n in actual_nodes],
+                         [['A', 'B', 'C'], ['A', 'H', 'I', 'J'], []])
+        npt.assert_array_equal(fractions, [1.0, 2. / 3., 1.0])
+        npt.assert_array_equal(n_hits, [2, 3, 1])
+
+        actual_nodes, fractions, n_hits = _batch_consensus(
+            query_index, ancestors, 3, 0.99)
+        self.assertEqual([table.lineage(n) for n in actual_nodes],
+                         [['A', 'B', 'C'], ['A', 'H'], []])
+        npt.assert_array_equal(fractions, [1.0, 1.0, 1.0])
+
+    def test_batch_majority(self):
+        table = TaxonomyTable()
+        in_ = [['A', 'B', 'C', 'D'],
+               ['A', 'B', 'C', 'E'],
+               ['A', 'H', 'I', 'J'],
+               ['A', 'H', 'K', 'L', 'M'],
+               ['A', 'H', 'I', 'J'],
+               ['A', 'F'],
+               ['G', 'F'],
+               []]
+        nodes = np.array([table.intern(a) for a in in_])
+        query_index = np.array([0, 0, 1, 1, 1, 2, 2, 3])
+        rank_nodes, rank_fractions, n_hits = _batch_majority(
+            query_index, _ancestor_matrix(nodes, table), 4)
+        self.assertEqual(rank_nodes.shape, (4, 5))
+        npt.assert_array_equal(rank_nodes[0], table.path(nodes[0])[:3] +
+                               [-1, -1])
+        npt.assert_array_equal(rank_nodes[1], table.path(nodes[2]) + [-1])
+        npt.assert_array_equal(rank_nodes[2:], -1)
+        npt.assert_array_equal(rank_fractions[1, :4],
+                               [1.0, 1.0, 2. / 3., 2. / 3.])
+        self.assertTrue(np.isnan(rank_fractions[0, 3:]).all())
+        self.assertTrue(np.isnan(rank_fractions[2:]).all())
+        npt.assert_array_equal(n_hits, [2, 3, 2, 1])
+
+    def test_weighted_batch_majority(self):
+        table = TaxonomyTable()
+        in_ = [['A', 'B', 'C', 'D'],
+               ['A', 'B', 'C', 'E'],
+               ['A', 'H', 'I', 'J'],
+               ['A', 'H', 'K', 'L', 'M'],
+               ['A', 'H', 'I', 'J'],
+               ['A', 'F'],
+               []]
+        nodes = np.array([table.intern(a) for a in in_])
+        query_index = np.array([0, 0, 1, 1, 1, 2, 2])
+        weights = np.array([97.0, 100.0, 97.0, 60.0, 100.0, 0.0, 0.0])
+        rank_nodes, rank_fractions, n_hits = _batch_majority(
+            query_index, _ancestor_matrix(nodes, table), 3, weights)
+        npt.assert_array_equal(rank_nodes[0], table.path(nodes[1]) + [-1])
+        npt.assert_array_equal(rank_fractions[0, :4],
+                               [1.0, 1.0, 1.0, 100.0 / 197.0])
+        npt.assert_array_equal(rank_nodes[1], table.path(nodes[2]) + [-1])
+        npt.assert_array_equal(rank_fractions[1, 2:4],
+                               [197.0 / 257.0, 197.0 / 257.0])
+        # hits without any weight have no majority
+        npt.assert_array_equal(rank_nodes[2], -1)
+        npt.assert_array_equal(n_hits, [2, 3, 2])
+
+    def test_weighted_matches_compute_majority_path(self):
+        rng = random.Random(0)
+        table = TaxonomyTable()
+        references = [table.intern(['%d%d' % (level, rng.randrange(3))
+                                    for level in range(rng.randint(0, 5))])
+                      for _ in range(20)]
+        query_index, nodes, weights = [], [], []
+        for q in range(100):
+            for _ in range(rng.randint(1, 8)):
+                query_index.append(q)
+                nodes.append(rng.choice(references))
+                weights.append(round(rng.uniform(90, 100), 1))
+        rank_nodes, rank_fractions, _ = _batch_majority(
+            np.array(query_index), _ancestor_matrix(np.array(nodes), table),
+            100, np.array(weights))
+        for q in range(100):
+            hits = [i for i, index in enumerate(query_index) if index == q]
+            path, fractions = _compute_majority_path(
+                _weight_sums([nodes[i] for i in hits],
+                             [weights[i] for i in hits]), table)
+            self.assertEqual(rank_nodes[q, :len(path)].tolist(), path)
+            # the weights are summed in the same order, so the fractions
+            # are equal rather than close
+            self.assertEqual(rank_fractions[q, :len(path)].tolist(),
+                             fractions)
+            self.assertTrue((rank_nodes[q, len(path):] == -1).all())
+
+    def test_top_hits(self):
+        rng = random.Random(0)
+        query_index = [rng.randrange(10) for _ in range(200)]
+        identities = [float(rng.randint(95, 100)) for _ in range(200)]
+        for max_hits in (1, 2, 5, 50):
+            top_hits = {}
+            for i, (q, identity) in enumerate(zip(query_index, identities)):
+                top_hits.setdefault(q, _TopHits(max_hits)).add(i, identity)
+            expected = sorted(i for hits in top_hits.values()
+                              for i in hits.hits()[0])
+            actual = _top_hits(np.array(query_index), np.array(identities),
+                               max_hits)
+            npt.assert_array_equal(actual, expected)
+        self.assertEqual(len(_top_hits(np.zeros(0, dtype=int), np.zeros(0),
+                                       1)), 0)
+
+    def test_invalid_min_consensus_fraction(self):
+        self.assertRaises(ValueError, _batch_consensus, np.array([0]),
+                          np.array([[1]]), 1, 0.5)
+
+    def test_matches_compute_consensus_annotation(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            references = []
+            for _ in range(20):
+                depth = rng.choice([0, 3, 5, 7])
+                depth = rng.randint(max(0, depth - 2), depth)
+                references.append(['%d%d' % (level, rng.randrange(3))
+                                   for level in range(depth)])
+            table = TaxonomyTable()
+            query_ids, query_index, nodes, annotations = [], [], [], {}
+            for q in range(20):
+                query_id = 'q%d' % q
+                query_ids.append(query_id)
+                for _ in range(rng.randint(1, 8)):
+                    annotation = rng.choice(references)
+                    query_index.append(q)
+                    nodes.append(table.intern(annotation))
+                    annotations.setdefault(query_id, []).append(annotation)
+            for min_consensus_fraction in (0.51, 0.6, 0.75, 1.0):
+                expected = {}
+                for query_id, a in annotations.items():
+                    expected[query_id] = _compute_consensus_annotation(
+                        a, min_consensus_fraction, 'x') + (len(a),)
+                actual = _batch_consensus_annotations(
+                    query_ids, np.array(query_index), np.array(nodes), table,
+                    min_consensus_fraction, 'x')
+                self.assertEqual(actual, expected)
+
+
+if __name__ == "__main__":
+    main()